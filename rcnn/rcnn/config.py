@@ -48,6 +48,9 @@ config.TRAIN.RPN_FG_FRACTION = 0.5
 config.TRAIN.RPN_POSITIVE_OVERLAP = 0.7
 config.TRAIN.RPN_NEGATIVE_OVERLAP = 0.3
 config.TRAIN.RPN_CLOBBER_POSITIVES = False
+# 'sparse' only computes overlaps of anchors near each gt box, faster for many gt boxes or large images
+# 'dense' computes the full anchor x gt overlap matrix, labels and regression targets are identical
+config.TRAIN.RPN_ASSIGN_MODE = 'dense'
 # rpn bounding box regression params
 config.TRAIN.RPN_BBOX_WEIGHTS = (1.0, 1.0, 1.0, 1.0)
 config.TRAIN.RPN_POSITIVE_WEIGHT = -1.0
@@ -88,6 +91,9 @@ config.TEST.PROPOSAL_MIN_SIZE = config.RPN_FEAT_STRIDE
 # RCNN nms
 config.TEST.NMS = 0.3
 
+# processes COCO evaluation shards images over
+config.TEST.COCO_EVAL_PROCS = 1
+
 # default settings
 default = edict()
 
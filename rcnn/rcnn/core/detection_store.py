@@ -0,0 +1,141 @@
+"""
+Chunked on-disk store of the detections of pred_eval.
+Detections are appended image by image and written in chunks, so a crashed
+evaluation can resume after the last written chunk. The store reads like
+all_boxes[cls][image], arrays are opened with numpy memmap on demand.
+
+Layout of the store directory:
+    index.json : num_classes, chunk_size and the written chunks
+    chunk_<n>_boxes.npy : (num_boxes, 5) float64 detections (x1, y1, x2, y2, score)
+        of the images of chunk n
+    chunk_<n>_offsets.npy : (num_chunk_images * num_classes + 1) int64,
+        detections of class j in image i are boxes[offsets[i * num_classes + j]:
+        offsets[i * num_classes + j + 1]], i counting from the chunk start
+"""
+
+import bisect
+import json
+import os
+import shutil
+import numpy as np
+
+from rcnn.logger import logger
+
+
+class DetectionStore(object):
+    def __init__(self, path, num_classes, chunk_size=500, resume=False):
+        """
+        open a store for writing
+        :param path: store directory
+        :param num_classes: number of classes including background
+        :param chunk_size: number of images written at a time
+        :param resume: keep the chunks of a previous run with the same classes
+        """
+        self.path = path
+        self.num_classes = num_classes
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._starts = []
+        self._pending = []
+        self._cache = {}
+
+        index = self._read_index()
+        if resume and index is not None and index['num_classes'] == num_classes:
+            self._chunks = index['chunks']
+            self._starts = [c[0] for c in self._chunks]
+            logger.info('resuming detections from %s after %d images' % (path, self.num_done))
+        else:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            self._write_index()
+
+    @property
+    def num_done(self):
+        """ number of images written to disk """
+        return self._chunks[-1][1] if self._chunks else 0
+
+    def append(self, dets):
+        """
+        add the detections of the next image
+        :param dets: [num_classes] list of [n, 5] arrays, may be empty lists
+        """
+        self._pending.append(dets)
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ write the pending images as a chunk """
+        if not self._pending:
+            return
+        start = self.num_done
+        end = start + len(self._pending)
+        arrays = [np.asarray(d, dtype=np.float64).reshape((-1, 5)) for dets in self._pending for d in dets]
+        offsets = np.zeros((len(arrays) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum([a.shape[0] for a in arrays])
+        boxes = np.vstack(arrays) if arrays else np.zeros((0, 5))
+        n = len(self._chunks)
+        # files are renamed into place, so a crash leaves no partial chunk
+        for name, array in (('boxes', boxes), ('offsets', offsets)):
+            tmp = os.path.join(self.path, 'chunk_%d_%s.tmp.npy' % (n, name))
+            np.save(tmp, array)
+            os.rename(tmp, self._chunk_file(n, name))
+        self._chunks.append([start, end])
+        self._starts.append(start)
+        self._write_index()
+        self._pending = []
+
+    def __len__(self):
+        return self.num_classes
+
+    def __getitem__(self, cls_ind):
+        """ detections of a class, indexed by image """
+        return _ClassView(self, cls_ind)
+
+    def get(self, cls_ind, im_ind):
+        """
+        detections of a class in an image
+        :return: [n, 5] array
+        """
+        n = bisect.bisect_right(self._starts, im_ind) - 1
+        if n < 0 or im_ind >= self._chunks[n][1]:
+            raise IndexError('image %d is not in the store' % im_ind)
+        boxes, offsets = self._open_chunk(n)
+        k = (im_ind - self._chunks[n][0]) * self.num_classes + cls_ind
+        return boxes[offsets[k]:offsets[k + 1]]
+
+    def _open_chunk(self, n):
+        if n not in self._cache:
+            self._cache[n] = (np.load(self._chunk_file(n, 'boxes'), mmap_mode='r'),
+                              np.load(self._chunk_file(n, 'offsets'), mmap_mode='r'))
+        return self._cache[n]
+
+    def _chunk_file(self, n, name):
+        return os.path.join(self.path, 'chunk_%d_%s.npy' % (n, name))
+
+    def _read_index(self):
+        fn_index = os.path.join(self.path, 'index.json')
+        if not os.path.exists(fn_index):
+            return None
+        with open(fn_index, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self):
+        fn_index = os.path.join(self.path, 'index.json')
+        with open(fn_index + '.tmp', 'w') as f:
+            json.dump({'num_classes': self.num_classes, 'chunk_size': self.chunk_size,
+                       'chunks': self._chunks}, f)
+        os.rename(fn_index + '.tmp', fn_index)
+
+
+class _ClassView(object):
+    """ all_boxes[cls] of a DetectionStore """
+    def __init__(self, store, cls_ind):
+        self._store = store
+        self._cls_ind = cls_ind
+
+    def __len__(self):
+        return self._store.num_done
+
+    def __getitem__(self, im_ind):
+        return self._store.get(self._cls_ind, im_ind)
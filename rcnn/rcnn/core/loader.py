@@ -1,3 +1,6 @@
+import collections
+import multiprocessing as mp
+import random
 import mxnet as mx
 import numpy as np
 from mxnet.executor_manager import _split_input_slice
@@ -53,8 +56,14 @@ class TestLoader(mx.io.DataIter):
         if self.shuffle:
             np.random.shuffle(self.index)
 
+    def seek(self, index):
+        """ continue from image index of a non-shuffled roidb, e.g. to resume testing """
+        assert not self.shuffle
+        self.cur = index
+
     def iter_next(self):
-        return self.cur + self.batch_size <= self.size
+        # the last batch may hold fewer images
+        return self.cur < self.size
 
     def next(self):
         if self.iter_next():
@@ -89,7 +98,8 @@ class TestLoader(mx.io.DataIter):
 
 
 class ROIIter(mx.io.DataIter):
-    def __init__(self, roidb, batch_size=2, shuffle=False, ctx=None, work_load_list=None, aspect_grouping=False):
+    def __init__(self, roidb, batch_size=2, shuffle=False, ctx=None, work_load_list=None, aspect_grouping=False,
+                 num_workers=0, prefetch=4):
         """
         This Iter will provide roi data to Fast R-CNN network
         :param roidb: must be preprocessed
@@ -98,6 +108,8 @@ class ROIIter(mx.io.DataIter):
         :param ctx: list of contexts
         :param work_load_list: list of work load
         :param aspect_grouping: group images with similar aspects
+        :param num_workers: number of processes loading batches ahead of time, 0 to load them in next()
+        :param prefetch: maximum number of batches loaded ahead of time by the workers
         :return: ROIIter
         """
         super(ROIIter, self).__init__()
@@ -127,8 +139,13 @@ class ROIIter(mx.io.DataIter):
         self.label = None
 
         # get first batch to fill in provide_data and provide_label
+        self.prefetcher = None
         self.reset()
         self.get_batch()
+        if num_workers > 0:
+            self.prefetcher = BatchPrefetcher(_get_roi_batch, self._batch_params(), self.roidb,
+                                              num_workers, prefetch)
+            self.prefetcher.start_epoch(self._epoch_batches())
 
     @property
     def provide_data(self):
@@ -149,20 +166,33 @@ class ROIIter(mx.io.DataIter):
                 horz_inds = np.where(horz)[0]
                 vert_inds = np.where(vert)[0]
                 inds = np.hstack((np.random.permutation(horz_inds), np.random.permutation(vert_inds)))
-                extra = inds.shape[0] % self.batch_size
-                inds_ = np.reshape(inds[:-extra], (-1, self.batch_size))
+                # shuffle whole batches, the last partial one stays at the end
+                num_full = inds.shape[0] - inds.shape[0] % self.batch_size
+                inds_ = np.reshape(inds[:num_full], (-1, self.batch_size))
                 row_perm = np.random.permutation(np.arange(inds_.shape[0]))
-                inds[:-extra] = np.reshape(inds_[row_perm, :], (-1,))
+                inds[:num_full] = np.reshape(inds_[row_perm, :], (-1,))
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
+        if self.prefetcher is not None:
+            self.prefetcher.start_epoch(self._epoch_batches())
 
     def iter_next(self):
         return self.cur + self.batch_size <= self.size
 
+    def _epoch_batches(self):
+        """ roidb indices of each batch returned by next() in this epoch """
+        return [self.index[cur:cur + self.batch_size]
+                for cur in range(0, self.size - self.batch_size + 1, self.batch_size)]
+
     def next(self):
         if self.iter_next():
-            self.get_batch()
+            if self.prefetcher is not None:
+                data, label = self.prefetcher.get()
+                self.data = [mx.nd.array(d) for d in data]
+                self.label = [mx.nd.array(l) for l in label]
+            else:
+                self.get_batch()
             self.cur += self.batch_size
             return mx.io.DataBatch(data=self.data, label=self.label,
                                    pad=self.getpad(), index=self.getindex(),
@@ -185,40 +215,19 @@ class ROIIter(mx.io.DataIter):
         cur_to = min(cur_from + self.batch_size, self.size)
         roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
 
-        # decide multi device slices
-        work_load_list = self.work_load_list
-        ctx = self.ctx
-        if work_load_list is None:
-            work_load_list = [1] * len(ctx)
-        assert isinstance(work_load_list, list) and len(work_load_list) == len(ctx), \
-            "Invalid settings for work load. "
-        slices = _split_input_slice(self.batch_size, work_load_list)
-
-        # get each device
-        data_list = []
-        label_list = []
-        for islice in slices:
-            iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
-            data, label = get_rcnn_batch(iroidb)
-            data_list.append(data)
-            label_list.append(label)
-
-        all_data = dict()
-        for key in data_list[0].keys():
-            all_data[key] = tensor_vstack([batch[key] for batch in data_list])
-
-        all_label = dict()
-        for key in label_list[0].keys():
-            all_label[key] = tensor_vstack([batch[key] for batch in label_list])
+        data, label = _get_roi_batch(self._batch_params(), roidb)
+        self.data = [mx.nd.array(d) for d in data]
+        self.label = [mx.nd.array(l) for l in label]
 
-        self.data = [mx.nd.array(all_data[name]) for name in self.data_name]
-        self.label = [mx.nd.array(all_label[name]) for name in self.label_name]
+    def _batch_params(self):
+        return (self.data_name, self.label_name, self.batch_size,
+                _work_load_list(self.work_load_list, self.ctx))
 
 
 class AnchorLoader(mx.io.DataIter):
     def __init__(self, feat_sym, roidb, batch_size=1, shuffle=False, ctx=None, work_load_list=None,
                  feat_stride=16, anchor_scales=(8, 16, 32), anchor_ratios=(0.5, 1, 2), allowed_border=0,
-                 aspect_grouping=False):
+                 aspect_grouping=False, num_workers=0, prefetch=4):
         """
         This Iter will provide roi data to Fast R-CNN network
         :param feat_sym: to infer shape of assign_output
@@ -228,6 +237,8 @@ class AnchorLoader(mx.io.DataIter):
         :param ctx: list of contexts
         :param work_load_list: list of work load
         :param aspect_grouping: group images with similar aspects
+        :param num_workers: number of processes loading batches ahead of time, 0 to load them in next()
+        :param prefetch: maximum number of batches loaded ahead of time by the workers
         :return: AnchorLoader
         """
         super(AnchorLoader, self).__init__()
@@ -265,8 +276,13 @@ class AnchorLoader(mx.io.DataIter):
         self.label = None
 
         # get first batch to fill in provide_data and provide_label
+        self.prefetcher = None
         self.reset()
         self.get_batch()
+        if num_workers > 0:
+            self.prefetcher = BatchPrefetcher(_get_anchor_batch, self._batch_params(), self.roidb,
+                                              num_workers, prefetch)
+            self.prefetcher.start_epoch(self._epoch_batches())
 
     @property
     def provide_data(self):
@@ -287,20 +303,33 @@ class AnchorLoader(mx.io.DataIter):
                 horz_inds = np.where(horz)[0]
                 vert_inds = np.where(vert)[0]
                 inds = np.hstack((np.random.permutation(horz_inds), np.random.permutation(vert_inds)))
-                extra = inds.shape[0] % self.batch_size
-                inds_ = np.reshape(inds[:-extra], (-1, self.batch_size))
+                # shuffle whole batches, the last partial one stays at the end
+                num_full = inds.shape[0] - inds.shape[0] % self.batch_size
+                inds_ = np.reshape(inds[:num_full], (-1, self.batch_size))
                 row_perm = np.random.permutation(np.arange(inds_.shape[0]))
-                inds[:-extra] = np.reshape(inds_[row_perm, :], (-1,))
+                inds[:num_full] = np.reshape(inds_[row_perm, :], (-1,))
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
+        if self.prefetcher is not None:
+            self.prefetcher.start_epoch(self._epoch_batches())
 
     def iter_next(self):
         return self.cur + self.batch_size <= self.size
 
+    def _epoch_batches(self):
+        """ roidb indices of each batch returned by next() in this epoch """
+        return [self.index[cur:cur + self.batch_size]
+                for cur in range(0, self.size - self.batch_size + 1, self.batch_size)]
+
     def next(self):
         if self.iter_next():
-            self.get_batch()
+            if self.prefetcher is not None:
+                data, label = self.prefetcher.get()
+                self.data = [mx.nd.array(d) for d in data]
+                self.label = [mx.nd.array(l) for l in label]
+            else:
+                self.get_batch()
             self.cur += self.batch_size
             return mx.io.DataBatch(data=self.data, label=self.label,
                                    pad=self.getpad(), index=self.getindex(),
@@ -339,57 +368,14 @@ class AnchorLoader(mx.io.DataIter):
         cur_to = min(cur_from + self.batch_size, self.size)
         roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
 
-        # decide multi device slice
-        work_load_list = self.work_load_list
-        ctx = self.ctx
-        if work_load_list is None:
-            work_load_list = [1] * len(ctx)
-        assert isinstance(work_load_list, list) and len(work_load_list) == len(ctx), \
-            "Invalid settings for work load. "
-        slices = _split_input_slice(self.batch_size, work_load_list)
-
-        # get testing data for multigpu
-        data_list = []
-        label_list = []
-        for islice in slices:
-            iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
-            data, label = get_rpn_batch(iroidb)
-            data_list.append(data)
-            label_list.append(label)
-
-        # pad data first and then assign anchor (read label)
-        data_tensor = tensor_vstack([batch['data'] for batch in data_list])
-        for data, data_pad in zip(data_list, data_tensor):
-            data['data'] = data_pad[np.newaxis, :]
-
-        new_label_list = []
-        for data, label in zip(data_list, label_list):
-            # infer label shape
-            data_shape = {k: v.shape for k, v in data.items()}
-            del data_shape['im_info']
-            _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
-            feat_shape = [int(i) for i in feat_shape[0]]
-
-            # add gt_boxes to data for e2e
-            data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
+        data, label = _get_anchor_batch(self._batch_params(), roidb)
+        self.data = [mx.nd.array(d) for d in data]
+        self.label = [mx.nd.array(l) for l in label]
 
-            # assign anchor for label
-            label = assign_anchor(feat_shape, label['gt_boxes'], data['im_info'],
-                                  self.feat_stride, self.anchor_scales,
-                                  self.anchor_ratios, self.allowed_border)
-            new_label_list.append(label)
-
-        all_data = dict()
-        for key in self.data_name:
-            all_data[key] = tensor_vstack([batch[key] for batch in data_list])
-
-        all_label = dict()
-        for key in self.label_name:
-            pad = -1 if key == 'label' else 0
-            all_label[key] = tensor_vstack([batch[key] for batch in new_label_list], pad=pad)
-
-        self.data = [mx.nd.array(all_data[key]) for key in self.data_name]
-        self.label = [mx.nd.array(all_label[key]) for key in self.label_name]
+    def _batch_params(self):
+        return (self.feat_sym, self.data_name, self.label_name, self.batch_size,
+                _work_load_list(self.work_load_list, self.ctx), self.feat_stride,
+                self.anchor_scales, self.anchor_ratios, self.allowed_border)
 
 
 class AnchorLoaderMS(mx.io.DataIter):
@@ -462,10 +448,11 @@ class AnchorLoaderMS(mx.io.DataIter):
                 horz_inds = np.where(horz)[0]
                 vert_inds = np.where(vert)[0]
                 inds = np.hstack((np.random.permutation(horz_inds), np.random.permutation(vert_inds)))
-                extra = inds.shape[0] % self.batch_size
-                inds_ = np.reshape(inds[:-extra], (-1, self.batch_size))
+                # shuffle whole batches, the last partial one stays at the end
+                num_full = inds.shape[0] - inds.shape[0] % self.batch_size
+                inds_ = np.reshape(inds[:num_full], (-1, self.batch_size))
                 row_perm = np.random.permutation(np.arange(inds_.shape[0]))
-                inds[:-extra] = np.reshape(inds_[row_perm, :], (-1,))
+                inds[:num_full] = np.reshape(inds_[row_perm, :], (-1,))
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
@@ -556,6 +543,10 @@ class AnchorLoaderMS(mx.io.DataIter):
 
         all_data = dict()
         for key in self.data_name:
+            if key == 'data':
+                # already stacked
+                all_data[key] = data_tensor
+                continue
             all_data[key] = tensor_vstack([batch[key] for batch in data_list])
 
         all_label = dict()
@@ -565,3 +556,161 @@ class AnchorLoaderMS(mx.io.DataIter):
 
         self.data = [mx.nd.array(all_data[key]) for key in self.data_name]
         self.label = [mx.nd.array(all_label[key]) for key in self.label_name]
+
+
+def _work_load_list(work_load_list, ctx):
+    """ decide multi device work load """
+    if work_load_list is None:
+        work_load_list = [1] * len(ctx)
+    assert isinstance(work_load_list, list) and len(work_load_list) == len(ctx), \
+        "Invalid settings for work load. "
+    return work_load_list
+
+
+def _get_roi_batch(params, roidb):
+    """
+    load a batch of ROIIter
+    :param params: (data_name, label_name, batch_size, work_load_list)
+    :param roidb: roidb of the batch
+    :return: list of data arrays, list of label arrays
+    """
+    data_name, label_name, batch_size, work_load_list = params
+    slices = _split_input_slice(batch_size, work_load_list)
+
+    # get each device
+    data_list = []
+    label_list = []
+    for islice in slices:
+        iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
+        data, label = get_rcnn_batch(iroidb)
+        data_list.append(data)
+        label_list.append(label)
+
+    all_data = dict()
+    for key in data_list[0].keys():
+        all_data[key] = tensor_vstack([batch[key] for batch in data_list])
+
+    all_label = dict()
+    for key in label_list[0].keys():
+        all_label[key] = tensor_vstack([batch[key] for batch in label_list])
+
+    return [all_data[name] for name in data_name], [all_label[name] for name in label_name]
+
+
+def _get_anchor_batch(params, roidb):
+    """
+    load a batch of AnchorLoader, with anchor targets
+    :param params: (feat_sym, data_name, label_name, batch_size, work_load_list,
+    feat_stride, anchor_scales, anchor_ratios, allowed_border)
+    :param roidb: roidb of the batch
+    :return: list of data arrays, list of label arrays
+    """
+    feat_sym, data_name, label_name, batch_size, work_load_list, \
+        feat_stride, anchor_scales, anchor_ratios, allowed_border = params
+    slices = _split_input_slice(batch_size, work_load_list)
+
+    # get testing data for multigpu
+    data_list = []
+    label_list = []
+    for islice in slices:
+        # a device may get several images, anchors are assigned per image
+        for i in range(islice.start, islice.stop):
+            data, label = get_rpn_batch([roidb[i]])
+            data_list.append(data)
+            label_list.append(label)
+
+    # pad data first and then assign anchor (read label)
+    data_tensor = tensor_vstack([batch['data'] for batch in data_list])
+    for data, data_pad in zip(data_list, data_tensor):
+        data['data'] = data_pad[np.newaxis, :]
+
+    # all images are padded to the same size
+    data_shape = {'data': data_list[0]['data'].shape}
+    _, feat_shape, _ = feat_sym.infer_shape(**data_shape)
+    feat_shape = [int(i) for i in feat_shape[0]]
+
+    new_label_list = []
+    for data, label in zip(data_list, label_list):
+        # add gt_boxes to data for e2e
+        data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
+
+        # assign anchor for label
+        label = assign_anchor(feat_shape, label['gt_boxes'], data['im_info'],
+                              feat_stride, anchor_scales, anchor_ratios, allowed_border)
+        new_label_list.append(label)
+
+    all_data = dict()
+    for key in data_name:
+        if key == 'data':
+            # already stacked
+            all_data[key] = data_tensor
+            continue
+        all_data[key] = tensor_vstack([batch[key] for batch in data_list])
+
+    all_label = dict()
+    for key in label_name:
+        pad = -1 if key == 'label' else 0
+        all_label[key] = tensor_vstack([batch[key] for batch in new_label_list], pad=pad)
+
+    return [all_data[key] for key in data_name], [all_label[key] for key in label_name]
+
+
+class BatchPrefetcher(object):
+    """
+    Load the batches of an epoch ahead of time in worker processes, and
+    return them in order. Every batch is loaded with its own random seed,
+    drawn when the epoch starts, so results do not depend on scheduling.
+    Workers are forked, they see the roidb and config of the parent.
+    :param func: func(params, roidb) loads a batch
+    :param params: arguments of func common to all batches
+    :param roidb: roidb of the iterator
+    :param num_workers: number of worker processes
+    :param prefetch: maximum number of batches being loaded
+    """
+    def __init__(self, func, params, roidb, num_workers, prefetch=4):
+        self.prefetch = max(1, prefetch)
+        self.pool = mp.Pool(num_workers, _init_prefetch_worker, (func, params, roidb))
+        self.tasks = []
+        self.pending = collections.deque()
+
+    def start_epoch(self, batch_indices):
+        """
+        :param batch_indices: list of roidb indices of each batch of the epoch
+        """
+        # batches of the previous epoch still being loaded are dropped
+        self.pending.clear()
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(batch_indices))
+        self.tasks = collections.deque(zip(batch_indices, seeds))
+        self._submit()
+
+    def get(self):
+        """ next batch: list of data arrays, list of label arrays """
+        self._submit()
+        result = self.pending.popleft().get()
+        self._submit()
+        return result
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def _submit(self):
+        while self.tasks and len(self.pending) < self.prefetch:
+            self.pending.append(self.pool.apply_async(_prefetch_worker, (self.tasks.popleft(),)))
+
+
+_prefetch_state = {}
+
+
+def _init_prefetch_worker(func, params, roidb):
+    _prefetch_state['func'] = func
+    _prefetch_state['params'] = params
+    _prefetch_state['roidb'] = roidb
+
+
+def _prefetch_worker(task):
+    indices, seed = task
+    random.seed(int(seed))
+    np.random.seed(seed)
+    roidb = [_prefetch_state['roidb'][i] for i in indices]
+    return _prefetch_state['func'](_prefetch_state['params'], roidb)
@@ -1,15 +1,21 @@
 import cPickle
+import collections
 import os
+import Queue
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 import mxnet as mx
 import numpy as np
 
 from module import MutableModule
+from detection_store import DetectionStore
 from rcnn.logger import logger
 from rcnn.config import config
 from rcnn.io import image
 from rcnn.processing.bbox_transform import bbox_pred, clip_boxes
-from rcnn.processing.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from rcnn.processing.topk import topk
+from rcnn.processing.nms import py_nms_wrapper, cpu_nms_wrapper, cpu_nms_batch_wrapper, gpu_nms_wrapper
 
 
 class Predictor(object):
@@ -41,6 +47,27 @@ def im_proposal(predictor, data_batch, data_names, scale):
     return scores, boxes, data_dict
 
 
+def im_proposal_batch(predictor, data_batch, data_names, scales):
+    """
+    proposals of a batch of images
+    :param scales: scale of each image
+    :return: list of scores and list of boxes of each image, data_dict
+    """
+    data_dict = dict(zip(data_names, data_batch.data))
+    output = predictor.predict(data_batch)
+
+    # rois of all images are stacked, the first column is the image index
+    rois = output['rois_output'].asnumpy()
+    scores = output['rois_score'].asnumpy()
+    batch_inds = rois[:, 0].astype(int)
+
+    # transform to original scale
+    boxes = [rois[batch_inds == i, 1:] / scale for i, scale in enumerate(scales)]
+    scores = [scores[batch_inds == i] for i in range(len(scales))]
+
+    return scores, boxes, data_dict
+
+
 def generate_proposals(predictor, test_data, imdb, vis=False, thresh=0.):
     """
     Generate detections results using RPN.
@@ -62,27 +89,28 @@ def generate_proposals(predictor, test_data, imdb, vis=False, thresh=0.):
         t1 = time.time() - t
         t = time.time()
 
-        scale = im_info[0, 2]
-        scores, boxes, data_dict = im_proposal(predictor, data_batch, data_names, scale)
+        scales = im_info[:, 2]
+        scores_all, boxes_all, data_dict = im_proposal_batch(predictor, data_batch, data_names, scales)
         t2 = time.time() - t
         t = time.time()
 
-        # assemble proposals
-        dets = np.hstack((boxes, scores))
-        original_boxes.append(dets)
+        for k, (scores, boxes) in enumerate(zip(scores_all, boxes_all)):
+            # assemble proposals
+            dets = np.hstack((boxes, scores))
+            original_boxes.append(dets)
 
-        # filter proposals
-        keep = np.where(dets[:, 4:] > thresh)[0]
-        dets = dets[keep, :]
-        imdb_boxes.append(dets)
+            # filter proposals
+            keep = np.where(dets[:, 4:] > thresh)[0]
+            dets = dets[keep, :]
+            imdb_boxes.append(dets)
 
-        if vis:
-            vis_all_detection(data_dict['data'].asnumpy(), [dets], ['obj'], scale)
+            if vis:
+                vis_all_detection(data_dict['data'].asnumpy()[k:k + 1], [dets], ['obj'], scales[k])
 
-        logger.info('generating %d/%d ' % (i + 1, imdb.num_images) +
-                    'proposal %d ' % (dets.shape[0]) +
-                    'data %.4fs net %.4fs' % (t1, t2))
-        i += 1
+            logger.info('generating %d/%d ' % (i + 1, imdb.num_images) +
+                        'proposal %d ' % (dets.shape[0]) +
+                        'data %.4fs net %.4fs' % (t1, t2))
+            i += 1
 
     assert len(imdb_boxes) == imdb.num_images, 'calculations not complete'
 
@@ -128,35 +156,70 @@ def im_detect(predictor, data_batch, data_names, scale):
     return scores, pred_boxes, data_dict
 
 
-def pred_eval(predictor, test_data, imdb, vis=False, thresh=1e-3):
+def pred_eval(predictor, test_data, imdb, vis=False, thresh=1e-3, stream=False, resume=False,
+              prefetch=2, post_workers=2):
     """
     wrapper for calculating offline validation for faster data analysis
     in this example, all threshold are set by hand
+    data loading, network forward and post processing run as a pipeline:
+    batches are loaded in a thread, post processing runs in a thread pool
+    and results are collected in image order
     :param predictor: Predictor
     :param test_data: data iterator, must be non-shuffle
     :param imdb: image database
     :param vis: controls visualization
     :param thresh: valid detection threshold
+    :param stream: write detections to a DetectionStore as they are produced instead of keeping them in memory
+    :param resume: with stream, continue after the images already in the store
+    :param prefetch: number of batches loaded ahead of the network
+    :param post_workers: number of post processing threads, 0 to post process in the main thread
+    with all OpenMP threads in nms
     :return:
     """
     assert vis or not test_data.shuffle
     data_names = [k[0] for k in test_data.provide_data]
 
-    nms = py_nms_wrapper(config.TEST.NMS)
+    # post processing threads already run images in parallel, each nms then uses one thread
+    nms = cpu_nms_batch_wrapper(config.TEST.NMS, num_threads=1 if post_workers > 0 else 0)
 
     # limit detections to max_per_image over all classes
     max_per_image = -1
 
     num_images = imdb.num_images
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
-
     i = 0
+    if stream:
+        # detections of each image are appended to a store in the cache
+        det_store = DetectionStore(os.path.join(imdb.cache_path, imdb.name + '_detections'),
+                                   imdb.num_classes, resume=resume)
+        i = det_store.num_done
+        test_data.seek(i)
+    else:
+        # all detections are collected into:
+        #    all_boxes[cls][image] = N x 5 array of detections in
+        #    (x1, y1, x2, y2, score)
+        all_boxes = [[[] for _ in xrange(num_images)]
+                     for _ in xrange(imdb.num_classes)]
+
+    pool = ThreadPool(post_workers) if post_workers > 0 else None
+    # post processing in flight, in image order
+    pending = collections.deque()
+
+    def collect(i):
+        result, data_dict, scale, t1, t2 = pending.popleft()
+        im_boxes, t3 = result.get() if pool is not None else result
+        if stream:
+            det_store.append(im_boxes)
+        else:
+            for j in range(1, imdb.num_classes):
+                all_boxes[j][i] = im_boxes[j]
+
+        if vis:
+            vis_all_detection(data_dict['data'].asnumpy(), im_boxes, imdb.classes, scale)
+
+        logger.info('testing %d/%d data %.4fs net %.4fs post %.4fs' % (i, imdb.num_images, t1, t2, t3))
+
     t = time.time()
-    for im_info, data_batch in test_data:
+    for im_info, data_batch in _prefetch(test_data, prefetch):
         t1 = time.time() - t
         t = time.time()
 
@@ -164,33 +227,30 @@ def pred_eval(predictor, test_data, imdb, vis=False, thresh=1e-3):
         scores, boxes, data_dict = im_detect(predictor, data_batch, data_names, scale)
 
         t2 = time.time() - t
-        t = time.time()
 
-        for j in range(1, imdb.num_classes):
-            indexes = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[indexes, j, np.newaxis]
-            cls_boxes = boxes[indexes, j * 4:(j + 1) * 4]
-            cls_dets = np.hstack((cls_boxes, cls_scores))
-            keep = nms(cls_dets)
-            all_boxes[j][i] = cls_dets[keep, :]
-
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in range(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in range(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
+        args = (scores, boxes, imdb.num_classes, thresh, nms, max_per_image)
+        if pool is not None:
+            pending.append((pool.apply_async(_post_process, args), data_dict, scale, t1, t2))
+            # bound the number of images waiting for post processing
+            if len(pending) > 2 * post_workers:
+                collect(i - len(pending) + 1)
+        else:
+            pending.append((_post_process(*args), data_dict, scale, t1, t2))
+            collect(i)
+        i += 1
+        t = time.time()
 
-        if vis:
-            boxes_this_image = [[]] + [all_boxes[j][i] for j in range(1, imdb.num_classes)]
-            vis_all_detection(data_dict['data'].asnumpy(), boxes_this_image, imdb.classes, scale)
+    while pending:
+        collect(i - len(pending))
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        t3 = time.time() - t
-        t = time.time()
-        logger.info('testing %d/%d data %.4fs net %.4fs post %.4fs' % (i, imdb.num_images, t1, t2, t3))
-        i += 1
+    if stream:
+        det_store.flush()
+        assert det_store.num_done == num_images, 'calculations not complete'
+        imdb.evaluate_detections(det_store)
+        return
 
     det_file = os.path.join(imdb.cache_path, imdb.name + '_detections.pkl')
     with open(det_file, 'wb') as f:
@@ -199,6 +259,69 @@ def pred_eval(predictor, test_data, imdb, vis=False, thresh=1e-3):
     imdb.evaluate_detections(all_boxes)
 
 
+def _post_process(scores, boxes, num_classes, thresh, nms, max_per_image):
+    """
+    per class thresholding and nms of the detections of an image
+    :return: im_boxes[cls] = N x 5 array of (x1, y1, x2, y2, score), post processing time
+    """
+    t = time.time()
+    # nms of all classes at once
+    cls_dets_list = []
+    for j in range(1, num_classes):
+        indexes = np.where(scores[:, j] > thresh)[0]
+        cls_scores = scores[indexes, j, np.newaxis]
+        cls_boxes = boxes[indexes, j * 4:(j + 1) * 4]
+        cls_dets_list.append(np.hstack((cls_boxes, cls_scores)))
+    keeps = nms([cls_dets.astype(np.float32) for cls_dets in cls_dets_list])
+    im_boxes = [[]] + [cls_dets[keep, :] for cls_dets, keep in zip(cls_dets_list, keeps)]
+
+    if max_per_image > 0:
+        image_scores = np.hstack([im_boxes[j][:, -1]
+                                  for j in range(1, num_classes)])
+        if len(image_scores) > max_per_image:
+            image_thresh = image_scores[topk(image_scores, max_per_image)[-1]]
+            for j in range(1, num_classes):
+                keep = np.where(im_boxes[j][:, -1] >= image_thresh)[0]
+                im_boxes[j] = im_boxes[j][keep, :]
+    return im_boxes, time.time() - t
+
+
+def _prefetch(data_iter, depth):
+    """
+    iterate data_iter in a thread, at most depth batches ahead
+    :param data_iter: iterator
+    :param depth: queue size, 0 to iterate in the calling thread
+    :return: generator of the batches of data_iter
+    """
+    if depth <= 0:
+        for batch in data_iter:
+            yield batch
+        return
+    queue = Queue.Queue(maxsize=depth)
+    end = object()
+
+    def worker():
+        try:
+            for batch in data_iter:
+                queue.put((batch, None))
+        except Exception as e:
+            queue.put((end, e))
+            return
+        queue.put((end, None))
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    while True:
+        batch, error = queue.get()
+        if error is not None:
+            raise error
+        if batch is end:
+            break
+        yield batch
+    thread.join()
+
+
 def vis_all_detection(im_array, detections, class_names, scale):
     """
     visualize all detections in one image
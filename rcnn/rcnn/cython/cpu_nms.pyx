@@ -7,11 +7,14 @@
 
 import numpy as np
 cimport numpy as np
+cimport cython
+cimport openmp
+from cython.parallel cimport prange
 
-cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
     return a if a >= b else b
 
-cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
     return a if a <= b else b
 
 def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
@@ -66,3 +69,84 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _nms_group(np.float32_t[:, ::1] dets, np.float32_t[::1] areas, np.intp_t[::1] order,
+                    Py_ssize_t start, Py_ssize_t end, np.float32_t thresh,
+                    np.uint8_t[::1] suppressed) nogil:
+    # cpu_nms of the boxes order[start:end], sorted by score
+    cdef Py_ssize_t _i, _j, i, j
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+    for _i in range(start, end):
+        if suppressed[_i] == 1:
+            continue
+        i = order[_i]
+        ix1 = dets[i, 0]
+        iy1 = dets[i, 1]
+        ix2 = dets[i, 2]
+        iy2 = dets[i, 3]
+        iarea = areas[i]
+        for _j in range(_i + 1, end):
+            if suppressed[_j] == 1:
+                continue
+            j = order[_j]
+            xx1 = max(ix1, dets[j, 0])
+            yy1 = max(iy1, dets[j, 1])
+            xx2 = min(ix2, dets[j, 2])
+            yy2 = min(iy2, dets[j, 3])
+            w = max(0.0, xx2 - xx1 + 1)
+            h = max(0.0, yy2 - yy1 + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                suppressed[_j] = 1
+    return 0
+
+
+def cpu_nms_batch(dets_list, np.float thresh, int num_threads=0):
+    """
+    cpu_nms of independent groups of boxes, e.g. all classes of an image or
+    all images of a batch. Groups are processed in parallel without the GIL.
+    With distinct scores the kept indices of a group are those of cpu_nms;
+    boxes of equal score are visited in index order here, while cpu_nms
+    visits them in the order of argsort()[::-1], so ties may keep another box.
+    :param dets_list: list of [n, 5+] arrays (x1, y1, x2, y2, score)
+    :param thresh: boxes overlapping a kept box by thresh or more are suppressed
+    :param num_threads: number of OpenMP threads, 0 for the default
+    :return: list of kept indices of each group, from highest to lowest score
+    """
+    cdef Py_ssize_t num_groups = len(dets_list)
+    if num_groups == 0:
+        return []
+    counts = np.array([d.shape[0] for d in dets_list], dtype=np.intp)
+    all_dets = np.ascontiguousarray(np.vstack([d[:, :5] for d in dets_list]), dtype=np.float32)
+    # group by group, by descending score inside a group
+    group = np.repeat(np.arange(num_groups), counts)
+    order_arr = np.lexsort((-all_dets[:, 4], group)).astype(np.intp)
+    bounds_arr = np.hstack(([0], np.cumsum(counts))).astype(np.intp)
+    areas_arr = (all_dets[:, 2] - all_dets[:, 0] + 1) * (all_dets[:, 3] - all_dets[:, 1] + 1)
+    suppressed_arr = np.zeros(all_dets.shape[0], dtype=np.uint8)
+
+    cdef np.float32_t[:, ::1] dets = all_dets
+    cdef np.float32_t[::1] areas = areas_arr
+    cdef np.intp_t[::1] order = order_arr
+    cdef np.intp_t[::1] bounds = bounds_arr
+    cdef np.uint8_t[::1] suppressed = suppressed_arr
+    cdef np.float32_t th = thresh
+    cdef Py_ssize_t g
+    if num_threads <= 0:
+        num_threads = openmp.omp_get_max_threads()
+
+    for g in prange(num_groups, nogil=True, schedule='dynamic', num_threads=num_threads):
+        _nms_group(dets, areas, order, bounds[g], bounds[g + 1], th, suppressed)
+
+    keep = []
+    for g in range(num_groups):
+        start, end = bounds_arr[g], bounds_arr[g + 1]
+        keep.append(order_arr[start:end][suppressed_arr[start:end] == 0] - start)
+    return keep
@@ -126,7 +126,8 @@ ext_modules = [
     Extension(
         "cpu_nms",
         ["cpu_nms.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function", "-fopenmp"]},
+        extra_link_args=["-fopenmp"],
         include_dirs = [numpy_include]
     ),
 ]
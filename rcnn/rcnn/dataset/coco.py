@@ -5,6 +5,7 @@ import json
 import numpy as np
 
 from ..logger import logger
+from ..config import config
 from imdb import IMDB
 
 # coco api
@@ -185,7 +186,7 @@ class coco(IMDB):
         coco_dt = self.coco.loadRes(res_file)
         coco_eval = COCOeval(self.coco, coco_dt)
         coco_eval.params.useSegm = (ann_type == 'segm')
-        coco_eval.evaluate()
+        coco_eval.evaluate(numProcs=config.TEST.COCO_EVAL_PROCS)
         coco_eval.accumulate()
         self._print_detection_metrics(coco_eval)
 
@@ -13,7 +13,7 @@ import numpy as np
 
 from ..logger import logger
 from imdb import IMDB
-from pascal_voc_eval import voc_eval
+from pascal_voc_eval import load_voc_recs, voc_eval_all
 from ds_utils import unique_boxes, filter_small_boxes
 
 
@@ -46,7 +46,8 @@ class PascalVOC(IMDB):
 
         self.config = {'comp_id': 'comp4',
                        'use_diff': False,
-                       'min_size': 2}
+                       'min_size': 2,
+                       'eval_workers': 1}
 
     def load_image_set_index(self):
         """
@@ -201,7 +202,7 @@ class PascalVOC(IMDB):
             os.mkdir(res_file_folder)
 
         self.write_pascal_results(detections)
-        self.do_python_eval()
+        self.do_python_eval(detections)
 
     def get_result_file_template(self):
         """
@@ -237,24 +238,50 @@ class PascalVOC(IMDB):
                                 format(index, dets[k, -1],
                                        dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def do_python_eval(self):
+    def get_eval_detections(self, all_boxes):
         """
-        python evaluation wrapper
+        detections of each class as arrays, with the values of the results files
+        :param all_boxes: boxes to be processed [bbox, confidence]
+        :return: per class (image indices, scores, boxes), None for background
+        """
+        detections = []
+        for cls_ind, cls in enumerate(self.classes):
+            if cls == '__background__':
+                detections.append(None)
+                continue
+            dets = [all_boxes[cls_ind][im_ind] for im_ind in range(self.num_images)]
+            image_inds = np.repeat(np.arange(self.num_images), [len(d) for d in dets])
+            dets = [d for d in dets if len(d) > 0]
+            # results files keep 3 decimals of scores and 1 of 1-based coordinates
+            scores = [np.round(d[:, -1].astype(np.float64), 3) for d in dets]
+            boxes = [np.round((d[:, :4] + 1).astype(np.float64), 1) for d in dets]
+            detections.append((image_inds,
+                               np.concatenate(scores) if dets else np.zeros((0,)),
+                               np.vstack(boxes) if dets else np.zeros((0, 4))))
+        return detections
+
+    def do_python_eval(self, detections):
+        """
+        python evaluation wrapper, all classes are evaluated from memory
+        :param detections: result matrix, [bbox, confidence]
         :return: None
         """
         annopath = os.path.join(self.data_path, 'Annotations', '{0!s}.xml')
         imageset_file = os.path.join(self.data_path, 'ImageSets', 'Main', self.image_set + '.txt')
         annocache = os.path.join(self.cache_path, self.name + '_annotations.pkl')
+        image_filenames, recs = load_voc_recs(annopath, imageset_file, annocache)
+        assert image_filenames == self.image_set_index, 'image set changed since the imdb was loaded'
         aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if int(self.year) < 2010 else False
         logger.info('VOC07 metric? ' + ('Y' if use_07_metric else 'No'))
+        results = voc_eval_all(self.get_eval_detections(detections), image_filenames, recs, self.classes,
+                               ovthresh=0.5, use_07_metric=use_07_metric,
+                               num_workers=self.config['eval_workers'])
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
                 continue
-            filename = self.get_result_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename, annopath, imageset_file, cls, annocache,
-                                     ovthresh=0.5, use_07_metric=use_07_metric)
+            rec, prec, ap = results[cls_ind]
             aps += [ap]
             logger.info('AP for {} = {:.4f}'.format(cls, ap))
         logger.info('Mean AP = {:.4f}'.format(np.mean(aps)))
@@ -15,32 +15,59 @@ def get_image(roidb, is_test=False):
     |
     y (height, first dim of im)
     """
-    num_images = len(roidb)
     processed_ims = []
     processed_roidb = []
-    for i in range(num_images):
-        roi_rec = roidb[i]
-        assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'])
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
-        new_rec = roi_rec.copy()
-        if is_test:
-            scale_ind = 0
-        else:
-            scale_ind = random.randrange(len(config.SCALES))
-        target_size = config.SCALES[scale_ind][0]
-        max_size = config.SCALES[scale_ind][1]
-        im, im_scale = resize(im, target_size, max_size, stride=config.IMAGE_STRIDE)
-        im_tensor = transform(im, config.PIXEL_MEANS)
-        processed_ims.append(im_tensor)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
-        new_rec['boxes'] = roi_rec['boxes'].copy() * im_scale
-        new_rec['im_info'] = im_info
+    for roi_rec in roidb:
+        im, new_rec = load_image(roi_rec, is_test)
+        processed_ims.append(transform(im, config.PIXEL_MEANS))
         processed_roidb.append(new_rec)
     return processed_ims, processed_roidb
 
 
+def get_image_batch(roidb, is_test=False):
+    """
+    preprocess images and stack them into one batch, images stay uint8 until
+    they are written into their slot of the float32 batch
+    :param roidb: a list of roidb
+    :return: [num_images, channel, height, width] batch padded with zeros, processed roidb
+    """
+    ims = []
+    processed_roidb = []
+    for roi_rec in roidb:
+        im, new_rec = load_image(roi_rec, is_test)
+        ims.append(im)
+        processed_roidb.append(new_rec)
+    height = max([im.shape[0] for im in ims])
+    width = max([im.shape[1] for im in ims])
+    im_array = np.empty((len(ims), 3, height, width), dtype=np.float32)
+    for im, slot in zip(ims, im_array):
+        transform(im, config.PIXEL_MEANS, out=slot)
+    return im_array, processed_roidb
+
+
+def load_image(roi_rec, is_test=False):
+    """
+    read, flip and resize (and pad to config.IMAGE_STRIDE) an image
+    :param roi_rec: roidb entry
+    :return: [height, width, channel] uint8 image in BGR, roidb entry with im_info
+    """
+    assert os.path.exists(roi_rec['image']), '{} does not exist'.format(roi_rec['image'])
+    im = cv2.imread(roi_rec['image'])
+    if roi_rec['flipped']:
+        im = im[:, ::-1, :]
+    new_rec = roi_rec.copy()
+    if is_test:
+        scale_ind = 0
+    else:
+        scale_ind = random.randrange(len(config.SCALES))
+    target_size = config.SCALES[scale_ind][0]
+    max_size = config.SCALES[scale_ind][1]
+    im, im_scale = resize(im, target_size, max_size, stride=config.IMAGE_STRIDE)
+    new_rec['boxes'] = roi_rec['boxes'].copy() * im_scale
+    new_rec['im_info'] = [im.shape[0], im.shape[1], im_scale]
+    return im, new_rec
+
+
 def resize(im, target_size, max_size, stride=0):
     """
     only resize input image to target size and return scale
@@ -48,7 +75,7 @@ def resize(im, target_size, max_size, stride=0):
     :param target_size: one dimensional size (the short side)
     :param max_size: one dimensional max size (the long side)
     :param stride: if given, pad the image to designated stride
-    :return:
+    :return: resized image with the dtype of im
     """
     im_shape = im.shape
     im_size_min = np.min(im_shape[0:2])
@@ -66,23 +93,31 @@ def resize(im, target_size, max_size, stride=0):
         im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
         im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
         im_channel = im.shape[2]
-        padded_im = np.zeros((im_height, im_width, im_channel))
+        padded_im = np.zeros((im_height, im_width, im_channel), dtype=im.dtype)
         padded_im[:im.shape[0], :im.shape[1], :] = im
         return padded_im, im_scale
 
 
-def transform(im, pixel_means):
+def transform(im, pixel_means, out=None):
     """
     transform into mxnet tensor,
     subtract pixel size and transform to correct format
     :param im: [height, width, channel] in BGR
     :param pixel_means: [B, G, R pixel means]
-    :return: [batch, channel, height, width]
+    :param out: [channel, height, width] float32 slot of a batch to write into,
+    area outside of im is filled with zeros
+    :return: [batch, channel, height, width] float32
     """
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
+    if out is None:
+        out = np.empty((1, 3, im.shape[0], im.shape[1]), dtype=np.float32)
+    im_tensor = out.reshape(out.shape[-3:])
+    height, width = im.shape[:2]
     for i in range(3):
-        im_tensor[0, i, :, :] = im[:, :, 2 - i] - pixel_means[2 - i]
-    return im_tensor
+        np.subtract(im[:, :, 2 - i], pixel_means[2 - i], out=im_tensor[i, :height, :width],
+                    dtype=np.float32)
+    im_tensor[:, height:, :] = 0
+    im_tensor[:, :height, width:] = 0
+    return out
 
 
 def transform_inverse(im_tensor, pixel_means):
@@ -110,34 +145,22 @@ def tensor_vstack(tensor_list, pad=0):
     vertically stack tensors
     :param tensor_list: list of tensor to be stacked vertically
     :param pad: label to pad with
-    :return: tensor with max shape
+    :return: tensor with max shape, tensor_list[0] itself if there is only one
     """
+    if len(tensor_list) == 1:
+        return tensor_list[0]
     ndim = len(tensor_list[0].shape)
     dtype = tensor_list[0].dtype
-    islice = tensor_list[0].shape[0]
-    dimensions = []
-    first_dim = sum([tensor.shape[0] for tensor in tensor_list])
-    dimensions.append(first_dim)
+    dimensions = [sum([tensor.shape[0] for tensor in tensor_list])]
     for dim in range(1, ndim):
         dimensions.append(max([tensor.shape[dim] for tensor in tensor_list]))
-    if pad == 0:
-        all_tensor = np.zeros(tuple(dimensions), dtype=dtype)
-    elif pad == 1:
-        all_tensor = np.ones(tuple(dimensions), dtype=dtype)
-    else:
-        all_tensor = np.full(tuple(dimensions), pad, dtype=dtype)
-    if ndim == 1:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind*islice:(ind+1)*islice] = tensor
-    elif ndim == 2:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind*islice:(ind+1)*islice, :tensor.shape[1]] = tensor
-    elif ndim == 3:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind*islice:(ind+1)*islice, :tensor.shape[1], :tensor.shape[2]] = tensor
-    elif ndim == 4:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind*islice:(ind+1)*islice, :tensor.shape[1], :tensor.shape[2], :tensor.shape[3]] = tensor
-    else:
-        raise Exception('Sorry, unimplemented.')
+    if all([tensor.shape[1:] == tuple(dimensions[1:]) for tensor in tensor_list]):
+        # nothing to pad
+        return np.concatenate(tensor_list, axis=0).astype(dtype, copy=False)
+    all_tensor = np.full(tuple(dimensions), pad, dtype=dtype)
+    start = 0
+    for tensor in tensor_list:
+        end = start + tensor.shape[0]
+        all_tensor[(slice(start, end),) + tuple(slice(0, d) for d in tensor.shape[1:])] = tensor
+        start = end
     return all_tensor
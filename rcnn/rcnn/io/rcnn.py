@@ -16,7 +16,7 @@ import numpy as np
 import numpy.random as npr
 
 from ..config import config
-from ..io.image import get_image, tensor_vstack
+from ..io.image import get_image, get_image_batch
 from ..processing.bbox_transform import bbox_overlaps, bbox_transform
 from ..processing.bbox_regression import expand_bbox_regression_targets
 
@@ -52,8 +52,7 @@ def get_rcnn_batch(roidb):
     :return: data, label
     """
     num_images = len(roidb)
-    imgs, roidb = get_image(roidb)
-    im_array = tensor_vstack(imgs)
+    im_array, roidb = get_image_batch(roidb)
 
     assert config.TRAIN.BATCH_ROIS % config.TRAIN.BATCH_IMAGES == 0, \
         'BATCHIMAGES {} must divide BATCH_ROIS {}'.format(config.TRAIN.BATCH_IMAGES, config.TRAIN.BATCH_ROIS)
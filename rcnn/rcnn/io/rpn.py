@@ -16,21 +16,20 @@ import numpy.random as npr
 
 from ..logger import logger
 from ..config import config
-from .image import get_image, tensor_vstack
+from .image import get_image, get_image_batch, tensor_vstack
 from ..processing.generate_anchor import generate_anchors
+from ..processing.anchor_grid import get_anchor_grid
 from ..processing.bbox_transform import bbox_overlaps, bbox_transform
 
 
 def get_rpn_testbatch(roidb):
     """
     return a dict of testbatch
-    :param roidb: ['image', 'flipped']
+    :param roidb: ['image', 'flipped'], images are padded to the same size
     :return: data, label, im_info
     """
-    assert len(roidb) == 1, 'Single batch only'
-    imgs, roidb = get_image(roidb, True)
-    im_array = imgs[0]
-    im_info = np.array([roidb[0]['im_info']], dtype=np.float32)
+    im_array, roidb = get_image_batch(roidb, True)
+    im_info = np.array([roi_rec['im_info'] for roi_rec in roidb], dtype=np.float32)
 
     data = {'data': im_array,
             'im_info': im_info}
@@ -96,10 +95,11 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
         return ret
 
     im_info = im_info[0]
-    scales = np.array(scales, dtype=np.float32)
-    base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
-    num_anchors = base_anchors.shape[0]
     feat_height, feat_width = feat_shape[-2:]
+    # 1. shifted anchors of the feature map, cached per shape
+    grid = get_anchor_grid(feat_stride, scales, ratios, feat_height, feat_width)
+    base_anchors = grid.base_anchors
+    num_anchors = grid.num_anchors
 
     logger.debug('anchors: %s' % base_anchors)
     logger.debug('anchor shapes: %s' % np.hstack((base_anchors[:, 2::4] - base_anchors[:, 0::4],
@@ -109,26 +109,12 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
     logger.debug('gt_boxes shape %s' % np.array(gt_boxes.shape))
     logger.debug('gt_boxes %s' % gt_boxes)
 
-    # 1. generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, feat_width) * feat_stride
-    shift_y = np.arange(0, feat_height) * feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
     A = num_anchors
-    K = shifts.shape[0]
-    all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    all_anchors = all_anchors.reshape((K * A, 4))
-    total_anchors = int(K * A)
+    all_anchors = grid.anchors
+    total_anchors = all_anchors.shape[0]
 
     # only keep anchors inside the image
-    inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
-                           (all_anchors[:, 1] >= -allowed_border) &
-                           (all_anchors[:, 2] < im_info[1] + allowed_border) &
-                           (all_anchors[:, 3] < im_info[0] + allowed_border))[0]
+    inds_inside = grid.inside(im_info[0], im_info[1], allowed_border)
     logger.debug('total_anchors %d' % total_anchors)
     logger.debug('inds_inside %d' % len(inds_inside))
 
@@ -141,14 +127,18 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
     labels.fill(-1)
 
     if gt_boxes.size > 0:
-        # overlap between the anchors and the gt boxes
-        # overlaps (ex, gt)
-        overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+        if config.TRAIN.RPN_ASSIGN_MODE == 'sparse':
+            argmax_overlaps, max_overlaps, gt_argmax_overlaps = \
+                _sparse_max_overlaps(grid, inds_inside, gt_boxes)
+        else:
+            # overlap between the anchors and the gt boxes
+            # overlaps (ex, gt)
+            overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
+            argmax_overlaps = overlaps.argmax(axis=1)
+            max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
+            gt_argmax_overlaps = overlaps.argmax(axis=0)
+            gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
+            gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
 
         if not config.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels first so that positive labels can clobber them
@@ -227,6 +217,51 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
     return label
 
 
+def _sparse_max_overlaps(grid, inds_inside, gt_boxes):
+    """
+    the dense overlap reductions of assign_anchor, from the anchor gt pairs
+    with a positive overlap only. Results are identical to the dense ones,
+    ties go to the first gt and anchors without overlap to gt 0 like argmax
+    :param grid: AnchorGrid
+    :param inds_inside: indices of the anchors inside the image
+    :param gt_boxes: [n, 5] gt boxes
+    :return: argmax_overlaps, max_overlaps, gt_argmax_overlaps
+    """
+    num_inside = len(inds_inside)
+    num_gt = gt_boxes.shape[0]
+    pos, gt_inds, ious = grid.overlap_pairs(inds_inside, gt_boxes)
+
+    # per anchor: max overlap, first gt reaching it. Pairs are ordered by gt and
+    # an anchor appears once per gt, so gt by gt updates need no sort
+    argmax_overlaps = np.zeros((num_inside,), dtype=np.int64)
+    max_overlaps = np.zeros((num_inside,), dtype=np.float64)
+    bounds = np.searchsorted(gt_inds, np.arange(num_gt + 1))
+    for g in range(num_gt):
+        gt_pos = pos[bounds[g]:bounds[g + 1]]
+        gt_ious = ious[bounds[g]:bounds[g + 1]]
+        better = gt_ious > max_overlaps[gt_pos]
+        max_overlaps[gt_pos[better]] = gt_ious[better]
+        argmax_overlaps[gt_pos[better]] = g
+
+    # per gt: anchors reaching its max overlap
+    gt_max_overlaps = _gt_max_overlaps(gt_inds, ious, num_gt)
+    if np.any(gt_max_overlaps == 0):
+        # a gt without overlap has all anchors at its max overlap of 0
+        gt_argmax_overlaps = np.arange(num_inside)
+    else:
+        gt_argmax_overlaps = np.unique(pos[ious == gt_max_overlaps[gt_inds]])
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps
+
+
+def _gt_max_overlaps(gt_inds, ious, num_gt):
+    """ max overlap of each gt from pairs ordered by gt, 0 for gts without pairs """
+    gt_max_overlaps = np.zeros((num_gt,), dtype=np.float64)
+    if ious.size > 0:
+        starts = np.r_[0, np.where(gt_inds[1:] != gt_inds[:-1])[0] + 1]
+        gt_max_overlaps[gt_inds[starts]] = np.maximum.reduceat(ious, starts)
+    return gt_max_overlaps
+
+
 def assign_anchor_multiscale(feat_shape_list, gt_boxes, im_info, feat_stride_list=[16, 32, 64, 128],
                   scales=(3,), ratios=(0.5, 1, 2), allowed_border=0):
     """
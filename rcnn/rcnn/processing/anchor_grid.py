@@ -0,0 +1,171 @@
+"""
+Cache of shifted anchor grids, shared by anchor assignment and proposal.
+With aspect grouping only a few feature map shapes occur, so grids are
+computed once per (feat_stride, scales, ratios, feat_height, feat_width).
+"""
+
+import collections
+import numpy as np
+
+from .generate_anchor import generate_anchors
+
+_MAX_GRIDS = 64
+_MAX_INSIDE = 64
+_grids = collections.OrderedDict()
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+class AnchorGrid(object):
+    """
+    all shifted anchors of a feature map, arrays are read-only
+    :param feat_stride: anchor position step
+    :param scales: anchor scales
+    :param ratios: anchor aspect ratios
+    :param feat_height: feature map height
+    :param feat_width: feature map width
+    """
+    def __init__(self, feat_stride, scales, ratios, feat_height, feat_width):
+        self.base_anchors = _read_only(generate_anchors(base_size=feat_stride, ratios=list(ratios),
+                                                        scales=np.array(scales)))
+        self.num_anchors = self.base_anchors.shape[0]
+        self.feat_stride = feat_stride
+        self.feat_height = feat_height
+        self.feat_width = feat_width
+
+        shift_x = np.arange(0, feat_width) * feat_stride
+        shift_y = np.arange(0, feat_height) * feat_stride
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+        # add A anchors (1, A, 4) to
+        # cell K shifts (K, 1, 4) to get
+        # shift anchors (K, A, 4)
+        # reshape to (K*A, 4) shifted anchors
+        A = self.num_anchors
+        K = shifts.shape[0]
+        anchors = self.base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+        self.anchors = _read_only(anchors.reshape((K * A, 4)))
+        self.areas = _read_only((self.anchors[:, 2] - self.anchors[:, 0] + 1) *
+                                (self.anchors[:, 3] - self.anchors[:, 1] + 1))
+        self._inside = collections.OrderedDict()
+
+    def inside(self, im_height, im_width, allowed_border=0):
+        """
+        indices of the anchors inside the image
+        :param im_height: image height
+        :param im_width: image width
+        :param allowed_border: anchors may cross the image border by allowed_border
+        :return: read-only array of anchor indices
+        """
+        key = (float(im_height), float(im_width), allowed_border)
+        inds_inside = self._inside.pop(key, None)
+        if inds_inside is None:
+            anchors = self.anchors
+            inds_inside = _read_only(np.where((anchors[:, 0] >= -allowed_border) &
+                                              (anchors[:, 1] >= -allowed_border) &
+                                              (anchors[:, 2] < im_width + allowed_border) &
+                                              (anchors[:, 3] < im_height + allowed_border))[0])
+            if len(self._inside) >= _MAX_INSIDE:
+                self._inside.popitem(last=False)
+        self._inside[key] = inds_inside
+        return inds_inside
+
+    def overlap_pairs(self, inds_inside, boxes):
+        """
+        all (anchor, box) pairs with a positive overlap, without computing the
+        dense overlap matrix. The intersection width of an anchor and a box only
+        depends on the base anchor and the cell column, the height on the cell
+        row, so both are tabulated for the columns and rows near each box and
+        only the cells where both are positive are enumerated.
+        Overlaps are computed like bbox_overlaps.
+        :param inds_inside: indices of the anchors considered, as returned by inside
+        :param boxes: [n, 4+] boxes
+        :return: positions in inds_inside, box indices (ascending), overlaps
+        """
+        A = self.num_anchors
+        boxes = boxes[:, :4].astype(np.float64)
+        num_pairs = boxes.shape[0] * A
+        # bounding cells of the considered anchors of each base anchor
+        mask = np.zeros((self.anchors.shape[0],), dtype=np.bool_)
+        mask[inds_inside] = True
+        mask = mask.reshape((self.feat_height, self.feat_width, A))
+        bound = np.zeros((4, A), dtype=np.int64)
+        for k, (used, size) in enumerate(((mask.any(axis=0), self.feat_width),
+                                          (mask.any(axis=1), self.feat_height))):
+            bound[k] = np.where(used.any(axis=0), used.argmax(axis=0), np.iinfo(np.int64).max)
+            bound[k + 2] = np.where(used.any(axis=0), size - 1 - used[::-1].argmax(axis=0), -1)
+
+        # intersection widths and heights per (box, base anchor) pair
+        iw, w_first, w_start, num_w = self._intersect_1d(boxes[:, 0], boxes[:, 2], self.base_anchors[:, 0],
+                                                         self.base_anchors[:, 2], bound[0], bound[2])
+        ih, h_first, h_start, num_h = self._intersect_1d(boxes[:, 1], boxes[:, 3], self.base_anchors[:, 1],
+                                                         self.base_anchors[:, 3], bound[1], bound[3])
+
+        # enumerate the cells of every pair where both are positive
+        counts = num_w * num_h
+        ends = np.cumsum(counts)
+        pair = np.repeat(np.arange(num_pairs), counts)
+        offset = np.arange(ends[-1] if ends.size else 0) - np.repeat(ends - counts, counts)
+        dh, dw = np.divmod(offset, num_w[pair])
+        first_anchor = (h_first * self.feat_width + w_first) * A + np.arange(num_pairs) % A
+        anchor_inds = first_anchor[pair] + (dh * self.feat_width + dw) * A
+        inter = iw[w_start[pair] + dw] * ih[h_start[pair] + dh]
+
+        inside_pos = np.empty((self.anchors.shape[0],), dtype=np.int64)
+        inside_pos.fill(-1)
+        inside_pos[inds_inside] = np.arange(len(inds_inside))
+        pos = inside_pos[anchor_inds]
+        box_inds = pair // A
+        if np.any(pos < 0):
+            keep = pos >= 0
+            pos, box_inds, anchor_inds, inter = pos[keep], box_inds[keep], anchor_inds[keep], inter[keep]
+        box_areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+        ua = self.areas[anchor_inds] + box_areas[box_inds] - inter
+        return pos, box_inds, inter / ua
+
+    def _intersect_1d(self, lo, hi, base_lo, base_hi, cell_lo, cell_hi):
+        """
+        positive intersection lengths of boxes [lo, hi] and the base anchors
+        shifted to cells cell_lo to cell_hi along one axis
+        :return: lengths, first cell, start in lengths and number of cells per (box, base anchor)
+        """
+        stride = float(self.feat_stride)
+        A = self.num_anchors
+        # superset of the cells intersecting the box
+        first = np.maximum(np.floor((lo[:, np.newaxis] - 1 - base_hi) / stride).astype(np.int64), cell_lo)
+        last = np.minimum(np.ceil((hi[:, np.newaxis] + 1 - base_lo) / stride).astype(np.int64), cell_hi)
+        first = first.ravel()
+        num = np.maximum(last.ravel() - first + 1, 0)
+        ends = np.cumsum(num)
+        pair = np.repeat(np.arange(num.size), num)
+        cell = first[pair] + np.arange(ends[-1] if ends.size else 0) - np.repeat(ends - num, num)
+        shift = cell * stride
+        length = np.minimum(base_hi[pair % A] + shift, hi[pair // A]) - \
+            np.maximum(base_lo[pair % A] + shift, lo[pair // A]) + 1
+        # positive lengths are contiguous in cells, keep those only
+        keep = length > 0
+        pair, cell, length = pair[keep], cell[keep], length[keep]
+        num = np.bincount(pair, minlength=first.size)
+        start = np.cumsum(num) - num
+        first = np.zeros_like(first)
+        first[num > 0] = cell[start[num > 0]]
+        return length, first, start, num
+
+
+def get_anchor_grid(feat_stride, scales, ratios, feat_height, feat_width):
+    """
+    cached AnchorGrid, the least recently used grids are dropped
+    :return: AnchorGrid
+    """
+    key = (int(feat_stride), tuple(float(s) for s in scales), tuple(float(r) for r in ratios),
+           int(feat_height), int(feat_width))
+    grid = _grids.pop(key, None)
+    if grid is None:
+        grid = AnchorGrid(*key)
+        if len(_grids) >= _MAX_GRIDS:
+            _grids.popitem(last=False)
+    _grids[key] = grid
+    return grid
@@ -1,5 +1,5 @@
 import numpy as np
-from ..cython.cpu_nms import cpu_nms
+from ..cython.cpu_nms import cpu_nms, cpu_nms_batch
 try:
     from ..cython.gpu_nms import gpu_nms
 except ImportError:
@@ -18,6 +18,21 @@ def cpu_nms_wrapper(thresh):
     return _nms
 
 
+def cpu_nms_batch_wrapper(thresh, num_threads=0):
+    def _nms(dets_list):
+        return cpu_nms_batch(dets_list, thresh, num_threads)
+    return _nms
+
+
+def gpu_nms_batch_wrapper(thresh, device_id):
+    def _nms(dets_list):
+        return [gpu_nms(dets, thresh, device_id) for dets in dets_list]
+    if gpu_nms is not None:
+        return _nms
+    else:
+        return cpu_nms_batch_wrapper(thresh)
+
+
 def gpu_nms_wrapper(thresh, device_id):
     def _nms(dets):
         return gpu_nms(dets, thresh, device_id)
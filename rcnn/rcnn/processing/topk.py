@@ -0,0 +1,27 @@
+"""
+Partial top-k selection. Only the k largest scores are sorted, which is
+much cheaper than a full argsort when k is small compared to the number of
+scores, e.g. when cutting RPN scores to rpn_pre_nms_top_n.
+"""
+
+import numpy as np
+
+
+def topk(scores, k):
+    """
+    indices of the k largest scores, from highest to lowest score.
+    Equal scores are ordered by index.
+    :param scores: [n] scores
+    :param k: number of indices, all scores are sorted if k <= 0 or k >= n
+    :return: [min(k, n)] indices
+    """
+    scores = np.asarray(scores).ravel()
+    if k <= 0 or k >= scores.size:
+        return np.argsort(-scores, kind='mergesort')
+    # k-th largest score, everything above it and enough of the equal ones
+    kth = -np.partition(-scores, k - 1)[k - 1]
+    above = np.where(scores > kth)[0]
+    equal = np.where(scores == kth)[0][:k - above.size]
+    inds = np.hstack((above, equal))
+    inds.sort()
+    return inds[np.argsort(-scores[inds], kind='mergesort')]
@@ -6,6 +6,13 @@ import time
 from collections import defaultdict
 import mask as maskUtils
 import copy
+import multiprocessing
+
+# evaluator shared with the worker processes of COCOeval.evaluate
+_shardEval = None
+
+def _evaluateShard(imgIds):
+    return _shardEval.evaluateImgIds(imgIds)
 
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
@@ -15,6 +22,7 @@ class COCOeval:
     #  E = CocoEval(cocoGt,cocoDt); # initialize CocoEval object
     #  E.params.recThrs = ...;      # set parameters as desired
     #  E.evaluate();                # run per image evaluation
+    #  E.evaluate(numProcs=8);      # or shard the images over 8 processes
     #  E.accumulate();              # accumulate per image results
     #  E.summarize();               # display summary metrics of results
     # For example usage see evalDemo.m and http://mscoco.org/.
@@ -51,6 +59,12 @@ class COCOeval:
     #  recall     - [TxKxAxM] max recall for every evaluation setting
     # Note: precision and recall==-1 for settings with no gt objects.
     #
+    # evaluateShard() / mergeShards(): evaluate a subset of the images, e.g. on
+    # another machine, and combine the pickled shards into "evalImgs" before
+    # accumulate():
+    #  S = E.evaluateShard(E.params.imgIds[i::n])  # on each machine i of n
+    #  E.mergeShards([S0, S1, ...]); E.accumulate(); E.summarize()
+    #
     # See also coco, mask, pycocoDemo, pycocoEvalDemo
     #
     # Microsoft COCO Toolbox.      version 2.0
@@ -82,9 +96,10 @@ class COCOeval:
             self.params.catIds = sorted(cocoGt.getCatIds())
 
 
-    def _prepare(self):
+    def _prepare(self, imgIds=None):
         '''
         Prepare ._gts and ._dts for evaluation based on params
+        :param imgIds: images to prepare, all of params.imgIds if None
         :return: None
         '''
         def _toMask(anns, coco):
@@ -93,12 +108,14 @@ class COCOeval:
                 rle = coco.annToRLE(ann)
                 ann['segmentation'] = rle
         p = self.params
+        if imgIds is None:
+            imgIds = p.imgIds
         if p.useCats:
-            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=imgIds, catIds=p.catIds))
+            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=imgIds, catIds=p.catIds))
         else:
-            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=imgIds))
+            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=imgIds))
 
         # convert ground truth to mask if iouType == 'segm'
         if p.iouType == 'segm':
@@ -119,26 +136,65 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
-    def evaluate(self):
+    def _prepareParams(self):
         '''
-        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        Check and normalize params for evaluation
         :return: None
         '''
-        tic = time.time()
-        print('Running per image evaluation...')
         p = self.params
         # add backward compatibility if useSegm is specified in params
         if not p.useSegm is None:
             p.iouType = 'segm' if p.useSegm == 1 else 'bbox'
             print('useSegm (deprecated) is not None. Running {} evaluation'.format(p.iouType))
-        print('Evaluate annotation type *{}*'.format(p.iouType))
         p.imgIds = list(np.unique(p.imgIds))
         if p.useCats:
             p.catIds = list(np.unique(p.catIds))
         p.maxDets = sorted(p.maxDets)
         self.params=p
 
+    def evaluate(self, numProcs=1):
+        '''
+        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param numProcs: number of processes the images are sharded over,
+                         self.ious is not kept if more than 1
+        :return: None
+        '''
+        global _shardEval
+        tic = time.time()
+        print('Running per image evaluation...')
+        self._prepareParams()
+        p = self.params
+        print('Evaluate annotation type *{}*'.format(p.iouType))
         self._prepare()
+        if numProcs > 1 and len(p.imgIds) > 1:
+            # workers are forked with the prepared gts and dts, interleaved
+            # shards balance images with many annotations
+            numShards = min(numProcs * 4, len(p.imgIds))
+            _shardEval = self
+            pool = multiprocessing.Pool(numProcs)
+            try:
+                evalImgs = pool.map(_evaluateShard, [p.imgIds[i::numShards] for i in range(numShards)])
+            finally:
+                pool.close()
+                pool.join()
+                _shardEval = None
+            self.ious = {}
+            self._mergeShards([{'imgIds': p.imgIds[i::numShards], 'evalImgs': e}
+                              for i, e in enumerate(evalImgs)])
+        else:
+            self.evalImgs = self.evaluateImgIds(p.imgIds, keepIous=True)
+            self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def evaluateImgIds(self, imgIds, keepIous=False):
+        '''
+        Run per image evaluation on prepared images
+        :param imgIds: images to evaluate
+        :param keepIous: store ious in self.ious instead of dropping them
+        :return: list of per image results ordered by category, area range, image
+        '''
+        p = self.params
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
@@ -147,19 +203,76 @@ class COCOeval:
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
         self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
+                        for imgId in imgIds
                         for catId in catIds}
 
         evaluateImg = self.evaluateImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
+        evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
                  for catId in catIds
                  for areaRng in p.areaRng
-                 for imgId in p.imgIds
+                 for imgId in imgIds
              ]
+        if not keepIous:
+            self.ious = {}
+        return evalImgs
+
+    def evaluateShard(self, imgIds):
+        '''
+        Run per image evaluation on a subset of the images, the shards of all
+        images are combined by mergeShards
+        :param imgIds: images of the shard
+        :return: dict shard with fields imgIds, catIds, areaRng, maxDet, evalImgs
+        '''
+        self._prepareParams()
+        p = self.params
+        imgIds = list(np.unique(imgIds))
+        self._prepare(imgIds)
+        return {
+                'imgIds':   imgIds,
+                'catIds':   p.catIds if p.useCats else [-1],
+                'areaRng':  p.areaRng,
+                'maxDet':   p.maxDets[-1],
+                'evalImgs': self.evaluateImgIds(imgIds),
+            }
+
+    def mergeShards(self, shards):
+        '''
+        Combine shards of per image results into self.evalImgs, in the layout
+        of evaluate() so accumulate() is unchanged. Together the shards must
+        cover params.imgIds, each image once.
+        :param shards: list of dict with fields imgIds and evalImgs
+        :return: None
+        '''
+        self._prepareParams()
+        self._mergeShards(shards)
+
+    def _mergeShards(self, shards):
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        found = {}
+        for shard in shards:
+            for key, value in (('catIds', catIds), ('areaRng', p.areaRng), ('maxDet', p.maxDets[-1])):
+                if key in shard and shard[key] != value:
+                    raise Exception('shard {} does not match params'.format(key))
+            I = len(shard['imgIds'])
+            for i, imgId in enumerate(shard['imgIds']):
+                if imgId in found:
+                    raise Exception('image {} is in more than one shard'.format(imgId))
+                found[imgId] = (shard, I, i)
+        missing = [imgId for imgId in p.imgIds if imgId not in found]
+        if missing:
+            raise Exception('{} images are missing from the shards, e.g. {}'.format(len(missing), missing[0]))
+        A = len(p.areaRng)
+        evalImgs = []
+        for k in range(len(catIds)):
+            for a in range(A):
+                for imgId in p.imgIds:
+                    shard, I, i = found[imgId]
+                    evalImgs.append(shard['evalImgs'][(k * A + a) * I + i])
+        self.evalImgs = evalImgs
+        self.eval     = {}
         self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc-tic))
 
     def computeIoU(self, imgId, catId):
         p = self.params
@@ -271,30 +384,9 @@ class COCOeval:
         gtIg = np.array([g['_ignore'] for g in gt])
         dtIg = np.zeros((T,D))
         if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
+            dtIds = np.array([d['id'] for d in dt])
+            gtIds = np.array([g['id'] for g in gt])
+            self.matchDets(ious[:D], p.iouThrs, dtIds, gtIds, gtIg, np.array(iscrowd, dtype=bool), gtm, dtm, dtIg)
         # set unmatched detections outside of area range to ignore
         a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
         dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
@@ -313,6 +405,51 @@ class COCOeval:
                 'dtIgnore':     dtIg,
             }
 
+    def matchDets(self, ious, iouThrs, dtIds, gtIds, gtIg, iscrowd, gtm, dtm, dtIg):
+        '''
+        greedy matching of detections to gts at all IoU thresholds at once,
+        same matches as the loop over thresholds, detections and gts that
+        evaluateImg used (see rcnn/tools/benchmark_coco_match.py). Detections
+        are matched in score order, for each threshold a detection takes the
+        best unmatched (or crowd) gt with iou >= threshold, regular gts before
+        ignored ones and the last gt on ties. The gts are ranked once per detection, so each detection is
+        one pass over a [TxG] array; detections below all thresholds are skipped.
+        :param ious: [DxG] ious, dt sorted by score, gt sorted ignore last
+        :param iouThrs: [T] IoU thresholds
+        :param dtIds: [D] detection ids
+        :param gtIds: [G] gt ids
+        :param gtIg: [G] gt ignore flags
+        :param iscrowd: [G] bool crowd flags
+        :param gtm: [TxG] gt matches, filled in place
+        :param dtm: [TxD] detection matches, filled in place
+        :param dtIg: [TxD] detection ignore flags, filled in place
+        :return: None
+        '''
+        D, G = ious.shape[0], len(gtIds)
+        if D == 0 or G == 0:
+            return
+        T = len(iouThrs)
+        thrs = np.minimum(iouThrs, 1-1e-10)
+        # gts in order of preference for each detection: regular gts first,
+        # then higher iou, then the last gt on ties as the loop takes them
+        order = np.lexsort((np.tile(-np.arange(G), (D, 1)), -ious, np.tile(gtIg != 0, (D, 1))))
+        reach = ious[np.arange(D)[:, np.newaxis], order][:, np.newaxis, :] >= thrs[:, np.newaxis]
+        # gts that can still be matched at each threshold
+        avail = np.logical_not((gtm > 0) & np.logical_not(iscrowd))
+        tind = np.arange(T)
+        for dind in np.where(reach.reshape((D, -1)).any(axis=1))[0]:
+            od = order[dind]
+            ok = reach[dind] & avail[:, od]
+            first = ok.argmax(axis=1)
+            tinds = np.where(ok[tind, first])[0]
+            if len(tinds) == 0:
+                continue
+            m = od[first[tinds]]
+            dtIg[tinds, dind] = gtIg[m]
+            dtm[tinds, dind]  = gtIds[m]
+            gtm[tinds, m]     = dtIds[dind]
+            avail[tinds, m]   = iscrowd[m]
+
     def accumulate(self, p = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
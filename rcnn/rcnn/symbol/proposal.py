@@ -11,7 +11,9 @@ from distutils.util import strtobool
 from rcnn.logger import logger
 from rcnn.processing.bbox_transform import bbox_pred, clip_boxes
 from rcnn.processing.generate_anchor import generate_anchors
-from rcnn.processing.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from rcnn.processing.anchor_grid import get_anchor_grid
+from rcnn.processing.topk import topk
+from rcnn.processing.nms import gpu_nms_batch_wrapper
 
 
 class ProposalOperator(mx.operator.CustomOp):
@@ -33,12 +35,52 @@ class ProposalOperator(mx.operator.CustomOp):
         logger.debug('anchors:\n%s' % self._anchors)
 
     def forward(self, is_train, req, in_data, out_data, aux):
-        nms = gpu_nms_wrapper(self._threshold, in_data[0].context.device_id)
+        nms = gpu_nms_batch_wrapper(self._threshold, in_data[0].context.device_id)
+        post_nms_topN = self._rpn_post_nms_top_n
+
+        # the first set of anchors are background probabilities
+        # keep the second part
+        scores = in_data[0].asnumpy()[:, self._num_anchors:, :, :]
+        bbox_deltas = in_data[1].asnumpy()
+        im_info = in_data[2].asnumpy()
 
-        batch_size = in_data[0].shape[0]
-        if batch_size > 1:
-            raise ValueError("Sorry, multiple images each device is not implemented")
+        # 1. - 5. proposal candidates of each image
+        candidates = [self._propose(scores[i:i + 1], bbox_deltas[i:i + 1], im_info[i, :])
+                      for i in range(scores.shape[0])]
 
+        # 6. apply nms (e.g. threshold = 0.7) to all images at once
+        # 7. take after_nms_topN (e.g. 300)
+        # 8. return the top proposals (-> RoIs top)
+        keeps = nms([np.hstack((proposals, im_scores)).astype(np.float32)
+                     for proposals, im_scores in candidates])
+
+        # proposals of each image, stacked with the image index in the batch
+        blobs = []
+        all_scores = []
+        for i, ((proposals, im_scores), keep) in enumerate(zip(candidates, keeps)):
+            if post_nms_topN > 0:
+                keep = keep[:post_nms_topN]
+            # pad to ensure output size remains unchanged
+            if len(keep) < post_nms_topN:
+                pad = npr.choice(keep, size=post_nms_topN - len(keep))
+                keep = np.hstack((keep, pad))
+            batch_inds = np.empty((len(keep), 1), dtype=np.float32)
+            batch_inds.fill(i)
+            blobs.append(np.hstack((batch_inds, proposals[keep, :].astype(np.float32, copy=False))))
+            all_scores.append(im_scores[keep].astype(np.float32, copy=False))
+        self.assign(out_data[0], req[0], np.vstack(blobs))
+
+        if self._output_score:
+            self.assign(out_data[1], req[1], np.vstack(all_scores))
+
+    def _propose(self, scores, bbox_deltas, im_info):
+        """
+        proposal candidates of a single image, before nms
+        :param scores: [1, A, H, W] foreground probabilities
+        :param bbox_deltas: [1, 4 * A, H, W]
+        :param im_info: [3] image height, width and scale
+        :return: [n, 4] proposals, [n, 1] scores sorted by score
+        """
         # for each (H, W) location i
         #   generate A anchor boxes centered on cell i
         #   apply predicted bbox deltas at cell i to each of the A anchors
@@ -51,15 +93,8 @@ class ProposalOperator(mx.operator.CustomOp):
         # return the top proposals (-> RoIs top, scores top)
 
         pre_nms_topN = self._rpn_pre_nms_top_n
-        post_nms_topN = self._rpn_post_nms_top_n
         min_size = self._rpn_min_size
 
-        # the first set of anchors are background probabilities
-        # keep the second part
-        scores = in_data[0].asnumpy()[:, self._num_anchors:, :, :]
-        bbox_deltas = in_data[1].asnumpy()
-        im_info = in_data[2].asnumpy()[0, :]
-
         logger.debug('im_info: %s' % im_info)
 
         # 1. Generate proposals from bbox_deltas and shifted anchors
@@ -69,22 +104,8 @@ class ProposalOperator(mx.operator.CustomOp):
         logger.debug('score map size: (%d, %d)' % (scores.shape[2], scores.shape[3]))
         logger.debug('resudial: (%d, %d)' % (scores.shape[2] - height, scores.shape[3] - width))
 
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
+        # Enumerate all shifted anchors, (K*A, 4) rows ordered by (h, w, a)
+        anchors = get_anchor_grid(self._feat_stride, self._scales, self._ratios, height, width).anchors
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
@@ -118,35 +139,8 @@ class ProposalOperator(mx.operator.CustomOp):
 
         # 4. sort all (proposal, score) pairs by score from highest to lowest
         # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        det = np.hstack((proposals, scores)).astype(np.float32)
-        keep = nms(det)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
-        # pad to ensure output size remains unchanged
-        if len(keep) < post_nms_topN:
-            pad = npr.choice(keep, size=post_nms_topN - len(keep))
-            keep = np.hstack((keep, pad))
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # Output rois array
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        self.assign(out_data[0], req[0], blob)
-
-        if self._output_score:
-            self.assign(out_data[1], req[1], scores.astype(np.float32, copy=False))
+        order = topk(scores.ravel(), pre_nms_topN)
+        return proposals[order, :], scores[order]
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         self.assign(in_grad[0], req[0], 0)
@@ -208,8 +202,9 @@ class ProposalProp(mx.operator.CustomOpProp):
 
         batch_size = cls_prob_shape[0]
         im_info_shape = (batch_size, 3)
-        output_shape = (self._rpn_post_nms_top_n, 5)
-        score_shape = (self._rpn_post_nms_top_n, 1)
+        # rois of all images are stacked, the first column is the image index
+        output_shape = (batch_size * self._rpn_post_nms_top_n, 5)
+        score_shape = (batch_size * self._rpn_post_nms_top_n, 1)
 
         if self._output_score:
             return [cls_prob_shape, bbox_pred_shape, im_info_shape], [output_shape, score_shape]
@@ -27,20 +27,31 @@ class ProposalTargetOperator(mx.operator.CustomOp):
     def forward(self, is_train, req, in_data, out_data, aux):
         assert self._batch_rois % self._batch_images == 0, \
             'BATCHIMAGES {} must devide BATCH_ROIS {}'.format(self._batch_images, self._batch_rois)
-        rois_per_image = self._batch_rois / self._batch_images
+        rois_per_image = self._batch_rois // self._batch_images
         fg_rois_per_image = np.round(self._fg_fraction * rois_per_image).astype(int)
 
         all_rois = in_data[0].asnumpy()
-        gt_boxes = in_data[1].asnumpy()
-
-        # Include ground-truth boxes in the set of candidate rois
-        zeros = np.zeros((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
-        all_rois = np.vstack((all_rois, np.hstack((zeros, gt_boxes[:, :-1]))))
-        # Sanity check: single batch only
-        assert np.all(all_rois[:, 0] == 0), 'Only single item batches are supported'
-
-        rois, labels, bbox_targets, bbox_weights = \
-            sample_rois(all_rois, fg_rois_per_image, rois_per_image, self._num_classes, gt_boxes=gt_boxes)
+        # gt boxes are padded to the same number per image, padding has no class
+        gt_boxes = in_data[1].asnumpy().reshape((self._batch_images, -1, 5))
+
+        rois, labels, bbox_targets, bbox_weights = [], [], [], []
+        for i in range(self._batch_images):
+            im_gt_boxes = gt_boxes[i][gt_boxes[i][:, 4] > 0]
+            # Include ground-truth boxes in the set of candidate rois
+            batch_inds = np.empty((im_gt_boxes.shape[0], 1), dtype=im_gt_boxes.dtype)
+            batch_inds.fill(i)
+            im_rois = np.vstack((all_rois[all_rois[:, 0] == i], np.hstack((batch_inds, im_gt_boxes[:, :-1]))))
+
+            im_rois, im_labels, im_bbox_targets, im_bbox_weights = \
+                sample_rois(im_rois, fg_rois_per_image, rois_per_image, self._num_classes, gt_boxes=im_gt_boxes)
+            rois.append(im_rois)
+            labels.append(im_labels)
+            bbox_targets.append(im_bbox_targets)
+            bbox_weights.append(im_bbox_weights)
+        rois = np.vstack(rois)
+        labels = np.hstack(labels)
+        bbox_targets = np.vstack(bbox_targets)
+        bbox_weights = np.vstack(bbox_weights)
 
         if logger.level == logging.DEBUG:
             logger.debug("labels: %s" % labels)
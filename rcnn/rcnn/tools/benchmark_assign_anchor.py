@@ -0,0 +1,67 @@
+"""
+Benchmark dense and sparse anchor assignment against the number of gt boxes.
+Labels, weights and regression targets of both modes are compared.
+Run from the rcnn directory: python -m rcnn.tools.benchmark_assign_anchor
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+
+from ..config import config
+from ..io.rpn import assign_anchor
+
+
+def make_gt_boxes(num_gt, im_height, im_width, rng):
+    """ random gt boxes from 8 to 400 pixels """
+    wh = np.exp(rng.uniform(np.log(8), np.log(400), (num_gt, 2)))
+    xy = rng.uniform(0, 1, (num_gt, 2)) * (np.array([im_width, im_height]) - wh)
+    gt_boxes = np.zeros((num_gt, 5), dtype=np.float32)
+    gt_boxes[:, 0:2] = np.round(xy)
+    gt_boxes[:, 2:4] = np.round(xy + wh)
+    gt_boxes[:, 4] = 1
+    return gt_boxes
+
+
+def run(mode, feat_shape, gt_boxes, im_info, num_iter, seed):
+    config.TRAIN.RPN_ASSIGN_MODE = mode
+    np.random.seed(seed)
+    label = assign_anchor(feat_shape, gt_boxes, im_info)
+    tic = time.time()
+    for _ in range(num_iter):
+        assign_anchor(feat_shape, gt_boxes, im_info)
+    return label, (time.time() - tic) / num_iter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark assign_anchor against number of gt boxes')
+    parser.add_argument('--num_gt', help='comma separated numbers of gt boxes', default='1,50,500', type=str)
+    parser.add_argument('--im_height', default=600, type=int)
+    parser.add_argument('--im_width', default=1000, type=int)
+    parser.add_argument('--num_iter', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    im_info = np.array([[args.im_height, args.im_width, 1.0]], dtype=np.float32)
+    feat_shape = (1, 2 * config.NUM_ANCHORS,
+                  int(np.ceil(args.im_height / 16.0)), int(np.ceil(args.im_width / 16.0)))
+    mode = config.TRAIN.RPN_ASSIGN_MODE
+    print('{:>8s} {:>12s} {:>12s} {:>8s} {:>6s}'.format('gt', 'dense (ms)', 'sparse (ms)', 'speedup', 'same'))
+    for num_gt in [int(n) for n in args.num_gt.split(',')]:
+        gt_boxes = make_gt_boxes(num_gt, args.im_height, args.im_width, rng)
+        ref, t_dense = run('dense', feat_shape, gt_boxes, im_info, args.num_iter, args.seed)
+        res, t_sparse = run('sparse', feat_shape, gt_boxes, im_info, args.num_iter, args.seed)
+        same = np.array_equal(ref['label'], res['label']) and \
+            np.array_equal(ref['bbox_weight'], res['bbox_weight']) and \
+            np.array_equal(ref['bbox_target'], res['bbox_target'])
+        print('{:>8d} {:>12.2f} {:>12.2f} {:>8.1f} {:>6s}'.format(
+            num_gt, t_dense * 1000.0, t_sparse * 1000.0, t_dense / t_sparse, str(same)))
+    config.TRAIN.RPN_ASSIGN_MODE = mode
+
+
+if __name__ == '__main__':
+    main()
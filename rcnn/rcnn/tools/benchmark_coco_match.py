@@ -0,0 +1,93 @@
+"""
+Benchmark COCOeval.matchDets against the per threshold, detection and gt loop
+it replaced, on random images with crowd and ignored gts and tied ious.
+Run from the rcnn directory: python -m rcnn.tools.benchmark_coco_match
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+
+from ..pycocotools.cocoeval import COCOeval
+
+
+def match_dets_loop(ious, iouThrs, dtIds, gtIds, gtIg, iscrowd, gtm, dtm, dtIg):
+    """
+    COCOeval.matchDets one threshold, detection and gt at a time, as evaluateImg did
+    """
+    for tind, t in enumerate(iouThrs):
+        for dind, dtId in enumerate(dtIds):
+            # information about best match so far (m=-1 -> unmatched)
+            iou = min([t,1-1e-10])
+            m   = -1
+            for gind, gtId in enumerate(gtIds):
+                # if this gt already matched, and not a crowd, continue
+                if gtm[tind,gind]>0 and not iscrowd[gind]:
+                    continue
+                # if dt matched to reg gt, and on ignore gt, stop
+                if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
+                    break
+                # continue to next gt unless better match made
+                if ious[dind,gind] < iou:
+                    continue
+                # if match successful and best so far, store appropriately
+                iou=ious[dind,gind]
+                m=gind
+            # if match made store id of match for both dt and gt
+            if m ==-1:
+                continue
+            dtIg[tind,dind] = gtIg[m]
+            dtm[tind,dind]  = gtIds[m]
+            gtm[tind,m]     = dtId
+
+
+def make_case(num_dt, num_gt, rng):
+    """ ious rounded to 0.05 so that ties occur, gt sorted ignore last like evaluateImg """
+    ious = np.round(rng.uniform(0, 1, (num_dt, num_gt)) * 20) / 20
+    ious[rng.uniform(0, 1, ious.shape) < 0.5] = 0
+    gtIg = np.sort(rng.uniform(0, 1, num_gt) < 0.2).astype(int)
+    iscrowd = (rng.uniform(0, 1, num_gt) < 0.1) & (gtIg > 0)
+    dtIds = np.arange(1, num_dt + 1)
+    gtIds = np.arange(1, num_gt + 1)
+    return ious, dtIds, gtIds, gtIg, iscrowd
+
+
+def run(func, cases, iouThrs):
+    results = []
+    tic = time.time()
+    for ious, dtIds, gtIds, gtIg, iscrowd in cases:
+        T, D, G = len(iouThrs), len(dtIds), len(gtIds)
+        gtm, dtm, dtIg = np.zeros((T, G)), np.zeros((T, D)), np.zeros((T, D))
+        func(ious, iouThrs, dtIds, gtIds, gtIg, iscrowd, gtm, dtm, dtIg)
+        results.append((gtm, dtm, dtIg))
+    return results, (time.time() - tic) / len(cases)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark COCOeval matching against number of detections')
+    parser.add_argument('--num_dt', help='comma separated numbers of detections per image',
+                        default='10,100,300', type=str)
+    parser.add_argument('--num_gt', default=20, type=int)
+    parser.add_argument('--num_cases', default=100, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    coco_eval = COCOeval(iouType='bbox')
+    iouThrs = coco_eval.params.iouThrs
+    print('{:>8s} {:>12s} {:>14s} {:>8s} {:>6s}'.format(
+        'dets', 'loop (ms)', 'matchDets (ms)', 'speedup', 'same'))
+    for num_dt in [int(n) for n in args.num_dt.split(',')]:
+        cases = [make_case(num_dt, rng.randint(1, args.num_gt + 1), rng) for _ in range(args.num_cases)]
+        ref, t_loop = run(match_dets_loop, cases, iouThrs)
+        res, t_vec = run(coco_eval.matchDets, cases, iouThrs)
+        same = all(np.array_equal(a, b) for r, s in zip(ref, res) for a, b in zip(r, s))
+        print('{:>8d} {:>12.2f} {:>14.2f} {:>8.1f} {:>6s}'.format(
+            num_dt, t_loop * 1000.0, t_vec * 1000.0, t_loop / t_vec, str(same)))
+
+
+if __name__ == '__main__':
+    main()
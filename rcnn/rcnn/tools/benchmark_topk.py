@@ -0,0 +1,53 @@
+"""
+Benchmark partial top-k selection against a full argsort of RPN scores.
+Run from the rcnn directory: python -m rcnn.tools.benchmark_topk
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+
+from ..config import config
+from ..processing.topk import topk
+
+
+def run(func, scores, k, num_iter):
+    order = func(scores, k)
+    tic = time.time()
+    for _ in range(num_iter):
+        func(scores, k)
+    return order, (time.time() - tic) / num_iter
+
+
+def full_sort(scores, k):
+    return scores.argsort()[::-1][:k]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark top-k selection against feature map size')
+    parser.add_argument('--feat_shape', help='comma separated feature map sizes HxW',
+                        default='38x63,50x84,63x100,100x167', type=str)
+    parser.add_argument('--top_k', default=config.TEST.RPN_PRE_NMS_TOP_N, type=int)
+    parser.add_argument('--num_iter', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    print('{:>10s} {:>8s} {:>12s} {:>12s} {:>8s} {:>6s}'.format(
+        'feat', 'scores', 'argsort (ms)', 'topk (ms)', 'speedup', 'same'))
+    # equal scores may come in another order, compare the sorted scores
+    for feat_shape in args.feat_shape.split(','):
+        height, width = [int(v) for v in feat_shape.split('x')]
+        scores = rng.uniform(0, 1, height * width * config.NUM_ANCHORS).astype(np.float32)
+        ref, t_sort = run(full_sort, scores, args.top_k, args.num_iter)
+        res, t_topk = run(topk, scores, args.top_k, args.num_iter)
+        print('{:>10s} {:>8d} {:>12.2f} {:>12.2f} {:>8.1f} {:>6s}'.format(
+            feat_shape, scores.size, t_sort * 1000.0, t_topk * 1000.0, t_sort / t_topk,
+            str(np.array_equal(scores[ref], scores[res]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@ from ..utils.load_model import load_param
 
 def test_rcnn(network, dataset, image_set, root_path, dataset_path,
               ctx, prefix, epoch,
-              vis, shuffle, has_rpn, proposal, thresh):
+              vis, shuffle, has_rpn, proposal, thresh, stream=False, resume=False):
     # set config
     if has_rpn:
         config.TEST.HAS_RPN = True
@@ -70,7 +70,7 @@ def test_rcnn(network, dataset, image_set, root_path, dataset_path,
                           arg_params=arg_params, aux_params=aux_params)
 
     # start detection
-    pred_eval(predictor, test_data, imdb, vis=vis, thresh=thresh)
+    pred_eval(predictor, test_data, imdb, vis=vis, thresh=thresh, stream=stream, resume=resume)
 
 
 def parse_args():
@@ -93,6 +93,8 @@ def parse_args():
     parser.add_argument('--shuffle', help='shuffle data on visualization', action='store_true')
     parser.add_argument('--has_rpn', help='generate proposals on the fly', action='store_true')
     parser.add_argument('--proposal', help='can be ss for selective search or rpn', default='rpn', type=str)
+    parser.add_argument('--stream', help='write detections to disk image by image', action='store_true')
+    parser.add_argument('--resume', help='with --stream, continue an interrupted test', action='store_true')
     args = parser.parse_args()
     return args
 
@@ -103,7 +105,7 @@ def main():
     ctx = mx.gpu(args.gpu)
     test_rcnn(args.network, args.dataset, args.image_set, args.root_path, args.dataset_path,
               ctx, args.prefix, args.epoch,
-              args.vis, args.shuffle, args.has_rpn, args.proposal, args.thresh)
+              args.vis, args.shuffle, args.has_rpn, args.proposal, args.thresh, args.stream, args.resume)
 
 if __name__ == '__main__':
     main()
@@ -13,7 +13,7 @@ from ..utils.load_model import load_param
 
 def test_rpn(network, dataset, image_set, root_path, dataset_path,
              ctx, prefix, epoch,
-             vis, shuffle, thresh):
+             vis, shuffle, thresh, batch_size=1):
     # rpn generate proposal config
     config.TEST.HAS_RPN = True
 
@@ -26,7 +26,7 @@ def test_rpn(network, dataset, image_set, root_path, dataset_path,
     # load dataset and prepare imdb for training
     imdb = eval(dataset)(image_set, root_path, dataset_path)
     roidb = imdb.gt_roidb()
-    test_data = TestLoader(roidb, batch_size=1, shuffle=shuffle, has_rpn=True)
+    test_data = TestLoader(roidb, batch_size=batch_size, shuffle=shuffle, has_rpn=True)
 
     # load model
     arg_params, aux_params = load_param(prefix, epoch, convert=True, ctx=ctx)
@@ -52,7 +52,7 @@ def test_rpn(network, dataset, image_set, root_path, dataset_path,
     # decide maximum shape
     data_names = [k[0] for k in test_data.provide_data]
     label_names = None if test_data.provide_label is None else [k[0] for k in test_data.provide_label]
-    max_data_shape = [('data', (1, 3, max([v[0] for v in config.SCALES]), max([v[1] for v in config.SCALES])))]
+    max_data_shape = [('data', (batch_size, 3, max([v[0] for v in config.SCALES]), max([v[1] for v in config.SCALES])))]
 
     # create predictor
     predictor = Predictor(sym, data_names, label_names,
@@ -83,6 +83,7 @@ def parse_args():
     parser.add_argument('--vis', help='turn on visualization', action='store_true')
     parser.add_argument('--thresh', help='rpn proposal threshold', default=0, type=float)
     parser.add_argument('--shuffle', help='shuffle data on visualization', action='store_true')
+    parser.add_argument('--batch_size', help='images per batch', default=1, type=int)
     args = parser.parse_args()
     return args
 
@@ -93,7 +94,7 @@ def main():
     ctx = mx.gpu(args.gpu)
     test_rpn(args.network, args.dataset, args.image_set, args.root_path, args.dataset_path,
              ctx, args.prefix, args.epoch,
-             args.vis, args.shuffle, args.thresh)
+             args.vis, args.shuffle, args.thresh, args.batch_size)
 
 if __name__ == '__main__':
     main()
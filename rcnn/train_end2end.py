@@ -22,7 +22,7 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
     logger.setLevel(logging.INFO)
 
     # setup config
-    config.TRAIN.BATCH_IMAGES = 1
+    config.TRAIN.BATCH_IMAGES = args.batch_images
     config.TRAIN.BATCH_ROIS = 256
     config.TRAIN.FG_FRACTION = 0.25
     config.TRAIN.END2END = True
@@ -51,7 +51,8 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
     train_data = AnchorLoader(feat_sym, roidb, batch_size=input_batch_size, shuffle=not args.no_shuffle,
                               ctx=ctx, work_load_list=args.work_load_list,
                               feat_stride=config.RPN_FEAT_STRIDE, anchor_scales=config.ANCHOR_SCALES,
-                              anchor_ratios=config.ANCHOR_RATIOS, aspect_grouping=config.TRAIN.ASPECT_GROUPING)
+                              anchor_ratios=config.ANCHOR_RATIOS, aspect_grouping=config.TRAIN.ASPECT_GROUPING,
+                              num_workers=args.prefetch_workers)
 
     # infer max shape
     max_data_shape = [('data', (input_batch_size, 3, max([v[0] for v in config.SCALES]), max([v[1] for v in config.SCALES])))]
@@ -177,6 +178,9 @@ def parse_args():
     parser.add_argument('--no_flip', help='disable flip images', action='store_true')
     parser.add_argument('--no_shuffle', help='disable random shuffle', action='store_true')
     parser.add_argument('--resume', help='continue training', action='store_true')
+    parser.add_argument('--batch_images', help='images per device', default=1, type=int)
+    parser.add_argument('--prefetch_workers', help='number of processes loading batches ahead of time',
+                        default=0, type=int)
     # e2e
     parser.add_argument('--gpus', help='GPU device to train with', default='0', type=str)
     parser.add_argument('--pretrained', help='pretrained model prefix', default=default.pretrained, type=str)
@@ -61,6 +61,8 @@ cfg.train.use_focal_loss = True # focal loss
 cfg.train.focal_loss_alpha = 0.25
 cfg.train.focal_loss_gamma = 2.0
 cfg.train.smoothl1_weight = 0.5 if cfg.train.use_focal_loss else 1.0
+# anchor matching of multibox_target: 'vectorized', 'loop' or 'ndarray' (no host copies)
+cfg.train.multibox_match_mode = 'vectorized'
 
 cfg.train = config_as_dict(cfg.train)  # convert to normal dict
 
@@ -77,5 +79,8 @@ cfg.valid.preprocess_threads = 32
 ### [eldercrow] my additions
 cfg.valid.th_pos = 0.25
 cfg.valid.th_nms = 0.35
+cfg.valid.pre_nms_topk = -1  # max number of candidates per image before nms, -1 for all
+cfg.valid.nms_topk = -1  # max number of detections kept per image, -1 for all
+cfg.valid.nms_per_class = False
 
 cfg.valid = config_as_dict(cfg.valid)  # convert to normal dict
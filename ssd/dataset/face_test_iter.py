@@ -15,27 +15,55 @@ class FaceTestIter(mx.io.DataIter):
         image shape to be resized
     mean_pixels : float or float list
         [R, G, B], mean pixel values
+    img_stride : int
+        input size is padded to a multiple of img_stride
+    batch_size : int
+        images per batch, more than 1 needs buckets
+    buckets : list of (int, int) or None
+        padded (height, width) shapes, multiples of img_stride. Each image goes
+        to the smallest bucket it fits in and a batch is emitted when a bucket
+        is full, so batches are not in image order; im_info['index'] gives the
+        images of a batch and im_info['pad_shape'] the shape each of them is
+        padded to when it runs alone. Images larger than every bucket run alone
+        at their own padded shape, with bucket_key None. If None, every image
+        runs alone at its own padded shape.
     """
     def __init__(self, imdb, has_label=False,
-            min_hw=(384, 384), mean_pixels=[128, 128, 128], img_stride=128):
+            min_hw=(384, 384), mean_pixels=[128, 128, 128], img_stride=128,
+            batch_size=1, buckets=None):
         super(FaceTestIter, self).__init__()
 
         self._imdb = imdb
-        self.batch_size = 1 # always 1
+        self.batch_size = batch_size
         self._min_hw = min_hw
         self._mean_pixels = mx.nd.array(mean_pixels).reshape((3,1,1))
         self._img_stride = img_stride
+        if buckets:
+            buckets = sorted([tuple(int(v) for v in b) for b in buckets], key=lambda b: b[0] * b[1])
+            for b in buckets:
+                assert b[0] % img_stride == 0 and b[1] % img_stride == 0, \
+                    "bucket {} is not a multiple of img_stride".format(b)
+            self.default_bucket_key = buckets[-1]
+        else:
+            assert batch_size == 1, "batch_size > 1 needs buckets"
+            self.default_bucket_key = None
+        self.buckets = buckets
 
         self._current = 0
         self._size = imdb.num_images
         self._index = np.arange(self._size)
+        # images read but not emitted yet, for each bucket
+        self._pending = {}
 
         self._data = None
         self._label = None
-        self._get_batch()
+        if self.buckets is None:
+            self._get_batch()
 
     @property
     def provide_data(self):
+        if self._data is None:
+            return [('data', (self.batch_size, 3) + self.default_bucket_key)]
         return [(k, v.shape) for k, v in self._data.items()]
 
     @property
@@ -47,15 +75,18 @@ class FaceTestIter(mx.io.DataIter):
 
     def reset(self):
         self._current = 0
+        self._pending = {}
 
     def iter_next(self):
-        return self._current < self._size
+        return self._current < self._size or len(self._pending) > 0
 
     def next(self):
+        if self.buckets is not None:
+            return self._next_bucket()
         if self.iter_next():
             self._get_batch()
             data_batch = mx.io.DataBatch( \
-                    data=self._data.values(), label=self._label.values(),
+                    data=list(self._data.values()), label=list(self._label.values()),
                     provide_data=self.provide_data, provide_label=self.provide_label,
                     pad=self.getpad(), index=self.getindex())
             self._current += self.batch_size
@@ -63,6 +94,78 @@ class FaceTestIter(mx.io.DataIter):
         else:
             raise StopIteration
 
+    def _next_bucket(self):
+        """
+        read images until a bucket is full, the remaining buckets are emitted
+        once all images are read
+        """
+        if not self.iter_next():
+            raise StopIteration
+        key, samples = None, None
+        while self._current < self._size:
+            sample = self._load_image(self._index[self._current])
+            self._current += 1
+            key = self._bucket_key(sample['data'].shape[1:])
+            if key is None:
+                samples = [sample]
+                break
+            self._pending.setdefault(key, []).append(sample)
+            if len(self._pending[key]) == self.batch_size:
+                samples = self._pending.pop(key)
+                break
+        if samples is None:
+            key = min(self._pending.keys())
+            samples = self._pending.pop(key)
+
+        n = len(samples)
+        if key is None:
+            data = np.expand_dims(samples[0]['data'], axis=0)
+        else:
+            data = np.zeros((self.batch_size, 3) + key, dtype=np.float32)
+            for i, sample in enumerate(samples):
+                h, w = sample['data'].shape[1:]
+                data[i, :, :h, :w] = sample['data']
+        self._data = {'data': mx.nd.array(data)}
+        labels = [sample['label'] for sample in samples]
+        if labels[0] is not None:
+            num_objects = max([1] + [l.shape[0] for l in labels])
+            label = -np.ones((data.shape[0], num_objects, labels[0].shape[1]), dtype=np.float32)
+            for i, l in enumerate(labels):
+                label[i, :l.shape[0]] = l
+            self._label = {'label': mx.nd.array(label)}
+        else:
+            self._label = {'label': None}
+        self._im_info = {'im_scale': mx.nd.array([sample['scale'] for sample in samples]),
+                         'im_path': [sample['im_path'] for sample in samples],
+                         'im_shape': [sample['im_shape'] for sample in samples],
+                         'pad_shape': [sample['data'].shape[1:] for sample in samples],
+                         'index': [sample['index'] for sample in samples]}
+        data_batch = mx.io.DataBatch( \
+                data=list(self._data.values()), label=list(self._label.values()),
+                provide_data=self.provide_data, provide_label=self.provide_label or None,
+                pad=data.shape[0] - n, bucket_key=key)
+        return data_batch, self._im_info
+
+    def _bucket_key(self, hw):
+        """ smallest bucket an image of padded size hw fits in, None if there is none """
+        for b in self.buckets:
+            if hw[0] <= b[0] and hw[1] <= b[1]:
+                return b
+        return None
+
+    def _load_image(self, index):
+        """
+        read an image padded to its own size
+        """
+        im_path = self._imdb.image_path_from_index(index)
+        with open(im_path, 'rb') as fp:
+            img_content = fp.read()
+        img = mx.img.imdecode(img_content)
+        data, scale = self._pad_image(img.asnumpy())
+        label = np.array(self._imdb.label_from_index(index)) if self._imdb.labels else None
+        return {'data': data, 'scale': scale, 'label': label, 'im_path': im_path,
+                'im_shape': img.shape, 'index': index}
+
     def getindex(self):
         return self._current // self.batch_size
 
@@ -111,6 +214,13 @@ class FaceTestIter(mx.io.DataIter):
         """
         perform data augmentations: resize, sub mean, swap channels
         """
+        data, scale = self._pad_image(data.asnumpy())
+        return mx.nd.array(data), mx.nd.array(scale)
+
+    def _pad_image(self, data):
+        """
+        pad an image w.r.t. image stride and subtract mean, padding is zero
+        """
         # # first resize image w.r.t max image size
         # sf_y = float(self._max_hw[0]) / data.shape[0]
         # sf_x = float(self._max_hw[1]) / data.shape[1]
@@ -122,7 +232,6 @@ class FaceTestIter(mx.io.DataIter):
         # if sy != data.shape[0] or sx != data.shape[1]:
         #     data = mx.img.imresize(data, sx, sy).asnumpy()
         # else:
-        data = data.asnumpy()
         sy, sx = data.shape[:2]
         sf_y, sf_x = 1.0, 1.0
         # pad image w.r.t. image stride
@@ -136,4 +245,4 @@ class FaceTestIter(mx.io.DataIter):
         # data = mx.img.imresize(data, int(sx), int(sy)).asnumpy() # ignore slight aspect ratio break
         data = np.transpose(padded, (2, 0, 1)).astype(float)
         data = data - self._mean_pixels.asnumpy()
-        return mx.nd.array(data), mx.nd.array((sf_y, sf_x))
+        return data, (sf_y, sf_x)
@@ -0,0 +1,146 @@
+import mxnet as mx
+import numpy as np
+
+
+class FaceTileIter(mx.io.DataIter):
+    """
+    Tiling iterator for large images, which feeds fixed size tiles to network.
+    Every image is resized to each scale of a pyramid and split into
+    overlapping tiles. A tile is cropped from the original image before it is
+    resized, and tiles are made one batch at a time, so memory does not grow
+    with image size or scale. Tiles of an image are consecutive, but a batch
+    may hold tiles of several images.
+
+    Parameters:
+    ----------
+    imdb : Imdb
+        image database
+    tile_hw : (int, int)
+        (height, width) of network input tiles
+    overlap : int
+        overlap of neighbouring tiles, in tile pixels. Objects up to this size
+        lie entirely in some tile
+    scales : tuple of float
+        image pyramid scales, larger than 1 for small objects
+    batch_size : int
+        tiles per batch
+    mean_pixels : float or float list
+        [R, G, B], mean pixel values
+    img_stride : int
+        tiles start at multiples of img_stride in the resized image, so their
+        anchors line up with those of the whole resized image
+    """
+    def __init__(self, imdb, tile_hw=(512, 512), overlap=128, scales=(1.0,),
+            batch_size=1, mean_pixels=[128, 128, 128], img_stride=128):
+        super(FaceTileIter, self).__init__()
+
+        if isinstance(tile_hw, int):
+            tile_hw = (tile_hw, tile_hw)
+        assert tile_hw[0] % img_stride == 0 and tile_hw[1] % img_stride == 0, \
+            "tiles should be multiples of img_stride"
+        assert min(tile_hw) - overlap >= img_stride, "tiles should overlap by less than tile - img_stride"
+        self._imdb = imdb
+        self.batch_size = batch_size
+        self._tile_hw = tuple(tile_hw)
+        self._overlap = overlap
+        self._scales = tuple(scales)
+        self._mean_pixels = np.reshape(np.array(mean_pixels, dtype=np.float32), (1, 1, 3))
+        self._img_stride = img_stride
+
+        self._size = imdb.num_images
+        self._index = np.arange(self._size)
+        self._tiles = None
+        self.reset()
+
+    @property
+    def provide_data(self):
+        return [('data', (self.batch_size, 3) + self._tile_hw)]
+
+    @property
+    def provide_label(self):
+        return []
+
+    def reset(self):
+        self._tiles = self._generate_tiles()
+        self._next_tile = next(self._tiles, None)
+
+    def iter_next(self):
+        return self._next_tile is not None
+
+    def next(self):
+        if not self.iter_next():
+            raise StopIteration
+        data = np.zeros((self.batch_size, 3) + self._tile_hw, dtype=np.float32)
+        tiles = []
+        while self._next_tile is not None and len(tiles) < self.batch_size:
+            tile_data, tile = self._next_tile
+            data[len(tiles), :, :tile_data.shape[0], :tile_data.shape[1]] = \
+                    np.transpose(tile_data, (2, 0, 1))
+            tiles.append(tile)
+            self._next_tile = next(self._tiles, None)
+        data_batch = mx.io.DataBatch(data=[mx.nd.array(data)], label=None,
+                provide_data=self.provide_data, provide_label=None,
+                pad=self.batch_size - len(tiles))
+        return data_batch, {'tiles': tiles}
+
+    def _generate_tiles(self):
+        """
+        tiles of all images, image by image and scale by scale
+
+        Returns:
+        ----------
+        generator of (tile data, tile info). Tile data is (h, w, 3), mean
+        subtracted, at most tile_hw. Tile info has the image index, path and
+        shape, the tile offset and scale (sx, sy) in the original image, and the
+        core (x0, y0, x1, y1), the part of the image this tile is responsible for
+        """
+        for index in self._index:
+            im_path = self._imdb.image_path_from_index(index)
+            with open(im_path, 'rb') as fp:
+                img_content = fp.read()
+            img = mx.img.imdecode(img_content).asnumpy()
+            im_shape = img.shape
+            for scale in self._scales:
+                # tile size in original image pixels
+                tile_h = int(self._tile_hw[0] / scale)
+                tile_w = int(self._tile_hw[1] / scale)
+                ys, cores_y = _tile_starts(im_shape[0], scale, self._tile_hw[0], self._overlap, self._img_stride)
+                xs, cores_x = _tile_starts(im_shape[1], scale, self._tile_hw[1], self._overlap, self._img_stride)
+                for y0, core_y in zip(ys, cores_y):
+                    for x0, core_x in zip(xs, cores_x):
+                        crop = img[y0:y0+tile_h, x0:x0+tile_w]
+                        ch, cw = crop.shape[:2]
+                        rh = min(int(round(ch * scale)), self._tile_hw[0])
+                        rw = min(int(round(cw * scale)), self._tile_hw[1])
+                        if (rh, rw) != (ch, cw):
+                            crop = mx.img.imresize(mx.nd.array(crop, dtype=np.uint8), rw, rh).asnumpy()
+                        tile = {'index': index, 'im_path': im_path, 'im_shape': im_shape,
+                                'offset': (x0, y0), 'scale': (rw / float(cw), rh / float(ch)),
+                                'tile_shape': (rh, rw),
+                                'core': (core_x[0], core_y[0], core_x[1], core_y[1])}
+                        yield crop.astype(np.float32) - self._mean_pixels, tile
+
+
+def _tile_starts(length, scale, tile, overlap, stride):
+    """
+    tile starts covering [0, length) at a scale. In the resized image, starts
+    are evenly spread multiples of stride, neighbouring tiles overlap by at
+    least overlap and the last tile may pass the end by less than stride.
+    The core of a tile ends half way through its overlap with the next one,
+    the first and last cores are unbounded
+
+    Returns:
+    ----------
+    list of starts, list of (core start, core end), in original image pixels
+    """
+    length_s = length * scale
+    if length_s <= tile:
+        return [0], [(-np.inf, np.inf)]
+    # last start and largest step, in strides
+    last = int(np.ceil((length_s - tile) / float(stride)))
+    step = (tile - overlap) // stride
+    n = int(np.ceil(last / float(step))) + 1
+    starts = [int(round(int(round(k * last / float(n - 1))) * stride / scale)) for k in range(n)]
+    tile = int(tile / scale)
+    bounds = [-np.inf] + [(starts[k] + starts[k-1] + tile) / 2.0 for k in range(1, n)] + [np.inf]
+    return starts, list(zip(bounds[:-1], bounds[1:]))
@@ -1,8 +1,11 @@
 import mxnet as mx
 import numpy as np
 import cv2
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import traceback
 from tools.rand_sampler import RandSampler
-from tools.crop_roi_patch import crop_roi_patch
+from tools.crop_roi_patch import crop_roi_patch_np
 
 class DetRecordIter(mx.io.DataIter):
     """
@@ -137,11 +140,24 @@ class DetIter(mx.io.DataIter):
     is_train : bool
         whether in training phase, default True, if False, labels might
         be ignored
+    num_workers : int
+        number of decoding processes, 0 to load batches in the calling thread
+    prefetch : int
+        maximum number of batches being prepared by the workers
+    shared_mem : bool
+        whether workers write batches into a ring of shared memory buffers,
+        which are wrapped as NDArrays without copying, instead of sending
+        them through a queue. The arrays of a batch are reused once the
+        next batch is requested
+    fused_augment : bool
+        whether to augment images as uint8 data and write them as float32
+        straight into the batch
     """
     def __init__(self, imdb, batch_size, data_shape, rand_sampler, \
                  mean_pixels=[128, 128, 128], \
                  rand_mirror=False, shuffle=False, rand_seed=None, \
-                 is_train=True, max_crop_trial=50):
+                 is_train=True, max_crop_trial=50, num_workers=0, prefetch=4,
+                 shared_mem=True, fused_augment=True):
         super(DetIter, self).__init__()
 
         self._imdb = imdb
@@ -149,7 +165,7 @@ class DetIter(mx.io.DataIter):
         if isinstance(data_shape, int):
             data_shape = (data_shape, data_shape)
         self._data_shape = data_shape
-        self._mean_pixels = mx.nd.array(mean_pixels).reshape((3,1,1))
+        self._mean_pixels = np.reshape(np.array(mean_pixels, dtype=np.float32), (3, 1, 1))
         self._rand_sampler = rand_sampler
         self.is_train = is_train
         self._rand_mirror = rand_mirror
@@ -157,15 +173,36 @@ class DetIter(mx.io.DataIter):
         if rand_seed:
             np.random.seed(rand_seed) # fix random seed
         self._max_crop_trial = max_crop_trial
+        self._fused_augment = fused_augment
 
         self._current = 0
         self._size = imdb.num_images
         self._index = np.arange(self._size)
 
+        # host copies of batch arrays, see copies_per_batch
+        self._num_batches = 0
+        self._num_copies = 0
+
         self._data = None
         self._label = None
         self._get_batch()
 
+        # worker pool, every batch is decoded with its own seed so that
+        # the results do not depend on the number of workers or scheduling
+        self._num_workers = num_workers
+        self._prefetch = max(1, prefetch)
+        self._workers = []
+        self._ring = None
+        if self._num_workers > 0:
+            self._seed_rng = np.random.RandomState(rand_seed)
+            if shared_mem:
+                label_shape = self._label['label'].shape[1:] if self.is_train else (0, 5)
+                # one more slot than prefetch, for the batch being used by the trainer
+                self._ring = SharedBatchRing(self._prefetch + 1, self.batch_size,
+                        self._data_shape, label_shape)
+            self._start_workers(rand_seed if rand_seed else 0)
+            self._start_epoch()
+
     @property
     def provide_data(self):
         return [(k, v.shape) for k, v in self._data.items()]
@@ -181,15 +218,20 @@ class DetIter(mx.io.DataIter):
         self._current = 0
         if self._shuffle:
             np.random.shuffle(self._index)
+        if self._workers:
+            self._start_epoch()
 
     def iter_next(self):
         return self._current < self._size
 
     def next(self):
         if self.iter_next():
-            self._get_batch()
-            data_batch = mx.io.DataBatch(data=self._data.values(),
-                                   label=self._label.values(),
+            if self._workers:
+                self._get_batch_from_workers()
+            else:
+                self._get_batch()
+            data_batch = mx.io.DataBatch(data=list(self._data.values()),
+                                   label=list(self._label.values()),
                                    pad=self.getpad(), index=self.getindex())
             self._current += self.batch_size
             return data_batch
@@ -203,67 +245,353 @@ class DetIter(mx.io.DataIter):
         pad = self._current + self.batch_size - self._size
         return 0 if pad < 0 else pad
 
-    def _get_batch(self):
+    @property
+    def copies_per_batch(self):
         """
-        Load data/label from dataset
+        Average number of host memory copies of data and label arrays made
+        for each batch after it was decoded, since the last reset_copy_stats
+        """
+        return self._num_copies / float(max(1, self._num_batches))
+
+    def reset_copy_stats(self):
+        self._num_batches = 0
+        self._num_copies = 0
+
+    def close(self):
+        """
+        Stop the decoding processes
         """
-        batch_data = mx.nd.zeros((self.batch_size, 3, self._data_shape[0], self._data_shape[1]))
-        batch_label = []
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for w in self._workers:
+            w.join(1.0)
+            if w.is_alive():
+                w.terminate()
+        self._workers = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _batch_indices(self, current):
+        """
+        Image indices of the batch starting at current, -1 for empty slots
+        """
+        indices = []
         for i in range(self.batch_size):
-            if (self._current + i) >= self._size:
+            if (current + i) >= self._size:
                 if not self.is_train:
+                    indices.append(-1)
                     continue
                 # use padding from middle in each epoch
-                idx = (self._current + i + self._size // 2) % self._size
-                index = self._index[idx]
+                idx = (current + i + self._size // 2) % self._size
+                indices.append(self._index[idx])
             else:
-                index = self._index[self._current + i]
-            # index = self.debug_index
-            im_path = self._imdb.image_path_from_index(index)
-            with open(im_path, 'rb') as fp:
-                img_content = fp.read()
-            img = mx.img.imdecode(img_content)
-            gt = self._imdb.label_from_index(index).copy() if self.is_train else None
-            data, label = self._data_augmentation(img, gt)
-            batch_data[i] = data
-            if self.is_train:
-                batch_label.append(label)
-        self._data = {'data': batch_data}
+                indices.append(self._index[current + i])
+        return indices
+
+    def _get_batch(self):
+        """
+        Load data/label from dataset
+        """
+        batch_data, batch_label = _load_det_batch(self._sample_params(), self._batch_indices(self._current))
+        self._set_batch(batch_data, batch_label)
+
+    def _set_batch(self, batch_data, batch_label, zero_copy=False):
+        zero_copy = zero_copy and hasattr(mx.nd, 'from_numpy')
+        self._num_batches += 1
+        self._data = {'data': _to_ndarray(batch_data, zero_copy)}
+        self._num_copies += 0 if zero_copy else 1
         if self.is_train:
-            self._label = {'label': mx.nd.array(np.array(batch_label))}
+            self._label = {'label': _to_ndarray(batch_label, zero_copy)}
+            self._num_copies += 0 if zero_copy else 1
         else:
             self._label = {'label': None}
 
-    def _data_augmentation(self, data, label):
+    def _sample_params(self):
+        return (self._imdb, self._data_shape, self._mean_pixels, self._rand_sampler,
+                self._rand_mirror, self.is_train, self._fused_augment)
+
+    def _start_workers(self, rand_seed):
+        self._task_queue = mp.Queue()
+        self._result_queue = mp.Queue()
+        for i in range(self._num_workers):
+            w = mp.Process(target=_det_worker_loop,
+                    args=(self._sample_params(), self._task_queue, self._result_queue,
+                        rand_seed + i, self._ring))
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+        self._epoch = 0
+        self._ready = {}
+        self._free_slots = list(range(self._ring.num_slots)) if self._ring else []
+        self._used_slot = None
+
+    def _start_epoch(self):
         """
-        perform data augmentations: crop, mirror, resize, sub mean, swap channels...
+        Drop the batches of the previous epoch and queue the first ones of the new epoch
         """
-        if self.is_train and self._rand_sampler:
-            width = data.shape[1]
-            height = data.shape[0]
-            rand_crop = self._rand_sampler.sample(label, (height, width))
-            xmin, ymin, xmax, ymax = np.array(rand_crop[0]).astype(int)
-            data = crop_roi_patch(data.asnumpy(), (xmin, ymin, xmax, ymax))
-            label = rand_crop[1]
-        if self.is_train:
-            interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, \
-                              cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
+        self._epoch += 1
+        # slots of batches still in flight are freed when their results arrive
+        for slot, _, _ in self._ready.values():
+            if slot is not None:
+                self._free_slots.append(slot)
+        self._ready = {}
+        self._n_pending = 0
+        self._next_submit = self._current
+        while self._n_pending < self._prefetch and self._submit():
+            pass
+
+    def _submit(self):
+        if self._next_submit >= self._size:
+            return False
+        slot = None
+        if self._ring:
+            if not self._free_slots:
+                return False
+            slot = self._free_slots.pop(0)
+        task = (self._epoch, self._next_submit, self._batch_indices(self._next_submit),
+                self._seed_rng.randint(0, 2**31 - 1), slot)
+        self._task_queue.put(task)
+        self._next_submit += self.batch_size
+        self._n_pending += 1
+        return True
+
+    def _release_slot(self):
+        """
+        Give the slot of the previous batch back to the workers,
+        once the engine has finished reading the NDArrays built on it
+        """
+        if self._used_slot is None:
+            return
+        for nd in (self._data['data'], self._label['label']):
+            if nd is not None:
+                mx.base.check_call(mx.base._LIB.MXNDArrayWaitToWrite(nd.handle))
+        self._free_slots.append(self._used_slot)
+        self._used_slot = None
+
+    def _get_batch_from_workers(self):
+        """
+        Wait for the current batch, results are reordered by their position in the epoch
+        """
+        self._release_slot()
+        while self._current not in self._ready:
+            while self._n_pending < self._prefetch and self._submit():
+                pass
+            epoch, current, slot, batch_data, batch_label = self._result_queue.get()
+            if epoch == 'error':
+                self.close()
+                raise RuntimeError('DetIter worker failed:\n' + batch_data)
+            if epoch != self._epoch:
+                if slot is not None:
+                    self._free_slots.append(slot)
+                continue
+            self._ready[current] = (slot, batch_data, batch_label)
+        slot, batch_data, batch_label = self._ready.pop(self._current)
+        self._n_pending -= 1
+        if slot is None:
+            # pickled through the result queue
+            self._num_copies += 2 if self.is_train else 1
+            self._set_batch(batch_data, batch_label)
         else:
-            interp_methods = [cv2.INTER_LINEAR]
-        interp_method = interp_methods[int(np.random.uniform(0, 1) * len(interp_methods))]
-        data = mx.img.imresize(data, self._data_shape[1], self._data_shape[0], interp_method)
-        if self.is_train:
-            valid_mask = np.where(np.any(label != -1, axis=1))[0]
-            if self._rand_mirror:
-                rr = rand_crop[2]
-                if np.random.uniform(0, 1) > 0.5:
-                    data = mx.nd.flip(data, axis=1)
-                    tmp = rr - label[valid_mask, 1]
-                    label[valid_mask, 1] = rr - label[valid_mask, 3]
-                    label[valid_mask, 3] = tmp
-            # label[valid_mask, 1::2] *= data.shape[1]
-            # label[valid_mask, 2::2] *= data.shape[0]
-        data = mx.nd.transpose(data, (2,0,1))
-        data = data.astype('float32')
-        data = data - self._mean_pixels
-        return data, label
+            self._used_slot = slot
+            self._set_batch(self._ring.data(slot), self._ring.label(slot), zero_copy=True)
+        while self._n_pending < self._prefetch and self._submit():
+            pass
+
+
+class SharedBatchRing(object):
+    """
+    Preallocated shared memory buffers for DetIter batches,
+    created before the workers are forked.
+
+    Parameters:
+    ----------
+    num_slots : int
+        number of batches in the ring
+    batch_size : int
+        batch size
+    data_shape : (int, int)
+        height and width of data
+    label_shape : (int, int)
+        shape of padded labels of an image
+    """
+    def __init__(self, num_slots, batch_size, data_shape, label_shape):
+        self.num_slots = num_slots
+        self.data_shape = (batch_size, 3, data_shape[0], data_shape[1])
+        self.label_shape = (batch_size,) + tuple(label_shape)
+        self._data = [RawArray('f', int(np.prod(self.data_shape))) for _ in range(num_slots)]
+        self._label = [RawArray('f', max(1, int(np.prod(self.label_shape)))) for _ in range(num_slots)]
+
+    def data(self, slot):
+        return np.frombuffer(self._data[slot], dtype=np.float32,
+                count=int(np.prod(self.data_shape))).reshape(self.data_shape)
+
+    def label(self, slot):
+        return np.frombuffer(self._label[slot], dtype=np.float32,
+                count=int(np.prod(self.label_shape))).reshape(self.label_shape)
+
+
+def _to_ndarray(arr, zero_copy=False):
+    """
+    NDArray from a numpy array, sharing its memory if zero_copy is set
+    """
+    if zero_copy:
+        return mx.nd.from_numpy(arr, zero_copy=True)
+    return mx.nd.array(arr)
+
+
+def _det_worker_loop(params, task_queue, result_queue, seed, ring=None):
+    """
+    Decoding process of DetIter
+    """
+    cv2.setNumThreads(1)
+    np.random.seed(seed)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        epoch, current, indices, batch_seed, slot = task
+        try:
+            np.random.seed(batch_seed)
+            if slot is None:
+                batch_data, batch_label = _load_det_batch(params, indices)
+            else:
+                _load_det_batch(params, indices, ring.data(slot), ring.label(slot))
+                batch_data, batch_label = None, None
+        except Exception:
+            result_queue.put(('error', current, slot, traceback.format_exc(), None))
+            continue
+        result_queue.put((epoch, current, slot, batch_data, batch_label))
+
+
+def _load_det_batch(params, indices, batch_data=None, batch_label=None):
+    """
+    Load and augment images of a batch, empty slots (index -1) are filled with zeros
+
+    Parameters:
+    ----------
+    params : tuple
+        (imdb, data_shape, mean_pixels, rand_sampler, rand_mirror, is_train, fused_augment)
+    indices : list of int
+        image indices
+    batch_data : numpy.array or None
+        (batch, 3, height, width) float32 array to write data into
+    batch_label : numpy.array or None
+        (batch, n_label, 5) float32 array to write labels into, padded with -1
+
+    Returns:
+    ----------
+    (batch, 3, height, width) float32 data and (batch, n_label, 5) labels
+    """
+    imdb, data_shape, mean_pixels, rand_sampler, rand_mirror, is_train, fused_augment = params
+    if batch_data is None:
+        batch_data = np.zeros((len(indices), 3, data_shape[0], data_shape[1]), dtype=np.float32)
+    labels = []
+    for i, index in enumerate(indices):
+        if index < 0:
+            batch_data[i] = 0
+            continue
+        im_path = imdb.image_path_from_index(index)
+        img = cv2.imread(im_path, cv2.IMREAD_COLOR)
+        assert img is not None, 'Failed to read {}'.format(im_path)
+        gt = imdb.label_from_index(index).copy() if is_train else None
+        if fused_augment:
+            label = _data_augmentation_fused(img, gt, batch_data[i], mean_pixels,
+                    rand_sampler, rand_mirror, is_train)
+        else:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            batch_data[i], label = _data_augmentation(img, gt, data_shape, mean_pixels,
+                    rand_sampler, rand_mirror, is_train)
+        if is_train:
+            labels.append(label)
+    if batch_label is None:
+        return batch_data, np.array(labels)
+    if is_train:
+        batch_label.fill(-1)
+        for i, label in enumerate(labels):
+            n = min(label.shape[0], batch_label.shape[1])
+            batch_label[i, :n, :label.shape[1]] = label[:n, :batch_label.shape[2]]
+    return batch_data, batch_label
+
+
+def _data_augmentation(data, label, data_shape, mean_pixels, rand_sampler, rand_mirror, is_train):
+    """
+    perform data augmentations: crop, mirror, resize, sub mean, swap channels...
+    data is a (height, width, 3) RGB image
+    """
+    if is_train and rand_sampler:
+        width = data.shape[1]
+        height = data.shape[0]
+        rand_crop = rand_sampler.sample(label, (height, width))
+        xmin, ymin, xmax, ymax = np.array(rand_crop[0]).astype(int)
+        data = crop_roi_patch_np(data, (xmin, ymin, xmax, ymax))
+        label = rand_crop[1]
+    if is_train:
+        interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, \
+                          cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
+    else:
+        interp_methods = [cv2.INTER_LINEAR]
+    interp_method = interp_methods[int(np.random.uniform(0, 1) * len(interp_methods))]
+    data = cv2.resize(data, (data_shape[1], data_shape[0]), interpolation=interp_method)
+    if is_train:
+        valid_mask = np.where(np.any(label != -1, axis=1))[0]
+        if rand_mirror:
+            rr = rand_crop[2]
+            if np.random.uniform(0, 1) > 0.5:
+                data = data[:, ::-1]
+                tmp = rr - label[valid_mask, 1]
+                label[valid_mask, 1] = rr - label[valid_mask, 3]
+                label[valid_mask, 3] = tmp
+        # label[valid_mask, 1::2] *= data.shape[1]
+        # label[valid_mask, 2::2] *= data.shape[0]
+    data = np.transpose(data, (2,0,1))
+    data = data.astype('float32')
+    data = data - mean_pixels
+    return data, label
+
+
+def _data_augmentation_fused(data, label, out, mean_pixels, rand_sampler, rand_mirror, is_train):
+    """
+    fused version of _data_augmentation, only the resized uint8 patch is
+    allocated, mirroring, swapping channels, casting and mean subtraction
+    are done while writing into out, a (3, height, width) float32 array.
+    data is a (height, width, 3) BGR image
+    """
+    height = data.shape[0]
+    width = data.shape[1]
+    xmin, ymin, xmax, ymax = 0, 0, width, height
+    rr = 1.0
+    if is_train and rand_sampler:
+        rand_crop = rand_sampler.sample(label, (height, width))
+        xmin, ymin, xmax, ymax = np.array(rand_crop[0]).astype(int)
+        label = rand_crop[1]
+        rr = rand_crop[2]
+    if is_train:
+        interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, \
+                          cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
+    else:
+        interp_methods = [cv2.INTER_LINEAR]
+    interp_method = interp_methods[int(np.random.uniform(0, 1) * len(interp_methods))]
+    mirror = False
+    if is_train:
+        valid_mask = np.where(np.any(label != -1, axis=1))[0]
+        if rand_mirror:
+            if np.random.uniform(0, 1) > 0.5:
+                mirror = True
+                tmp = rr - label[valid_mask, 1]
+                label[valid_mask, 1] = rr - label[valid_mask, 3]
+                label[valid_mask, 3] = tmp
+
+    # crop is a view of the image unless padding is needed, a separable
+    # resize of it is cheaper than an affine warp of the whole image
+    patch = crop_roi_patch_np(data, (xmin, ymin, xmax, ymax))
+    patch = cv2.resize(patch, (out.shape[2], out.shape[1]), interpolation=interp_method)
+    if mirror:
+        patch = patch[:, ::-1]
+    for c in range(3):
+        # BGR to RGB
+        np.subtract(patch[:, :, 2 - c], mean_pixels[c], out=out[c], dtype=np.float32)
+    return label
@@ -0,0 +1,176 @@
+import os
+import json
+import shutil
+import numpy as np
+
+
+class LabelStore(object):
+    """
+    Columnar on-disk store of image names and per-image labels.
+    Arrays are opened with numpy memmap, so reading an entry costs O(1)
+    without loading the whole store, and all processes using the store
+    share the same pages.
+
+    Layout of the store directory:
+        header.json : version, label width, max_objects and other fields
+        boxes.npy : (num_boxes, width) float32 labels of all images
+        offsets.npy : (num_images + 1) int64, labels of image i are
+            boxes[offsets[i]:offsets[i + 1]]
+        names.npy : uint8 utf-8 encoded image names, concatenated
+        name_offsets.npy : (num_images + 1) int64 offsets into names
+        mtimes.npy : (num_images) float64 modification time of the
+            annotations of each image, optional
+
+    Parameters:
+    ----------
+    path : str
+        store directory
+    version : str or None
+        expected version, raises if the store has a different one
+    """
+    def __init__(self, path, version=None):
+        self.path = path
+        self.order = None
+        self.padding = 0
+        self._open()
+        if version is not None:
+            assert self.header['ver'] == version, "Version mismatch, re-index DB."
+
+    def _open(self):
+        with open(os.path.join(self.path, 'header.json'), 'r') as fh:
+            self.header = json.load(fh)
+        self.width = self.header['width']
+        self.has_labels = self.header['has_labels']
+        self._name_offsets = np.load(os.path.join(self.path, 'name_offsets.npy'), mmap_mode='r')
+        self._names = np.load(os.path.join(self.path, 'names.npy'), mmap_mode='r')
+        self._offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+        self._boxes = np.load(os.path.join(self.path, 'boxes.npy'), mmap_mode='r')
+        fn_mtimes = os.path.join(self.path, 'mtimes.npy')
+        self.mtimes = np.load(fn_mtimes, mmap_mode='r') if os.path.exists(fn_mtimes) else None
+        self.num_images = self._name_offsets.size - 1
+
+    def __getstate__(self):
+        # processes reopen the memmaps instead of receiving a copy of the data
+        state = self.__dict__.copy()
+        for k in ('_name_offsets', '_names', '_offsets', '_boxes', 'mtimes'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @property
+    def names(self):
+        return _NameTable(self)
+
+    @property
+    def labels(self):
+        return _LabelTable(self)
+
+    def permute(self, ridx):
+        """
+        reorder entries, ridx[i] is the current position of new entry i
+        """
+        ridx = np.asarray(ridx, dtype=np.int64)
+        self.order = ridx if self.order is None else self.order[ridx]
+
+    def name(self, index):
+        if self.order is not None:
+            index = self.order[index]
+        return self._names[self._name_offsets[index]:self._name_offsets[index + 1]] \
+            .tobytes().decode('utf-8')
+
+    def label(self, index):
+        """
+        labels of an image as a new float32 array, padded with -1 up to padding rows
+        """
+        assert self.has_labels, "Labels not stored"
+        if self.order is not None:
+            index = self.order[index]
+        boxes = self._boxes[self._offsets[index]:self._offsets[index + 1]]
+        label = np.full((max(boxes.shape[0], self.padding), self.width), -1, dtype=np.float32)
+        label[:boxes.shape[0]] = boxes
+        return label
+
+    @staticmethod
+    def save(path, names, labels=None, header=None, mtimes=None):
+        """
+        write a store, replacing an existing one
+
+        Parameters:
+        ----------
+        path : str
+            store directory
+        names : list of str
+            image names
+        labels : list of numpy.array or None
+            (n x width) labels of each image
+        header : dict
+            extra fields, should contain 'ver'
+        mtimes : numpy.array or None
+            modification time of the annotations of each image
+        """
+        header = dict(header) if header else {}
+        name_bytes = [n.encode('utf-8') for n in names]
+        name_offsets = np.zeros((len(names) + 1,), dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(n) for n in name_bytes])
+        names = np.frombuffer(b''.join(name_bytes), dtype=np.uint8)
+
+        width = 0
+        offsets = np.zeros((len(name_bytes) + 1,), dtype=np.int64)
+        if labels is not None:
+            assert len(labels) == len(name_bytes), "Number of labels and images mismatch"
+            width = max([l.shape[1] for l in labels if l.size > 0] or [6])
+            rows = [np.reshape(l, (-1, l.shape[1] if l.size > 0 else width)) for l in labels]
+            offsets[1:] = np.cumsum([r.shape[0] for r in rows])
+            boxes = np.full((offsets[-1], width), -1, dtype=np.float32)
+            for r, s in zip(rows, offsets[:-1]):
+                boxes[s:s + r.shape[0], :r.shape[1]] = r
+        else:
+            boxes = np.zeros((0, width), dtype=np.float32)
+        header['width'] = width
+        header['has_labels'] = labels is not None
+        header['num_images'] = len(name_bytes)
+
+        # write to a temporary directory first, so that readers never see a partial store
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'name_offsets.npy'), name_offsets)
+        np.save(os.path.join(tmp_path, 'names.npy'), names)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_path, 'boxes.npy'), boxes)
+        if mtimes is not None:
+            np.save(os.path.join(tmp_path, 'mtimes.npy'), np.asarray(mtimes, dtype=np.float64))
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as fh:
+            json.dump(header, fh)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+
+class _NameTable(object):
+    """ list-like view of the image names of a LabelStore """
+    def __init__(self, store):
+        self._store = store
+
+    def __len__(self):
+        return self._store.num_images
+
+    def _check_index(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('index out of range')
+        return index
+
+    def __getitem__(self, index):
+        return self._store.name(self._check_index(index))
+
+
+class _LabelTable(_NameTable):
+    """ list-like view of the padded labels of a LabelStore """
+    def __getitem__(self, index):
+        return self._store.label(self._check_index(index))
@@ -1,6 +1,7 @@
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
 from pycocotools.coco import COCO
 
 
@@ -18,7 +19,7 @@ class Coco(Imdb):
         whether initially shuffle image list
 
     """
-    IDX_VER = '170811_1'
+    IDX_VER = '171020_1'
 
     def __init__(self, anno_file, image_dir, shuffle=True, names='mscoco.names'):
         assert os.path.isfile(anno_file), "Invalid annotation file: " + anno_file
@@ -32,17 +33,17 @@ class Coco(Imdb):
         self.num_classes = len(self.classes)
 
         # try to load cached data
-        cached = self._load_from_cache()
-        if cached is None:  # no cached data, load from DB (and save)
-            fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
+        store = self._load_from_cache()
+        if store is None:  # no cached data, load from DB (and save)
             self._load_all(anno_file, shuffle)
             self._save_to_cache()
-        else:
-            self.image_set_index = cached['image_set_index']
-            self.num_images = len(self.image_set_index)
-            if self.is_train:
-                self.labels = cached['labels']
-        self.num_images = len(self.image_set_index)
+            store = self._load_from_cache()
+        # names and labels are read from the memory-mapped store on demand
+        self._label_store = store
+        self.image_set_index = store.names
+        self.labels = store.labels
+        self.max_objects = store.header['max_objects']
+        self.num_images = store.num_images
 
     def image_path_from_index(self, index):
         """
@@ -77,6 +78,12 @@ class Coco(Imdb):
         assert self.labels is not None, "Labels not processed"
         return self.labels[index]
 
+    def pad_labels(self, max_objects=0):
+        """ labels are padded with -1 when they are read from the store """
+        self.max_objects = max(self.max_objects, max_objects)
+        self.padding = self.max_objects
+        self._label_store.padding = self.padding
+
     def _load_all(self, anno_file, shuffle):
         """
         initialize all entries given annotation json file
@@ -92,7 +99,7 @@ class Coco(Imdb):
         labels = []
         coco = COCO(anno_file)
         img_ids = coco.getImgIds()
-        max_objects == 0
+        max_objects = 0
         for img_id in img_ids:
             # filename
             image_info = coco.loadImgs(img_id)[0]
@@ -114,7 +121,7 @@ class Coco(Imdb):
                 ymax = ymin + float(bbox[3]) / height
                 label.append([cat_id, xmin, ymin, xmax, ymax, 0])
             if label:
-                max_objects = max(max_objects, len(labels))
+                max_objects = max(max_objects, len(label))
                 labels.append(np.array(label))
                 image_set_index.append(os.path.join(subdir, filename))
 
@@ -146,29 +153,16 @@ class Coco(Imdb):
         return cache_path
 
     def _load_from_cache(self):
-        fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
-        cached = {}
-        if os.path.exists(fn_cache):
-            try:
-                with open(fn_cache, 'rb') as fh:
-                    header = cPickle.load(fh)
-                    assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
-                    self.max_objects = header['max_objects']
-                    iidx = cPickle.load(fh)
-                    cached['image_set_index'] = iidx['image_set_index']
-                    if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
-            except:
-                # print 'Exception in load_from_cache.'
-                return None
-        return cached
+        fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.labels')
+        if not os.path.exists(fn_cache):
+            return None
+        try:
+            return LabelStore(fn_cache, self.IDX_VER)
+        except:
+            # print 'Exception in load_from_cache.'
+            return None
 
     def _save_to_cache(self):
-        fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
-        with open(fn_cache, 'wb') as fh:
-            header = {'ver': self.IDX_VER, 'max_objects': self.max_objects}
-            cPickle.dump(header, fh, cPickle.HIGHEST_PROTOCOL)
-            cPickle.dump({'image_set_index': self.image_set_index}, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({'labels': self.labels}, fh, cPickle.HIGHEST_PROTOCOL)
+        fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.labels')
+        header = {'ver': self.IDX_VER, 'max_objects': self.max_objects}
+        LabelStore.save(fn_cache, self.image_set_index, self.labels, header)
@@ -0,0 +1,144 @@
+import os
+import struct
+import multiprocessing as mp
+import numpy as np
+
+
+def parallel_map(func, tasks, num_workers=0, chunksize=32):
+    """
+    map func over tasks with a process pool, in order
+
+    Parameters:
+    ----------
+    func : callable
+        module level function, so that it can be sent to the workers
+    tasks : list
+        arguments of each call
+    num_workers : int
+        number of processes, 0 or 1 to run in this process
+    """
+    if num_workers <= 1 or len(tasks) <= chunksize:
+        return [func(t) for t in tasks]
+    pool = mp.Pool(num_workers)
+    try:
+        return pool.map(func, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def file_mtime(filenames):
+    """
+    latest modification time of the given files, 0 for missing ones
+    """
+    mtime = 0.0
+    for fn in filenames:
+        try:
+            mtime = max(mtime, os.path.getmtime(fn))
+        except OSError:
+            pass
+    return mtime
+
+
+def index_labels(names, parse_func, tasks, mtimes, store=None, num_workers=0):
+    """
+    parse labels of all images, reusing the ones in a previous label store
+    whose annotation files have not been modified since
+
+    Parameters:
+    ----------
+    names : list of str
+        image names
+    parse_func : callable
+        parse_func(task) returns the labels of an image
+    tasks : list
+        parse_func arguments of each image
+    mtimes : numpy.array
+        modification time of the annotations of each image
+    store : LabelStore or None
+        previous index, not shuffled nor padded
+    num_workers : int
+        number of parsing processes
+
+    Returns:
+    ----------
+    list of labels, number of parsed images
+    """
+    prev = {}
+    if store is not None and store.has_labels and store.mtimes is not None:
+        prev_mtimes = np.array(store.mtimes)
+        prev = dict((store.name(i), i) for i in range(store.num_images))
+    labels = [None] * len(names)
+    todo = []
+    for i, name in enumerate(names):
+        j = prev.get(name)
+        if j is not None and prev_mtimes[j] == mtimes[i]:
+            labels[i] = store.label(j)
+        else:
+            todo.append(i)
+    parsed = parallel_map(parse_func, [tasks[i] for i in todo], num_workers)
+    for i, label in zip(todo, parsed):
+        labels[i] = label
+    return labels, len(todo)
+
+
+def image_size(filename):
+    """
+    (width, height) of a jpeg, png, gif or bmp image read from its header,
+    without decoding pixels. Jpeg sizes follow the exif orientation like
+    cv2.imread. Returns None for other formats.
+    """
+    with open(filename, 'rb') as fh:
+        head = fh.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] == b'BM':
+            w, h = struct.unpack('<ii', head[18:26])
+            return w, abs(h)
+        if head[:2] == b'\xff\xd8':
+            fh.seek(2)
+            return _jpeg_size(fh)
+    return None
+
+
+def _jpeg_size(fh):
+    """ walk the jpeg markers until the start of frame """
+    transposed = False
+    while True:
+        marker = fh.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            return None
+        code = ord(marker[1:2])
+        if code == 0xff:
+            # fill byte
+            fh.seek(-1, 1)
+            continue
+        if code in (0x01,) or 0xd0 <= code <= 0xd7:
+            continue
+        seg_len = struct.unpack('>H', fh.read(2))[0]
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            h, w = struct.unpack('>xHH', fh.read(5))
+            return (h, w) if transposed else (w, h)
+        data = fh.read(seg_len - 2)
+        if code == 0xe1 and data[:6] == b'Exif\x00\x00':
+            transposed = _exif_orientation(data[6:]) in (5, 6, 7, 8)
+        if code == 0xda:
+            return None
+
+
+def _exif_orientation(tiff):
+    """ orientation tag of the first IFD of exif data, 1 if not found """
+    try:
+        endian = '<' if tiff[:2] == b'II' else '>'
+        offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        num_entries = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+        for i in range(num_entries):
+            entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+            tag, _, _, value = struct.unpack(endian + 'HHIH', entry[:10])
+            if tag == 0x0112:
+                return value
+    except struct.error:
+        pass
+    return 1
@@ -3,9 +3,10 @@ import os
 import numpy as np
 from imdb import Imdb
 import xml.etree.ElementTree as ET
-from evaluate.eval_voc import voc_eval
+from evaluate.eval_voc import load_voc_recs, voc_eval_all
 import cv2
-import cPickle
+from label_store import LabelStore
+from parallel_index import index_labels, file_mtime
 
 
 class PascalVoc(Imdb):
@@ -25,7 +26,7 @@ class PascalVoc(Imdb):
     is_train : boolean
         if true, will load annotations
     """
-    IDX_VER = '170811_1'
+    IDX_VER = '171020_1'
 
     def __init__(self, image_set, year, devkit_path, shuffle=False, is_train=False,
             names='pascal_voc.names'):
@@ -41,34 +42,33 @@ class PascalVoc(Imdb):
             os.path.join(os.path.dirname(__file__), 'names'))
 
         self.config = {'use_difficult': True,
-                       'comp_id': 'comp4',}
+                       'comp_id': 'comp4',
+                       'index_workers': 8,
+                       'eval_workers': 0,
+                       'check_mtime': True,}
 
         self.num_classes = len(self.classes)
 
         # try to load cached data
-        cached = self._load_from_cache()
-        if cached is None:  # no cached data, load from DB (and save)
-            fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
+        store = self._load_from_cache()
+        if store is None or (self.is_train and not store.has_labels) \
+                or self._cache_outdated(store):
+            # no cached data or annotations changed, load from DB (and save)
             self.image_set_index = self._load_image_set_index(shuffle)
             self.num_images = len(self.image_set_index)
-            self.labels, self.max_objects = self._load_image_labels()
+            self.labels, self.max_objects = self._load_image_labels(store)
             # if self.is_train:
             #     self.labels, self.max_objects = self._load_image_labels()
             self._save_to_cache()
-        else:
-            self.image_set_index = cached['image_set_index']
-            self.num_images = len(self.image_set_index)
-            if self.is_train:
-                if 'labels' in cached:
-                    self.labels = cached['labels']
-                else:
-                    self.labels, self.max_objects = self._load_image_labels()
-                    self._save_to_cache()
+            store = self._load_from_cache()
+        # names and labels are read from the memory-mapped store on demand
+        self._label_store = store
+        self.image_set_index = store.names
+        self.num_images = store.num_images
+        self.max_objects = store.header['max_objects']
+        self.labels = store.labels if store.has_labels else None
         if shuffle:
-            ridx = np.random.permutation(np.arange(self.num_images))
-            image_set_index = [self.image_set_index[i] for i in ridx]
-            labels = [self.labels[i] for i in ridx]
-            self.image_set_index, self.labels = image_set_index, labels
+            store.permute(np.random.permutation(np.arange(self.num_images)))
         if self.is_train:
             self.pad_labels()
 
@@ -88,39 +88,38 @@ class PascalVoc(Imdb):
 
     def _load_from_cache(self):
         fn_cache = os.path.join(self.cache_path,
-                                self.name + '_' + self.IDX_VER + '.pkl')
-        cached = {}
-        if os.path.exists(fn_cache):
-            try:
-                with open(fn_cache, 'rb') as fh:
-                    header = cPickle.load(fh)
-                    assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
-                    self.max_objects = header['max_objects']
-                    iidx = cPickle.load(fh)
-                    cached['image_set_index'] = iidx['image_set_index']
-                    if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
-            except:
-                # print 'Exception in load_from_cache.'
-                return None
-        return None if not cached else cached
+                                self.name + '_' + self.IDX_VER + '.labels')
+        if not os.path.exists(fn_cache):
+            return None
+        try:
+            return LabelStore(fn_cache, self.IDX_VER)
+        except:
+            # print 'Exception in load_from_cache.'
+            return None
 
     def _save_to_cache(self):
         fn_cache = os.path.join(self.cache_path,
-                                self.name + '_' + self.IDX_VER + '.pkl')
-        with open(fn_cache, 'wb') as fh:
-            cPickle.dump({
-                'ver': self.IDX_VER,
-                'max_objects': self.max_objects
-            }, fh, cPickle.HIGHEST_PROTOCOL)
-            cPickle.dump({
-                'image_set_index': self.image_set_index
-            }, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({
-                    'labels': self.labels
-                }, fh, cPickle.HIGHEST_PROTOCOL)
+                                self.name + '_' + self.IDX_VER + '.labels')
+        LabelStore.save(fn_cache, self.image_set_index, self.labels,
+                        {'ver': self.IDX_VER, 'max_objects': self.max_objects},
+                        self._label_mtimes)
+
+    def _cache_outdated(self, store):
+        """
+        check if the image list or any annotation changed since the cache was saved
+        """
+        if not self.config['check_mtime'] or not store.has_labels:
+            return False
+        if store.mtimes is None:
+            return True
+        names = self._load_image_set_index()
+        if len(names) != store.num_images:
+            return True
+        prev = dict(zip(store.names, store.mtimes))
+        for name in names:
+            if prev.get(name) != file_mtime([self._label_path_from_index(name)]):
+                return True
+        return False
 
     def _load_image_set_index(self, shuffle=False):
         """
@@ -192,57 +191,36 @@ class PascalVoc(Imdb):
         assert os.path.exists(label_file), 'Path does not exist: {}'.format(label_file)
         return label_file
 
-    def _load_image_labels(self):
+    def _load_image_labels(self, store=None):
         """
         preprocess all ground-truths
 
+        Parameters:
+        ----------
+        store : LabelStore or None
+            previous index, labels of unmodified annotations are taken from it
+
         Returns:
         ----------
         labels packed in [num_images x max_num_objects x 6] tensor
         """
-        temp = []
-        max_objects = 0
-
-        # load ground-truth from xml annotations
-        for idx in self.image_set_index:
-            label_file = self._label_path_from_index(idx)
-            tree = ET.parse(label_file)
-            root = tree.getroot()
-            size = root.find('size')
-            width = float(size.find('width').text)
-            height = float(size.find('height').text)
-            label = []
-
-            for obj in root.iter('object'):
-                difficult = int(obj.find('difficult').text)
-                # if not self.config['use_difficult'] and difficult == 1:
-                #     continue
-                cls_name = obj.find('name').text
-                if cls_name not in self.classes:
-                    continue
-                cls_id = self.classes.index(cls_name)
-                xml_box = obj.find('bndbox')
-                xmin = float(xml_box.find('xmin').text) / width
-                ymin = float(xml_box.find('ymin').text) / height
-                xmax = float(xml_box.find('xmax').text) / width
-                ymax = float(xml_box.find('ymax').text) / height
-                label.append([cls_id, xmin, ymin, xmax, ymax, difficult])
-            if len(label) > max_objects:
-                max_objects = len(label)
-            temp.append(np.array(label))
+        # load ground-truth from xml annotations, only the ones modified
+        # since the previous index are parsed
+        names = list(self.image_set_index)
+        tasks = [(self._label_path_from_index(idx), self.classes) for idx in names]
+        self._label_mtimes = np.array([file_mtime([t[0]]) for t in tasks])
+        temp, _ = index_labels(names, _parse_voc_annotation, tasks, self._label_mtimes,
+                               store, self.config['index_workers'])
+        max_objects = max([label.shape[0] for label in temp] + [0])
 
         assert max_objects > 0, "No objects found for any of the images"
         return temp, max_objects
 
     def pad_labels(self, max_objects=0):
-        """ labels: list of ndarrays """
+        """ labels are padded with -1 when they are read from the store """
         self.max_objects = max(self.max_objects, max_objects)
         self.padding = self.max_objects
-        for (i, label) in enumerate(self.labels):
-            padded = np.tile(np.full((6, ), -1, dtype=np.float32), (self.padding, 1))
-            padded[:label.shape[0], :] = label
-            self.labels[i] = padded
-            assert self.labels[i].shape[0] == self.max_objects
+        self._label_store.padding = self.padding
 
     def evaluate_detections(self, detections):
         """
@@ -266,8 +244,9 @@ class PascalVoc(Imdb):
         if not os.path.exists(res_file_folder):
             os.mkdir(res_file_folder)
 
-        self.write_pascal_results(detections)
-        self.do_python_eval()
+        imsizes = self._get_imsizes(detections)
+        self.write_pascal_results(detections, imsizes)
+        self.do_python_eval(detections, imsizes)
 
     def get_result_file_template(self):
         """
@@ -284,17 +263,21 @@ class PascalVoc(Imdb):
         path = os.path.join(res_file_folder, filename)
         return path
 
-    def write_pascal_results(self, all_boxes):
+    def write_pascal_results(self, all_boxes, imsizes=None):
         """
         write results files in pascal devkit path
         Parameters:
         ----------
         all_boxes: list
             boxes to be processed [bbox, confidence]
+        imsizes: list or None
+            (height, width) of the images with detections, read if None
         Returns:
         ----------
         None
         """
+        if imsizes is None:
+            imsizes = self._get_imsizes(all_boxes)
         for cls_ind, cls in enumerate(self.classes):
             print('Writing {} VOC results file'.format(cls))
             filename = self.get_result_file_template().format(cls)
@@ -303,7 +286,7 @@ class PascalVoc(Imdb):
                     dets = all_boxes[im_ind]
                     if dets.shape[0] < 1:
                         continue
-                    h, w = self._get_imsize(self.image_path_from_index(im_ind))
+                    h, w = imsizes[im_ind]
                     # the VOCdevkit expects 1-based indices
                     for k in range(dets.shape[0]):
                         if (int(dets[k, 0]) == cls_ind):
@@ -312,10 +295,58 @@ class PascalVoc(Imdb):
                                            int(dets[k, 2] * w) + 1, int(dets[k, 3] * h) + 1,
                                            int(dets[k, 4] * w) + 1, int(dets[k, 5] * h) + 1))
 
-    def do_python_eval(self):
+    def get_eval_detections(self, all_boxes, imsizes):
         """
-        python evaluation wrapper
+        detections of each class as arrays, with the values of the results files
 
+        Parameters:
+        ----------
+        all_boxes: list
+            boxes to be processed [bbox, confidence]
+        imsizes: list
+            (height, width) of the images with detections
+        Returns:
+        ----------
+        per class (image indices, scores, boxes)
+        """
+        image_inds, cls_ids, scores, boxes = [], [], [], []
+        for im_ind in range(self.num_images):
+            dets = all_boxes[im_ind]
+            if dets.shape[0] < 1:
+                continue
+            h, w = imsizes[im_ind]
+            # results files keep 3 decimals of scores and 1-based pixel coordinates
+            scale = np.array([w, h, w, h], dtype=dets.dtype)
+            image_inds.append(np.full((dets.shape[0],), im_ind, dtype=np.int64))
+            cls_ids.append(dets[:, 0].astype(int))
+            scores.append(np.round(dets[:, 1].astype(np.float64), 3))
+            boxes.append(((dets[:, 2:6] * scale).astype(int) + 1).astype(np.float64))
+        if image_inds:
+            image_inds, cls_ids = np.concatenate(image_inds), np.concatenate(cls_ids)
+            scores, boxes = np.concatenate(scores), np.vstack(boxes)
+        else:
+            image_inds, cls_ids = np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=int)
+            scores, boxes = np.zeros((0,)), np.zeros((0, 4))
+
+        # split by class, in the order of the results files
+        order = np.argsort(cls_ids, kind='mergesort')
+        starts = np.searchsorted(cls_ids[order], np.arange(self.num_classes + 1))
+        detections = []
+        for cls_ind in range(self.num_classes):
+            inds = order[starts[cls_ind]:starts[cls_ind + 1]]
+            detections.append((image_inds[inds], scores[inds], boxes[inds]))
+        return detections
+
+    def do_python_eval(self, detections, imsizes=None):
+        """
+        python evaluation wrapper, all classes are evaluated from memory
+
+        Parameters:
+        ----------
+        detections: list
+            result list, each entry is a matrix of detections
+        imsizes: list or None
+            (height, width) of the images with detections, read if None
         Returns:
         ----------
         None
@@ -323,18 +354,35 @@ class PascalVoc(Imdb):
         annopath = os.path.join(self.data_path, 'Annotations', '{:s}.xml')
         imageset_file = os.path.join(self.data_path, 'ImageSets', 'Main', self.image_set + '.txt')
         cache_dir = os.path.join(self.cache_path, self.name)
+        image_filenames, recs = load_voc_recs(annopath, imageset_file, cache_dir)
+        assert image_filenames == list(self.image_set_index), \
+            "image set changed since the imdb was loaded"
+        if imsizes is None:
+            imsizes = self._get_imsizes(detections)
         aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if int(self.year) < 2010 else False
         print('VOC07 metric? ' + ('Y' if use_07_metric else 'No'))
+        results = voc_eval_all(self.get_eval_detections(detections, imsizes), image_filenames, recs,
+                               self.classes, ovthresh=0.5, use_07_metric=use_07_metric,
+                               num_workers=self.config['eval_workers'])
         for cls_ind, cls in enumerate(self.classes):
-            filename = self.get_result_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename, annopath, imageset_file, cls, cache_dir,
-                                     ovthresh=0.5, use_07_metric=use_07_metric)
+            rec, prec, ap = results[cls_ind]
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
         print('Mean AP = {:.4f}'.format(np.mean(aps)))
 
+    def _get_imsizes(self, all_boxes):
+        """
+        sizes of the images with detections, each image is read once
+
+        Returns:
+        ----------
+        list of (height, width), None for images without detections
+        """
+        return [self._get_imsize(self.image_path_from_index(im_ind)) if all_boxes[im_ind].shape[0] > 0
+                else None for im_ind in range(self.num_images)]
+
     def _get_imsize(self, im_name):
         """
         get image size info
@@ -344,3 +392,41 @@ class PascalVoc(Imdb):
         """
         img = cv2.imread(im_name)
         return (img.shape[0], img.shape[1])
+
+
+def _parse_voc_annotation(task):
+    """
+    labels of an image from its xml annotation
+
+    Parameters:
+    ----------
+    task : tuple
+        (annotation file, class names)
+
+    Returns:
+    ----------
+    numpy.array of [cls_id, xmin, ymin, xmax, ymax, difficult]
+    """
+    label_file, classes = task
+    tree = ET.parse(label_file)
+    root = tree.getroot()
+    size = root.find('size')
+    width = float(size.find('width').text)
+    height = float(size.find('height').text)
+    label = []
+
+    for obj in root.iter('object'):
+        difficult = int(obj.find('difficult').text)
+        # if not self.config['use_difficult'] and difficult == 1:
+        #     continue
+        cls_name = obj.find('name').text
+        if cls_name not in classes:
+            continue
+        cls_id = classes.index(cls_name)
+        xml_box = obj.find('bndbox')
+        xmin = float(xml_box.find('xmin').text) / width
+        ymin = float(xml_box.find('ymin').text) / height
+        xmax = float(xml_box.find('xmax').text) / width
+        ymax = float(xml_box.find('ymax').text) / height
+        label.append([cls_id, xmin, ymin, xmax, ymax, difficult])
+    return np.array(label)
@@ -3,7 +3,8 @@ import os
 import numpy as np
 from imdb import Imdb
 import cv2
-import cPickle
+from label_store import LabelStore
+from parallel_index import index_labels, file_mtime, image_size
 
 
 class Wider(Imdb):
@@ -21,7 +22,7 @@ class Wider(Imdb):
     is_train : boolean
         if true, will load annotations
     """
-    IDX_VER = '170819_1'  # for caching
+    IDX_VER = '171020_1'  # for caching
 
     def __init__(self, image_set, devkit_path, shuffle=False, is_train=False):
         super(Wider,
@@ -35,34 +36,32 @@ class Wider(Imdb):
 
         self.classes = ['face',]
 
-        self.config = {'th_small': 6, 'use_difficult': False, 'padding': 256}
+        self.config = {'th_small': 6, 'use_difficult': False, 'padding': 256,
+                       'index_workers': 8, 'check_mtime': True}
 
         self.num_classes = len(self.classes)
         self.max_objects = 0
+        self._label_mtimes = None
 
         # try to load cached data
-        cached = self._load_from_cache()
-        if cached is None:  # no cached data, load from DB (and save)
-            fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
+        store = self._load_from_cache()
+        if store is None or (self.is_train and not store.has_labels) \
+                or self._cache_outdated(store):
+            # no cached data or annotations changed, load from DB (and save)
             self.image_set_index = self._load_image_set_index(shuffle)
             self.num_images = len(self.image_set_index)
             if self.is_train:
-                self.labels, self.max_objects = self._load_image_labels()
+                self.labels, self.max_objects = self._load_image_labels(store)
             self._save_to_cache()
-        else:
-            self.image_set_index = cached['image_set_index']
-            self.num_images = len(self.image_set_index)
-            if self.is_train:
-                if 'labels' in cached:
-                    self.labels = cached['labels']
-                else:
-                    self.labels, self.max_objects = self._load_image_labels()
-                    self._save_to_cache()
+            store = self._load_from_cache()
+        # names and labels are read from the memory-mapped store on demand
+        self._label_store = store
+        self.image_set_index = store.names
+        self.num_images = store.num_images
+        self.max_objects = store.header['max_objects']
+        self.labels = store.labels if store.has_labels else None
         if shuffle:
-            ridx = np.random.permutation(np.arange(self.num_images))
-            image_set_index = [self.image_set_index[i] for i in ridx]
-            labels = [self.labels[i] for i in ridx]
-            self.image_set_index, self.labels = image_set_index, labels
+            store.permute(np.random.permutation(np.arange(self.num_images)))
         if self.is_train:
             self._pad_labels()
 
@@ -82,39 +81,39 @@ class Wider(Imdb):
 
     def _load_from_cache(self):
         fn_cache = os.path.join(self.cache_path,
-                                self.name + '_' + self.IDX_VER + '.pkl')
-        cached = {}
-        if os.path.exists(fn_cache):
-            try:
-                with open(fn_cache, 'rb') as fh:
-                    header = cPickle.load(fh)
-                    assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
-                    self.max_objects = header['max_objects']
-                    iidx = cPickle.load(fh)
-                    cached['image_set_index'] = iidx['image_set_index']
-                    if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
-            except:
-                # print 'Exception in load_from_cache.'
-                return None
-        return None if not cached else cached
+                                self.name + '_' + self.IDX_VER + '.labels')
+        if not os.path.exists(fn_cache):
+            return None
+        try:
+            return LabelStore(fn_cache, self.IDX_VER)
+        except:
+            # print 'Exception in load_from_cache.'
+            return None
 
     def _save_to_cache(self):
         fn_cache = os.path.join(self.cache_path,
-                                self.name + '_' + self.IDX_VER + '.pkl')
-        with open(fn_cache, 'wb') as fh:
-            cPickle.dump({
-                'ver': self.IDX_VER,
-                'max_objects': self.max_objects
-            }, fh, cPickle.HIGHEST_PROTOCOL)
-            cPickle.dump({
-                'image_set_index': self.image_set_index
-            }, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({
-                    'labels': self.labels
-                }, fh, cPickle.HIGHEST_PROTOCOL)
+                                self.name + '_' + self.IDX_VER + '.labels')
+        LabelStore.save(fn_cache, self.image_set_index,
+                        self.labels if self.is_train else None,
+                        {'ver': self.IDX_VER, 'max_objects': int(self.max_objects)},
+                        self._label_mtimes if self.is_train else None)
+
+    def _cache_outdated(self, store):
+        """
+        check if the image list or any annotation changed since the cache was saved
+        """
+        if not self.config['check_mtime'] or not store.has_labels:
+            return False
+        if store.mtimes is None:
+            return True
+        names = self._load_image_set_index(False)
+        if len(names) != store.num_images:
+            return True
+        prev = dict(zip(store.names, store.mtimes))
+        for name in names:
+            if prev.get(name) != file_mtime(self._annotation_files(name)):
+                return True
+        return False
 
     def _load_image_set_index(self, shuffle):
         """
@@ -185,98 +184,111 @@ class Wider(Imdb):
         full path of annotation file
         """
         name = self.image_set_index[index]
-        bb_file = os.path.join(self.data_path, 'annotation', name + '.bb')
-        prop_file = os.path.join(self.data_path, 'annotation', name + '.prop_label')
+        bb_file, prop_file = self._annotation_files(name)
         assert os.path.exists(bb_file), 'Path does not exist: {}'.format(bb_file)
         return bb_file, prop_file
 
-    def _load_image_labels(self):
+    def _annotation_files(self, name):
+        return (os.path.join(self.data_path, 'annotation', name + '.bb'),
+                os.path.join(self.data_path, 'annotation', name + '.prop_label'))
+
+    def _load_image_labels(self, store=None):
         """
         preprocess all ground-truths
 
+        Parameters:
+        ----------
+        store : LabelStore or None
+            previous index, labels of unmodified annotations are taken from it
+
         Returns:
         ----------
         labels packed in [num_images x max_num_objects x 5] tensor
         """
-        temp = []
-        max_objects = 0
-        max_label = np.empty((0, 5))
-        max_fn = ''
-
-        # load ground-truth from xml annotations
-        for idx in range(len(self.image_set_index)):
+        # only annotations modified since the previous index are parsed
+        names = list(self.image_set_index)
+        tasks = []
+        mtimes = []
+        for idx in range(len(names)):
             bb_file, prop_file = self._label_path_from_index(idx)
-            cls_id = self.classes.index('face')
-            bbs = np.reshape(np.loadtxt(bb_file).astype(float), (-1, 4))
-            if bbs.size == 0:
-                temp.append(np.empty((0, 6)))
-                continue
-            ww_img = 0
-            hh_img = 0
-            small_mask = np.maximum(bbs[:, 2], bbs[:, 3]) < self.config['th_small']
-            # remove bbs that are 1) invalid or 2) too small and occluded.
-            with open(prop_file, 'r') as fh:
-                prop_data = fh.read().splitlines()
-            for pdata in prop_data:
-                prop_bb = pdata.split(' ')
-                if prop_bb[0] == 'invalid_label_list':
-                    invalid_mask = np.array(prop_bb[1:]).astype(int) == 1
-                if prop_bb[0] == 'occlusion_label_list':
-                    occ_mask = np.array(prop_bb[1:]).astype(int) == 2
-                if prop_bb[0] == 'blur_label_list':
-                    blur_mask = np.array(prop_bb[1:]).astype(int) == 2
-                # also get image size
-                if prop_bb[0] == 'image_size':
-                    ww_img = int(prop_bb[1])
-                    hh_img = int(prop_bb[2])
-            if self.config['use_difficult'] is not True:
-                # import ipdb
-                # ipdb.set_trace()
-                hard_mask = np.logical_or(blur_mask, occ_mask)
-                hard_mask = np.logical_and(hard_mask, small_mask)
-                invalid_mask = np.logical_or(invalid_mask, hard_mask)
-            # FOR DEBUG, save image size to .prop_label
-            if ww_img == 0:
-                fn_img = self.image_path_from_index(idx)
-                img = cv2.imread(fn_img)
-                prop_data.append('image_size %d %d' % (img.shape[1], img.shape[0]))
-                with open(prop_file, 'w') as fh:
-                    for pdata in prop_data:
-                        fh.write(pdata + '\n')
-                ww_img = img.shape[1]
-                hh_img = img.shape[0]
-
-            invalid_idx = np.where(invalid_mask == True)[0]
-            # bbs = bbs[valid_idx, :]
-            if bbs.size == 0:
-                temp.append(np.empty((0, 6)))
-                continue
-
-            # we need [xmin, ymin, xmax, ymax], but wider DB has [xmin, ymin, width, height]
-            bbs[:, 2] += bbs[:, 0]
-            bbs[:, 3] += bbs[:, 1]
-            # normalize to [0, 1]
-            bbs[:, 0::2] /= ww_img
-            bbs[:, 1::2] /= hh_img
-
-            bbs = np.minimum(np.maximum(bbs, 0.0), 1.0)
-
-            label = np.zeros((bbs.shape[0], 6))
-            label[:, 0] = cls_id
-            label[invalid_idx, 0] = -1
-            label[:, 1:5] = bbs
-            temp.append(label)
-            if label.shape[0] > max_objects:
-                max_objects = label.shape[0]
+            image_file = os.path.join(self.data_path, 'img', names[idx] + self.extension)
+            tasks.append((bb_file, prop_file, image_file, self.classes.index('face'),
+                          self.config['th_small'], self.config['use_difficult']))
+            mtimes.append(file_mtime((bb_file, prop_file)))
+        self._label_mtimes = np.array(mtimes)
+        temp, _ = index_labels(names, _parse_wider_annotation, tasks, self._label_mtimes,
+                               store, self.config['index_workers'])
+        max_objects = max([label.shape[0] for label in temp] + [0])
 
         assert max_objects > 0, "No objects found for any of the images"
         return temp, max_objects
 
     def _pad_labels(self):
-        """ labels: list of ndarrays """
-        self.padding = np.maximum(self.max_objects, self.config['padding'])
-        for (i, label) in enumerate(self.labels):
-            padded = np.tile(np.full((6, ), -1, dtype=np.float32), (self.padding, 1))
-            padded[:label.shape[0], :] = label
-            self.labels[i] = padded
-            assert self.labels[i].shape[0] == self.max_objects
+        """ labels are padded with -1 when they are read from the store """
+        self.padding = int(np.maximum(self.max_objects, self.config['padding']))
+        self._label_store.padding = self.padding
+
+
+def _parse_wider_annotation(task):
+    """
+    labels of an image from its .bb and .prop_label files
+
+    Parameters:
+    ----------
+    task : tuple
+        (bb file, prop file, image file, class id, th_small, use_difficult)
+
+    Returns:
+    ----------
+    numpy.array of [cls_id, xmin, ymin, xmax, ymax, 0], cls_id is -1 for invalid ones
+    """
+    bb_file, prop_file, image_file, cls_id, th_small, use_difficult = task
+    bbs = np.reshape(np.loadtxt(bb_file).astype(float), (-1, 4))
+    if bbs.size == 0:
+        return np.empty((0, 6))
+    ww_img = 0
+    hh_img = 0
+    small_mask = np.maximum(bbs[:, 2], bbs[:, 3]) < th_small
+    # remove bbs that are 1) invalid or 2) too small and occluded.
+    with open(prop_file, 'r') as fh:
+        prop_data = fh.read().splitlines()
+    for pdata in prop_data:
+        prop_bb = pdata.split(' ')
+        if prop_bb[0] == 'invalid_label_list':
+            invalid_mask = np.array(prop_bb[1:]).astype(int) == 1
+        if prop_bb[0] == 'occlusion_label_list':
+            occ_mask = np.array(prop_bb[1:]).astype(int) == 2
+        if prop_bb[0] == 'blur_label_list':
+            blur_mask = np.array(prop_bb[1:]).astype(int) == 2
+        # also get image size
+        if prop_bb[0] == 'image_size':
+            ww_img = int(prop_bb[1])
+            hh_img = int(prop_bb[2])
+    if use_difficult is not True:
+        hard_mask = np.logical_or(blur_mask, occ_mask)
+        hard_mask = np.logical_and(hard_mask, small_mask)
+        invalid_mask = np.logical_or(invalid_mask, hard_mask)
+    if ww_img == 0:
+        # read the size from the image header, decode only if the format is unknown
+        img_size = image_size(image_file)
+        if img_size is None:
+            img = cv2.imread(image_file)
+            img_size = (img.shape[1], img.shape[0])
+        ww_img, hh_img = img_size
+
+    invalid_idx = np.where(invalid_mask == True)[0]
+
+    # we need [xmin, ymin, xmax, ymax], but wider DB has [xmin, ymin, width, height]
+    bbs[:, 2] += bbs[:, 0]
+    bbs[:, 3] += bbs[:, 1]
+    # normalize to [0, 1]
+    bbs[:, 0::2] /= ww_img
+    bbs[:, 1::2] /= hh_img
+
+    bbs = np.minimum(np.maximum(bbs, 0.0), 1.0)
+
+    label = np.zeros((bbs.shape[0], 6))
+    label[:, 0] = cls_id
+    label[invalid_idx, 0] = -1
+    label[:, 1:5] = bbs
+    return label
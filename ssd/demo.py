@@ -7,7 +7,7 @@ from detect.detector import Detector
 from symbol.symbol_factory import get_symbol
 
 def get_detector(net, prefix, epoch, data_shape, mean_pixels, ctx, num_class,
-                 nms_thresh=0.5, force_nms=True, nms_topk=400):
+                 nms_thresh=0.5, force_nms=True, nms_topk=400, batch_size=1):
     """
     wrapper for initialize a detector
 
@@ -31,11 +31,14 @@ def get_detector(net, prefix, epoch, data_shape, mean_pixels, ctx, num_class,
         non-maximum suppression threshold
     force_nms : bool
         force suppress different categories
+    batch_size : int
+        number of images detected together
     """
     if net is not None:
         net = get_symbol(net, data_shape, num_classes=num_class, nms_thresh=nms_thresh,
             force_nms=force_nms, nms_topk=nms_topk)
-    detector = Detector(net, prefix, epoch, data_shape, mean_pixels, ctx=ctx)
+    detector = Detector(net, prefix, epoch, data_shape, mean_pixels,
+                        batch_size=batch_size, ctx=ctx)
     return detector
 
 def parse_args():
@@ -59,6 +62,8 @@ def parse_args():
                         help='GPU device id to detect with')
     parser.add_argument('--data-shape', dest='data_shape', type=int, default=512,
                         help='set image shape')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1,
+                        help='number of images detected together')
     parser.add_argument('--mean-r', dest='mean_r', type=float, default=123,
                         help='red mean value')
     parser.add_argument('--mean-g', dest='mean_g', type=float, default=117,
@@ -118,7 +123,8 @@ if __name__ == '__main__':
     detector = get_detector(network, prefix, args.epoch,
                             args.data_shape,
                             (args.mean_r, args.mean_g, args.mean_b),
-                            ctx, len(class_names), args.nms_thresh, args.force_nms)
+                            ctx, len(class_names), args.nms_thresh, args.force_nms,
+                            batch_size=args.batch_size)
     # run detection
     detector.detect_and_visualize(image_list, args.dir, args.extension,
                                   class_names, args.thresh, args.show_timer)
@@ -7,7 +7,8 @@ from detect.face_detector import FaceDetector
 from symbol.symbol_factory import get_symbol
 
 def get_detector(net, prefix, epoch, data_shape, mean_pixels, ctx, num_class,
-                 nms_thresh=0.5, force_nms=True, nms_topk=400):
+                 nms_thresh=0.5, force_nms=True, nms_topk=400,
+                 batch_size=1, buckets=None, tile_shape=0, tile_overlap=128, scales=(1.0,)):
     """
     wrapper for initialize a detector
 
@@ -31,11 +32,24 @@ def get_detector(net, prefix, epoch, data_shape, mean_pixels, ctx, num_class,
         non-maximum suppression threshold
     force_nms : bool
         force suppress different categories
+    batch_size : int
+        images or tiles per forward pass
+    buckets : list of (int, int) or None
+        padded (height, width) input shapes of bucketed detection
+    tile_shape : int
+        split images into overlapping tiles of this size, 0 to disable
+    tile_overlap : int
+        overlap of neighbouring tiles
+    scales : tuple of float
+        image pyramid scales of tiled detection
     """
     if net is not None:
         net = get_symbol(net, data_shape, num_classes=num_class, nms_thresh=nms_thresh,
             force_nms=force_nms, nms_topk=nms_topk)
-    detector = FaceDetector(net, prefix, epoch, data_shape, mean_pixels, ctx=ctx)
+    detector = FaceDetector(net, prefix, epoch, data_shape, mean_pixels, ctx=ctx,
+                            batch_size=batch_size, buckets=buckets,
+                            tile_hw=tile_shape if tile_shape > 0 else None,
+                            tile_overlap=tile_overlap, scales=scales)
     return detector
 
 def parse_args():
@@ -65,6 +79,16 @@ def parse_args():
                         help='green mean value')
     parser.add_argument('--mean-b', dest='mean_b', type=float, default=104,
                         help='blue mean value')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1,
+                        help='images per forward pass of bucketed detection, or tiles per forward pass of tiled detection')
+    parser.add_argument('--buckets', dest='buckets', type=str, default='',
+                        help='comma separated padded input shapes of bucketed detection, e.g. 384x384,640x640')
+    parser.add_argument('--tile-shape', dest='tile_shape', type=int, default=0,
+                        help='detect large images in overlapping tiles of this size, 0 to disable')
+    parser.add_argument('--tile-overlap', dest='tile_overlap', type=int, default=128,
+                        help='overlap of neighbouring tiles')
+    parser.add_argument('--scales', dest='scales', type=str, default='1.0',
+                        help='comma separated image pyramid scales of tiled detection')
     parser.add_argument('--thresh', dest='thresh', type=float, default=0.5,
                         help='object visualize score threshold, default 0.6')
     parser.add_argument('--nms', dest='nms_thresh', type=float, default=0.35,
@@ -95,6 +119,12 @@ def parse_class_names(class_names):
         raise RuntimeError("No valid class_name provided...")
     return class_names
 
+def parse_buckets(buckets):
+    """ parse comma separated HxW bucket shapes, None if empty """
+    if not buckets:
+        return None
+    return [tuple(int(v) for v in b.strip().split('x')) for b in buckets.split(',')]
+
 if __name__ == '__main__':
     args = parse_args()
     if args.cpu:
@@ -116,7 +146,10 @@ if __name__ == '__main__':
     detector = get_detector(network, prefix, args.epoch,
                             args.data_shape,
                             (args.mean_r, args.mean_g, args.mean_b),
-                            ctx, len(class_names), args.nms_thresh, args.force_nms)
+                            ctx, len(class_names), args.nms_thresh, args.force_nms,
+                            batch_size=args.batch_size, buckets=parse_buckets(args.buckets),
+                            tile_shape=args.tile_shape, tile_overlap=args.tile_overlap,
+                            scales=tuple(float(s) for s in args.scales.split(',')))
     # run detection
     detector.detect_and_visualize(image_list, args.dir, args.extension,
                                   class_names, args.thresh, args.show_timer)
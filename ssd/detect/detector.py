@@ -1,10 +1,13 @@
 from __future__ import print_function
+import os
 import mxnet as mx
 import numpy as np
+import cv2
 from timeit import default_timer as timer
 from config.config import cfg
-from dataset.testdb import TestDB
-from dataset.iterator import DetIter
+from dataset.iterator import _data_augmentation_fused
+from detect.nms import nms
+from detect.topk import topk
 
 class Detector(object):
     """
@@ -35,13 +38,17 @@ class Detector(object):
         load_symbol, args, auxs = mx.model.load_checkpoint(model_prefix, epoch)
         if symbol is None:
             symbol = load_symbol
-        self.mod = mx.mod.Module(symbol, label_names=None, context=ctx)
+        self.mod = mx.mod.Module(symbol, label_names=None, context=self.ctx)
         self.data_shape = data_shape
+        self.batch_size = batch_size
         self.mod.bind(data_shapes=[('data', (batch_size, 3, data_shape, data_shape))])
         self.mod.set_params(args, auxs)
         self.data_shape = data_shape
         self.mean_pixels = mean_pixels
         self.th_nms = cfg.valid['th_nms']
+        self.pre_nms_topk = cfg.valid['pre_nms_topk']
+        self.nms_topk = cfg.valid['nms_topk']
+        self.nms_per_class = cfg.valid['nms_per_class']
 
     def detect(self, det_iter, show_timer=False):
         """
@@ -61,18 +68,94 @@ class Detector(object):
         num_images = det_iter._size
         if not isinstance(det_iter, mx.io.PrefetchingIter):
             det_iter = mx.io.PrefetchingIter(det_iter)
+        det_iter.reset()
         start = timer()
-        detections = self.mod.predict(det_iter).asnumpy()
+        batches = ((batch, self.batch_size - batch.pad) for batch in det_iter)
+        result = list(self._detect_batches(batches))
         time_elapsed = timer() - start
         if show_timer:
             print("Detection time for {} images: {:.4f} sec".format(
                 num_images, time_elapsed))
+        return result
+
+    def detect_stream(self, images, root_dir=None, extension=None):
+        """
+        detect a stream of images with fixed-size batches, results are
+        yielded in order as soon as the batch of an image is done. Images of
+        the next batch are loaded and sent to the device before the detections
+        of the current one are post-processed, and at most two batches are
+        held at a time whatever the number of images.
+
+        Parameters:
+        ----------
+        images : iterable of str or numpy.array
+            image paths, or (height, width, 3) BGR images as read by cv2.imread
+        root_dir : str or None
+            directory of input images, optional if image path already
+            has full directory information
+        extension : str or None
+            image extension, eg. ".jpg", optional
+
+        Returns:
+        ----------
+        generator of detections np.array([id, score, xmin, ymin, xmax, ymax]...)
+        """
+        return self._detect_batches(self._load_batches(images, root_dir, extension))
+
+    def _load_batches(self, images, root_dir, extension):
+        """
+        generator of (batch, number of images in the batch)
+        """
+        batch_data = np.zeros((self.batch_size, 3, self.data_shape, self.data_shape),
+                              dtype=np.float32)
+        n_valid = 0
+        for img in images:
+            if not isinstance(img, np.ndarray):
+                im_path = img + extension if extension else img
+                if root_dir:
+                    im_path = os.path.join(root_dir, im_path)
+                img = cv2.imread(im_path, cv2.IMREAD_COLOR)
+                assert img is not None, 'Failed to read {}'.format(im_path)
+            _data_augmentation_fused(img, None, batch_data[n_valid], self.mean_pixels,
+                                     None, False, False)
+            n_valid += 1
+            if n_valid == self.batch_size:
+                yield mx.io.DataBatch(data=[mx.nd.array(batch_data)], label=None), n_valid
+                n_valid = 0
+        if n_valid > 0:
+            batch_data[n_valid:] = 0
+            yield mx.io.DataBatch(data=[mx.nd.array(batch_data)], label=None), n_valid
+
+    def _detect_batches(self, batches):
+        """
+        forward batches and yield the detections of each image. Forward is
+        asynchronous, so the post-processing of a batch runs while the
+        device computes the next one.
+        """
+        pending = None
+        for batch, n_valid in batches:
+            self.mod.forward(batch, is_train=False)
+            # the copy is queued behind the forward, outputs are reused by the next one
+            out = self.mod.get_outputs()[0].copyto(mx.cpu())
+            if pending is not None:
+                for det in self._postprocess(*pending):
+                    yield det
+            pending = (out, n_valid)
+        if pending is not None:
+            for det in self._postprocess(*pending):
+                yield det
+
+    def _postprocess(self, out, n_valid):
+        """
+        remove invalid detections and apply nms, for the images of a batch
+        """
+        detections = out.asnumpy()
         result = []
-        for i in range(detections.shape[0]):
+        for i in range(n_valid):
             det = detections[i, :, :]
             pidx = np.where(det[:, 0] >= 0)[0]
             det = det[pidx, :]
-            sidx = np.argsort(det[:, 1])[::-1]
+            sidx = topk(det[:, 1], self.pre_nms_topk)
             det = det[sidx, :]
             vidx = self._do_nms(det)
             det = det[vidx, :]
@@ -99,10 +182,15 @@ class Detector(object):
         list of detection results in format [det0, det1...], det is in
         format np.array([id, score, xmin, ymin, xmax, ymax]...)
         """
-        test_db = TestDB(im_list, root_dir=root_dir, extension=extension)
-        test_iter = DetIter(test_db, 1, self.data_shape, self.mean_pixels,
-                            is_train=False)
-        return self.detect(test_iter, show_timer)
+        if not isinstance(im_list, list):
+            im_list = [im_list]
+        start = timer()
+        result = list(self.detect_stream(im_list, root_dir, extension))
+        time_elapsed = timer() - start
+        if show_timer:
+            print("Detection time for {} images: {:.4f} sec".format(
+                len(im_list), time_elapsed))
+        return result
 
     def visualize_detection(self, img, dets, classes=[], thresh=0.6):
         """
@@ -170,7 +258,6 @@ class Detector(object):
         ----------
 
         """
-        import cv2
         dets = self.im_detect(im_list, root_dir, extension, show_timer=show_timer)
         if not isinstance(im_list, list):
             im_list = [im_list]
@@ -181,18 +268,4 @@ class Detector(object):
             self.visualize_detection(img, det, classes, thresh)
 
     def _do_nms(self, dets):
-        #
-        areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
-        vmask = np.ones((dets.shape[0],), dtype=int)
-        vidx = []
-        for i, d in enumerate(dets):
-            if vmask[i] == 0:
-                continue
-            iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
-            ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
-            I = np.maximum(iw, 0) * np.maximum(ih, 0)
-            iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
-            nidx = np.where(iou > self.th_nms)[0] + i
-            vmask[nidx] = 0
-            vidx.append(i)
-        return vidx
+        return nms(dets, self.th_nms, self.nms_topk, self.nms_per_class)
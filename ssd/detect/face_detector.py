@@ -3,6 +3,9 @@ import os
 from timeit import default_timer as timer
 from dataset.testdb import TestDB
 from dataset.face_test_iter import FaceTestIter
+from dataset.face_tile_iter import FaceTileIter
+from detect.nms import nms
+from detect.topk import topk
 # from mutable_module import MutableModule
 import mxnet as mx
 import numpy as np
@@ -23,14 +26,38 @@ class FaceDetector(object):
         input data resize shape
     mean_pixels : tuple of float
         (mean_r, mean_g, mean_b)
-    batch_size : int
-        run detection with batch size
+    img_stride : int
+        input size is padded to a multiple of img_stride
+    th_nms : float
+        overlap threshold of non-maximum suppression
+    pre_nms_topk : int
+        only the pre_nms_topk best candidates of an image go to nms, -1 for all
+    nms_topk : int
+        keep at most nms_topk detections per image, -1 to keep all
+    nms_per_class : bool
+        only suppress detections of the same class
     ctx : mx.ctx
         device to use, if None, use mx.cpu() as default context
+    batch_size : int
+        images per forward pass in bucketed inference
+    buckets : list of (int, int) or None
+        padded (height, width) input shapes of bucketed inference, multiples of
+        img_stride. Each bucket has its own executor, bound once and sharing the
+        parameters and memory of the largest one. If None, the network is
+        reshaped for every image.
+    tile_hw : int or (int, int) or None
+        if not None, images are split into overlapping tiles of this size,
+        batch_size tiles per forward pass, and the detections of all tiles and
+        scales of an image go through one nms
+    tile_overlap : int
+        overlap of neighbouring tiles, in network input pixels
+    scales : tuple of float
+        image pyramid scales of tiled inference
     """
 
     def __init__(self, symbol, model_prefix, epoch, data_hw, mean_pixels,
-                 img_stride=128, th_nms=0.3333, ctx=None):
+                 img_stride=128, th_nms=0.3333, pre_nms_topk=-1, nms_topk=-1, nms_per_class=False,
+                 ctx=None, batch_size=1, buckets=None, tile_hw=None, tile_overlap=128, scales=(1.0,)):
         '''
         '''
         self.ctx = mx.cpu() if not ctx else ctx
@@ -42,13 +69,35 @@ class FaceDetector(object):
 
         _, arg_params, aux_params = mx.model.load_checkpoint(model_prefix, epoch)
 
-        self.mod = mx.mod.Module(symbol, label_names=None, context=ctx)
+        self.mod = mx.mod.Module(symbol, label_names=None, context=self.ctx)
         self.mod.bind(data_shapes=[('data', (1, 3, data_hw[0], data_hw[1]))])
         self.mod.set_params(arg_params, aux_params)
 
+        self.batch_size = batch_size
+        self.buckets = buckets
+        self.bucket_mod = None
+        if buckets:
+            # the largest bucket is bound first, the others share its memory
+            default_key = max([tuple(b) for b in buckets], key=lambda b: b[0] * b[1])
+            self.bucket_mod = mx.mod.BucketingModule(lambda key: (symbol, ('data',), None),
+                                                     default_bucket_key=default_key, context=self.ctx)
+            self.bucket_mod.bind(data_shapes=[('data', (batch_size, 3) + default_key)],
+                                 for_training=False)
+            self.bucket_mod.set_params(arg_params, aux_params)
+
+        if isinstance(tile_hw, int):
+            tile_hw = (tile_hw, tile_hw)
+        self.tile_hw = tile_hw
+        self.tile_overlap = tile_overlap
+        self.scales = scales
+        self.tile_mod = None
+
         self.mean_pixels = mean_pixels
         self.img_stride = img_stride
         self.th_nms = th_nms
+        self.pre_nms_topk = pre_nms_topk
+        self.nms_topk = nms_topk
+        self.nms_per_class = nms_per_class
 
     def detect(self, det_iter, show_timer=False):
         """
@@ -67,36 +116,126 @@ class FaceDetector(object):
         """
         num_images = det_iter._size
 
-        result = []
-        im_paths = []
-        detections = []
+        result = [None] * num_images
+        im_paths = [None] * num_images
         time_elapsed = 0
-        for i, (datum, im_info) in enumerate(det_iter):
-            im_paths.append(im_info['im_path'])
-            self.mod.reshape(data_shapes=datum.provide_data)
-
+        i = 0
+        for datum, im_info in det_iter:
+            if getattr(det_iter, 'buckets', None) is None:
+                im_info = {'im_path': [im_info['im_path']], 'pad_shape': [None], 'index': [i]}
             start = timer()
-            self.mod.forward(datum)
-            out = self.mod.get_outputs()
-            det = out[0][0].asnumpy()
-            pidx = np.where(det[:, 0] >= 0)[0]
-            det = det[pidx, :]
-            sidx = np.argsort(det[:, 1])[::-1]
-            det = det[sidx, :]
-            vidx = self._do_nms(det)
-            det = det[vidx, :]
+            if datum.bucket_key is None:
+                self.mod.reshape(data_shapes=datum.provide_data)
+                self.mod.forward(datum)
+                out = self.mod.get_outputs()
+            else:
+                self.bucket_mod.forward(datum, is_train=False)
+                out = self.bucket_mod.get_outputs()
+            out = out[0].asnumpy()
+            for k, index in enumerate(im_info['index']):
+                result[index] = self._post_process(out[k], im_info['pad_shape'][k])
+                im_paths[index] = im_info['im_path'][k]
             time_elapsed += timer() - start
 
-            result.append(det)
+            for index in im_info['index']:
+                if i % 10 == 0:
+                    n_dets = result[index].shape[0]
+                    print('Processing image {}/{}, {} faces detected.'.format(i+1, num_images, n_dets))
+                i += 1
+        # time_elapsed = timer() - start
+        if show_timer:
+            print("Detection time for {} images: {:.4f} sec".format(num_images, time_elapsed))
+        return result, im_paths
+
+    def detect_tiled(self, tile_iter, show_timer=False):
+        """
+        detect all images in a tiling iterator
+
+        Parameters:
+        ----------
+        tile_iter : FaceTileIter
+            iterator for the tiles of all testing images
+        show_timer : Boolean
+            whether to print out detection exec time
+
+        Returns:
+        ----------
+        list of detection results in original image coordinates
+        """
+        num_images = tile_iter._size
+        mod = self._get_tile_mod(tile_iter.provide_data)
 
+        result = [None] * num_images
+        im_paths = [None] * num_images
+        # detections of the image being tiled, merged when its last tile is done
+        current, pending = None, []
+        time_elapsed = 0
+        for datum, im_info in tile_iter:
+            start = timer()
+            mod.forward(datum, is_train=False)
+            out = mod.get_outputs()[0].asnumpy()
+            for k, tile in enumerate(im_info['tiles']):
+                if tile['index'] != current:
+                    if current is not None:
+                        result[current] = self._suppress(np.vstack(pending))
+                    current, pending = tile['index'], []
+                    im_paths[current] = tile['im_path']
+                pending.append(self._tile_detections(out[k], tile))
+            time_elapsed += timer() - start
+        if current is not None:
+            result[current] = self._suppress(np.vstack(pending))
+
+        for i, det in enumerate(result):
             if i % 10 == 0:
-                n_dets = det.shape[0]
-                print('Processing image {}/{}, {} faces detected.'.format(i+1, num_images, n_dets))
-        # time_elapsed = timer() - start
+                print('Processing image {}/{}, {} faces detected.'.format(i+1, num_images, det.shape[0]))
         if show_timer:
             print("Detection time for {} images: {:.4f} sec".format(num_images, time_elapsed))
         return result, im_paths
 
+    def _get_tile_mod(self, data_shapes):
+        """ module bound to the tile batch shape, sharing the parameters of self.mod """
+        if self.tile_mod is None or self.tile_mod.data_shapes[0].shape != data_shapes[0][1]:
+            arg_params, aux_params = self.mod.get_params()
+            self.tile_mod = mx.mod.Module(self.mod.symbol, label_names=None, context=self.ctx)
+            self.tile_mod.bind(data_shapes=data_shapes, for_training=False)
+            self.tile_mod.set_params(arg_params, aux_params)
+        return self.tile_mod
+
+    def _tile_detections(self, det, tile):
+        """
+        valid detections of a tile, in original image coordinates.
+        Detections in the padding of the tile or centred outside its core are
+        dropped, the neighbouring tile is responsible for them
+        """
+        th, tw = tile['tile_shape']
+        det = det[(det[:, 0] >= 0) & (det[:, 2] < tw) & (det[:, 3] < th)]
+        det = det[topk(det[:, 1], self.pre_nms_topk)]
+        det[:, 2::2] = det[:, 2::2] / tile['scale'][0] + tile['offset'][0]
+        det[:, 3::2] = det[:, 3::2] / tile['scale'][1] + tile['offset'][1]
+        cx = (det[:, 2] + det[:, 4]) * 0.5
+        cy = (det[:, 3] + det[:, 5]) * 0.5
+        x0, y0, x1, y1 = tile['core']
+        return det[(cx >= x0) & (cx < x1) & (cy >= y0) & (cy < y1)]
+
+    def _post_process(self, det, pad_shape=None):
+        """
+        valid detections of an image, top-k candidates and nms.
+        In a bucket, detections centred right or below pad_shape, the shape the
+        image is padded to when it runs alone, are dropped
+        """
+        valid = det[:, 0] >= 0
+        if pad_shape is not None:
+            valid &= ((det[:, 2] + det[:, 4]) * 0.5 < pad_shape[1]) & \
+                    ((det[:, 3] + det[:, 5]) * 0.5 < pad_shape[0])
+        return self._suppress(det[np.where(valid)[0], :])
+
+    def _suppress(self, det):
+        """ top-k candidates and nms """
+        sidx = topk(det[:, 1], self.pre_nms_topk)
+        det = det[sidx, :]
+        vidx = self._do_nms(det)
+        return det[vidx, :]
+
     def im_detect(self,
                   im_list,
                   root_dir=None,
@@ -121,8 +260,14 @@ class FaceDetector(object):
         format np.array([id, score, xmin, ymin, xmax, ymax]...)
         """
         test_db = TestDB(im_list, root_dir=root_dir, extension=extension)
+        if self.tile_hw is not None:
+            tile_iter = FaceTileIter(test_db, tile_hw=self.tile_hw, overlap=self.tile_overlap,
+                    scales=self.scales, batch_size=self.batch_size, mean_pixels=self.mean_pixels,
+                    img_stride=self.img_stride)
+            return self.detect_tiled(tile_iter, show_timer)
         test_iter = FaceTestIter(test_db,
-                mean_pixels=self.mean_pixels, img_stride=self.img_stride)
+                mean_pixels=self.mean_pixels, img_stride=self.img_stride,
+                batch_size=self.batch_size, buckets=self.buckets)
         return self.detect(test_iter, show_timer)
 
     def visualize_detection(self, img, dets, classes=[], thresh=0.6):
@@ -240,21 +385,7 @@ class FaceDetector(object):
     #     return dets
 
     def _do_nms(self, dets):
-        #
-        areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
-        vmask = np.ones((dets.shape[0],), dtype=int)
-        vidx = []
-        for i, d in enumerate(dets):
-            if vmask[i] == 0:
-                continue
-            iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
-            ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
-            I = np.maximum(iw, 0) * np.maximum(ih, 0)
-            iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
-            nidx = np.where(iou > self.th_nms)[0] + i
-            vmask[nidx] = 0
-            vidx.append(i)
-        return vidx
+        return nms(dets, self.th_nms, self.nms_topk, self.nms_per_class)
 
 
     def _comp_overlap(self, dets, im_shape):
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def nms(dets, th_nms, top_k=-1, per_class=False, tile_size=64):
+    """
+    greedy non-maximum suppression, same result as suppressing the tail of
+    the list box by box. Overlaps are computed as a matrix for a tile of the
+    remaining boxes at a time, then the boxes kept in the tile suppress the
+    rest at once and suppressed boxes are dropped
+
+    Parameters:
+    ----------
+    dets : numpy.array
+        (n, 6) detections [id, score, xmin, ymin, xmax, ymax],
+        sorted by score in descending order
+    th_nms : float
+        boxes overlapping a kept box by more than th_nms are suppressed
+    top_k : int
+        stop once top_k boxes are kept, -1 to keep all
+    per_class : bool
+        only suppress boxes of the same class
+    tile_size : int
+        number of boxes handled together
+
+    Returns:
+    ----------
+    list of indices of kept detections
+    """
+    n_dets = dets.shape[0]
+    keep = []
+    if n_dets == 0 or top_k == 0:
+        return keep
+    boxes = [dets[:, k] for k in range(2, 6)]
+    areas = (boxes[2] - boxes[0]) * (boxes[3] - boxes[1])
+    cls_ids = dets[:, 0] if per_class else None
+
+    # remaining boxes in score order, suppressed ones are dropped after each tile
+    order = np.arange(n_dets)
+    while order.size > 0:
+        tile, order = order[:tile_size], order[tile_size:]
+        # greedy suppression inside the tile
+        over = _overlap_matrix(boxes, areas, cls_ids, tile, tile) > th_nms
+        alive = np.ones(tile.size, dtype=bool)
+        kept = []
+        for i in range(tile.size):
+            if not alive[i]:
+                continue
+            kept.append(i)
+            if len(keep) + len(kept) == top_k:
+                return keep + tile[kept].tolist()
+            alive[i + 1:] &= ~over[i, i + 1:]
+        kept = tile[kept]
+        keep += kept.tolist()
+        # boxes kept in the tile suppress the rest
+        if order.size > 0:
+            over = _overlap_matrix(boxes, areas, cls_ids, kept, order) > th_nms
+            order = order[~np.any(over, axis=0)]
+    return keep
+
+
+def _overlap_matrix(boxes, areas, cls_ids, idx_a, idx_b):
+    """
+    (len(idx_a), len(idx_b)) IoU matrix, zero between different classes if cls_ids is given
+    """
+    xmin, ymin, xmax, ymax = [b[idx_a][:, np.newaxis] for b in boxes]
+    iw = np.minimum(xmax, boxes[2][idx_b]) - np.maximum(xmin, boxes[0][idx_b])
+    ih = np.minimum(ymax, boxes[3][idx_b]) - np.maximum(ymin, boxes[1][idx_b])
+    I = np.maximum(iw, 0) * np.maximum(ih, 0)
+    iou = I / np.maximum(areas[idx_b] + areas[idx_a][:, np.newaxis] - I, 1e-08)
+    if cls_ids is not None:
+        iou *= cls_ids[idx_a][:, np.newaxis] == cls_ids[idx_b]
+    return iou
+
+
+def nms_loop(dets, th_nms, top_k=-1, per_class=False):
+    """
+    reference implementation of nms, one box at a time
+    """
+    areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
+    vmask = np.ones((dets.shape[0],), dtype=int)
+    vidx = []
+    for i, d in enumerate(dets):
+        if vmask[i] == 0:
+            continue
+        if len(vidx) == top_k:
+            break
+        iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
+        ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
+        I = np.maximum(iw, 0) * np.maximum(ih, 0)
+        iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
+        if per_class:
+            iou *= dets[i:, 0] == d[0]
+        nidx = np.where(iou > th_nms)[0] + i
+        vmask[nidx] = 0
+        vidx.append(i)
+    return vidx
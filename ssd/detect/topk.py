@@ -0,0 +1,29 @@
+import numpy as np
+
+
+def topk(scores, k=-1):
+    """
+    indices of the k largest scores, from highest to lowest score. Only the
+    k largest scores are sorted, after a partial selection
+
+    Parameters:
+    ----------
+    scores : numpy.array
+        (n,) scores
+    k : int
+        number of indices, -1 to sort all scores
+
+    Returns:
+    ----------
+    numpy.array of min(k, n) indices, equal scores are ordered by index
+    """
+    scores = np.asarray(scores).ravel()
+    if k <= 0 or k >= scores.size:
+        return np.argsort(-scores, kind='mergesort')
+    # k-th largest score, everything above it and enough of the equal ones
+    kth = -np.partition(-scores, k - 1)[k - 1]
+    above = np.where(scores > kth)[0]
+    equal = np.where(scores == kth)[0][:k - above.size]
+    inds = np.hstack((above, equal))
+    inds.sort()
+    return inds[np.argsort(-scores[inds], kind='mergesort')]
@@ -72,6 +72,12 @@ class MApMetric(mx.metric.EvalMetric):
         sum_metric and num_inst are updated in _update() function instead when
         get() is called to return results.
 
+        Each image is handled with array operations: the IoU of every detection
+        with every ground-truth of its class is computed as one matrix, and a
+        detection is a tp if it is the first one, in network output order, whose
+        best match is that ground-truth. Records are the same as those of a
+        per-detection loop, see tools/benchmark_map_metric.py.
+
         Params:
         ----------
         labels: mx.nd.array (n * 6) or (n * 5), difficult column is optional
@@ -79,103 +85,95 @@ class MApMetric(mx.metric.EvalMetric):
         preds: mx.nd.array (m * 6)
             2-d array of detections, m objects(id-score-xmin-ymin-xmax-ymax)
         """
-        def iou(x, ys):
-            """
-            Calculate intersection-over-union overlap
-            Params:
-            ----------
-            x : numpy.array
-                single box [xmin, ymin ,xmax, ymax]
-            ys : numpy.array
-                multiple box [[xmin, ymin, xmax, ymax], [...], ]
-            Returns:
-            -----------
-            numpy.array
-                [iou1, iou2, ...], size == ys.shape[0]
-            """
-            ixmin = np.maximum(ys[:, 0], x[0])
-            iymin = np.maximum(ys[:, 1], x[1])
-            ixmax = np.minimum(ys[:, 2], x[2])
-            iymax = np.minimum(ys[:, 3], x[3])
-            iw = np.maximum(ixmax - ixmin, 0.)
-            ih = np.maximum(iymax - iymin, 0.)
-            inters = iw * ih
-            uni = (x[2] - x[0]) * (x[3] - x[1]) + (ys[:, 2] - ys[:, 0]) * \
-                (ys[:, 3] - ys[:, 1]) - inters
-            ious = inters / uni
-            ious[uni < 1e-12] = 0  # in case bad boxes
-            return ious
-
+        all_labels = labels[0].asnumpy()
+        all_preds = preds[self.pred_idx].asnumpy()
         # independant execution for each image
-        for i in range(labels[0].shape[0]):
-            # get as numpy arrays
-            label = labels[0][i].asnumpy()
-            if np.sum(label[:, 0] >= 0) < 1:
+        for label, pred in zip(all_labels, all_preds):
+            gt_cls = label[:, 0].astype(int)
+            if np.sum(gt_cls >= 0) < 1:
                 continue
-            pred = preds[self.pred_idx][i].asnumpy()
-            # calculate for each class
-            while (pred.shape[0] > 0):
-                cid = int(pred[0, 0])
-                indices = np.where(pred[:, 0].astype(int) == cid)[0]
-                if cid < 0:
-                    pred = np.delete(pred, indices, axis=0)
-                    continue
-                dets = pred[indices]
-                pred = np.delete(pred, indices, axis=0)
-                # sort by score, desceding
-                dets[dets[:,1].argsort()[::-1]]
-                records = np.hstack((dets[:, 1][:, np.newaxis], np.zeros((dets.shape[0], 1))))
-                # ground-truths
-                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
-                gts = label[label_indices, :]
-                label = np.delete(label, label_indices, axis=0)
-                if gts.size > 0:
-                    found = [False] * gts.shape[0]
-                    for j in range(dets.shape[0]):
-                        # compute overlaps
-                        ious = iou(dets[j, 2:], gts[:, 1:5])
-                        ovargmax = np.argmax(ious)
-                        ovmax = ious[ovargmax]
-                        if ovmax > self.ovp_thresh:
-                            if (not self.use_difficult and
-                                gts.shape[1] >= 6 and
-                                gts[ovargmax, 5] > 0):
-                                pass
-                            else:
-                                if not found[ovargmax]:
-                                    records[j, -1] = 1  # tp
-                                    found[ovargmax] = True
-                                else:
-                                    # duplicate
-                                    records[j, -1] = 2  # fp
-                        else:
-                            records[j, -1] = 2 # fp
-                else:
-                    # no gt, mark all fp
-                    records[:, -1] = 2
+            cls = pred[:, 0].astype(int)
+            valid = np.where(cls >= 0)[0]
+            pred, cls = pred[valid], cls[valid]
 
-                # ground truth count
-                if (not self.use_difficult and gts.shape[1] >= 6):
-                    gt_count = np.sum(gts[:, 5] < 1)
-                else:
-                    gt_count = gts.shape[0]
+            # ground-truths ignored if matched, and count of the others per class
+            use_difficult = self.use_difficult or label.shape[1] < 6
+            if use_difficult:
+                ignore = np.zeros(gt_cls.shape, dtype=bool)
+            else:
+                ignore = label[:, 5] > 0
+            gt_valid = gt_cls >= 0
+            num_cls = max(gt_cls.max(), cls.max() if cls.size > 0 else 0) + 1
+            gt_total = np.bincount(gt_cls[gt_valid], minlength=num_cls)
+            if use_difficult:
+                gt_count = gt_total
+            else:
+                gt_count = np.bincount(gt_cls[gt_valid & (label[:, 5] < 1)], minlength=num_cls)
 
-                # now we push records to buffer
-                # first column: score, second column: tp/fp
+            if pred.shape[0] > 0:
+                # best ground-truth of the same class for each detection
+                ious = self._iou_matrix(pred[:, 2:6], label[:, 1:5])
+                ious[cls[:, np.newaxis] != gt_cls[np.newaxis, :]] = -1
+                ovargmax = np.argmax(ious, axis=1)
+                ovmax = ious[np.arange(ious.shape[0]), ovargmax]
                 # 0: not set(matched to difficult or something), 1: tp, 2: fp
-                records = records[np.where(records[:, -1] > 0)[0], :]
-                if records.size > 0:
-                    self._insert(cid, records, gt_count)
+                status = np.where(ovmax > self.ovp_thresh, 0, 2)
+                matched = np.where((status == 0) & ~ignore[ovargmax])[0]
+                status[matched] = 2
+                _, first = np.unique(ovargmax[matched], return_index=True)
+                status[matched[first]] = 1
+                records = np.hstack((pred[:, 1][:, np.newaxis], status[:, np.newaxis].astype(np.float64)))
+
+                # group by class, keeping output order within a class,
+                # classes are inserted in order of first appearance
+                order = np.argsort(cls, kind='mergesort')
+                bounds = np.where(np.diff(cls[order]) != 0)[0] + 1
+                groups = np.split(order, bounds)
+                groups.sort(key=lambda g: g[0])
+                for group in groups:
+                    cid = cls[group[0]]
+                    rec = records[group]
+                    rec = rec[rec[:, -1] > 0]
+                    if rec.size > 0:
+                        self._insert(int(cid), rec, gt_count[cid])
 
             # add missing class if not present in prediction
-            while (label.shape[0] > 0):
-                cid = int(label[0, 0])
-                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
-                label = np.delete(label, label_indices, axis=0)
-                if cid < 0:
-                    continue
-                gt_count = label_indices.size
-                self._insert(cid, np.array([[0, 0]]), gt_count)
+            missing = np.where(gt_valid & ~np.in1d(gt_cls, cls))[0]
+            _, first = np.unique(gt_cls[missing], return_index=True)
+            for cid in gt_cls[missing[np.sort(first)]]:
+                self._insert(int(cid), np.array([[0, 0]]), gt_total[cid])
+
+    @staticmethod
+    def _iou_matrix(dets, gts):
+        """
+        Calculate intersection-over-union overlap of every pair, with the same
+        operations as a per-detection iou
+
+        Params:
+        ----------
+        dets : numpy.array
+            (m, 4) boxes [xmin, ymin, xmax, ymax]
+        gts : numpy.array
+            (n, 4) boxes [xmin, ymin, xmax, ymax]
+        Returns:
+        -----------
+        numpy.array
+            (m, n) overlaps
+        """
+        x = [dets[:, k][:, np.newaxis] for k in range(4)]
+        ixmin = np.maximum(gts[:, 0], x[0])
+        iymin = np.maximum(gts[:, 1], x[1])
+        ixmax = np.minimum(gts[:, 2], x[2])
+        iymax = np.minimum(gts[:, 3], x[3])
+        iw = np.maximum(ixmax - ixmin, 0.)
+        ih = np.maximum(iymax - iymin, 0.)
+        inters = iw * ih
+        uni = (x[2] - x[0]) * (x[3] - x[1]) + (gts[:, 2] - gts[:, 0]) * \
+            (gts[:, 3] - gts[:, 1]) - inters
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = inters / uni
+        ious[uni < 1e-12] = 0  # in case bad boxes
+        return ious
 
     def _update(self):
         """ update num_inst and sum_metric """
@@ -4,6 +4,7 @@ given a pascal voc imdb, compute mAP
 from __future__ import print_function
 import numpy as np
 import os
+from dataset.parallel_index import parallel_map
 try:
     import cPickle as pickle
 except ImportError:
@@ -66,17 +67,13 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
-def voc_eval(detpath, annopath, imageset_file, classname, cache_dir, ovthresh=0.5, use_07_metric=False):
+def load_voc_recs(annopath, imageset_file, cache_dir):
     """
-    pascal voc evaluation
-    :param detpath: detection results detpath.format(classname)
+    read the images of an imageset and their annotations
     :param annopath: annotations annopath.format(classname)
     :param imageset_file: text file containing list of images
-    :param classname: category name
     :param cache_dir: caching annotations
-    :param ovthresh: overlap threshold
-    :param use_07_metric: whether to use voc07's 11 point ap computation
-    :return: rec, prec, ap
+    :return: image names, dict of image name to list of object dicts
     """
     if not os.path.isdir(cache_dir):
         os.mkdir(cache_dir)
@@ -98,6 +95,22 @@ def voc_eval(detpath, annopath, imageset_file, classname, cache_dir, ovthresh=0.
     else:
         with open(cache_file, 'rb') as f:
             recs = pickle.load(f)
+    return image_filenames, recs
+
+
+def voc_eval(detpath, annopath, imageset_file, classname, cache_dir, ovthresh=0.5, use_07_metric=False):
+    """
+    pascal voc evaluation
+    :param detpath: detection results detpath.format(classname)
+    :param annopath: annotations annopath.format(classname)
+    :param imageset_file: text file containing list of images
+    :param classname: category name
+    :param cache_dir: caching annotations
+    :param ovthresh: overlap threshold
+    :param use_07_metric: whether to use voc07's 11 point ap computation
+    :return: rec, prec, ap
+    """
+    image_filenames, recs = load_voc_recs(annopath, imageset_file, cache_dir)
 
     # extract objects in :param classname:
     class_recs = {}
@@ -177,3 +190,124 @@ def voc_eval(detpath, annopath, imageset_file, classname, cache_dir, ovthresh=0.
     ap = voc_ap(rec, prec, use_07_metric)
 
     return rec, prec, ap
+
+
+def voc_eval_all(detections, image_filenames, recs, classnames, ovthresh=0.5, use_07_metric=False,
+                 num_workers=1):
+    """
+    pascal voc evaluation of all classes in one pass, gives the rec, prec and ap
+    of voc_eval on the same detections. Annotations are gathered once into
+    arrays, then for each class the overlaps of every detection with the gts of
+    its image are computed at once and the first detection taking a gt is a tp.
+    :param detections: per class (image indices, scores, boxes) in the order of
+        the detection file, image indices into image_filenames, None to skip a class
+    :param image_filenames: images of the imageset
+    :param recs: annotations, as returned by load_voc_recs
+    :param classnames: class names of detections
+    :param ovthresh: overlap threshold
+    :param use_07_metric: whether to use voc07's 11 point ap computation
+    :param num_workers: number of processes the classes are evaluated in, 0 or 1 to run in this process
+    :return: list of (rec, prec, ap), None for skipped classes
+    """
+    gt_image, gt_class, gt_boxes, gt_difficult = _gt_arrays(image_filenames, recs, classnames)
+    tasks = []
+    for cls_ind, dets in enumerate(detections):
+        if dets is None:
+            continue
+        keep = gt_class == cls_ind
+        tasks.append((cls_ind, dets, gt_image[keep], gt_boxes[keep], gt_difficult[keep],
+                      len(image_filenames), ovthresh, use_07_metric))
+    results = parallel_map(_eval_class, tasks, num_workers, chunksize=1)
+
+    res = [None] * len(detections)
+    for task, result in zip(tasks, results):
+        res[task[0]] = result
+    return res
+
+
+def _gt_arrays(image_filenames, recs, classnames):
+    """
+    annotations of all images as arrays, ordered by image then annotation
+    :return: image index, class index (-1 for other classes), boxes, difficult flags
+    """
+    cls_inds = dict(zip(classnames, range(len(classnames))))
+    objects = [(ind, obj) for ind, image_filename in enumerate(image_filenames) for obj in recs[image_filename]]
+    gt_image = np.array([ind for ind, _ in objects], dtype=np.int64)
+    gt_class = np.array([cls_inds.get(obj['name'], -1) for _, obj in objects], dtype=np.int64)
+    gt_boxes = np.array([obj['bbox'] for _, obj in objects], dtype=np.float64).reshape((-1, 4))
+    gt_difficult = np.array([obj['difficult'] for _, obj in objects], dtype=bool)
+    return gt_image, gt_class, gt_boxes, gt_difficult
+
+
+def _eval_class(task):
+    """
+    rec, prec and ap of one class, with the same operations as voc_eval
+    """
+    _, (image_inds, confidence, bbox), gt_image, gt_boxes, gt_difficult, num_images, ovthresh, use_07_metric = task
+    npos = int(np.sum(~gt_difficult))
+    gt_count = np.bincount(gt_image, minlength=num_images)
+    gt_start = np.cumsum(gt_count) - gt_count
+
+    # sort by confidence
+    sorted_inds = np.argsort(-confidence)
+    image_inds = image_inds[sorted_inds]
+    bbox = bbox[sorted_inds, :].astype(float)
+
+    # all (detection, gt of the same image) pairs
+    nd = len(image_inds)
+    count = gt_count[image_inds]
+    ends = np.cumsum(count)
+    pair_det = np.repeat(np.arange(nd), count)
+    pair_gt = np.repeat(gt_start[image_inds], count) + np.arange(ends[-1] if nd > 0 else 0) - \
+        np.repeat(ends - count, count)
+    bb = bbox[pair_det]
+    bbgt = gt_boxes[pair_gt]
+
+    # intersection
+    ixmin = np.maximum(bbgt[:, 0], bb[:, 0])
+    iymin = np.maximum(bbgt[:, 1], bb[:, 1])
+    ixmax = np.minimum(bbgt[:, 2], bb[:, 2])
+    iymax = np.minimum(bbgt[:, 3], bb[:, 3])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+
+    # union
+    uni = ((bb[:, 2] - bb[:, 0] + 1.) * (bb[:, 3] - bb[:, 1] + 1.) +
+           (bbgt[:, 2] - bbgt[:, 0] + 1.) *
+           (bbgt[:, 3] - bbgt[:, 1] + 1.) - inters)
+    overlaps = inters / uni
+
+    # best gt of each detection, the first one on ties
+    ovmax = np.empty((nd,))
+    ovmax.fill(-np.inf)
+    jmax = np.zeros((nd,), dtype=np.int64)
+    has_gt = count > 0
+    if np.any(has_gt):
+        ovmax[has_gt] = np.maximum.reduceat(overlaps, (ends - count)[has_gt])
+        is_max = np.where(overlaps == ovmax[pair_det])[0]
+        dets, first = np.unique(pair_det[is_max], return_index=True)
+        jmax[dets] = pair_gt[is_max[first]]
+
+    # mark true positives and false positives, a gt is taken by its first
+    # detection and detections on difficult gts are neither. Without gts of
+    # the class no detection is over the threshold, all are false positives
+    over = ovmax > ovthresh
+    tp = np.zeros(nd)
+    fp = (~over).astype(float)
+    matched = np.where(over)[0]
+    matched = matched[~gt_difficult[jmax[matched]]]
+    _, first = np.unique(jmax[matched], return_index=True)
+    fp[matched] = 1.
+    fp[matched[first]] = 0.
+    tp[matched[first]] = 1.
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid division by zero in case first detection matches a difficult ground ruth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+
+    return rec, prec, ap
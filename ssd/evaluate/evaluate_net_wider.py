@@ -14,7 +14,7 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
                  model_prefix, epoch, ctx=mx.cpu(), batch_size=1,
                  nms_thresh=0.45, force_nms=False,
                  ovp_thresh=0.5, use_difficult=False,
-                 voc07_metric=False):
+                 voc07_metric=False, buckets=None):
     """
     evalute network given validation record file
 
@@ -39,7 +39,7 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
     ctx : mx.ctx
         mx.gpu() or mx.cpu()
     batch_size : int
-        validation batch size
+        validation batch size, more than 1 needs buckets
     nms_thresh : float
         non-maximum suppression threshold
     force_nms : boolean
@@ -52,6 +52,10 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
         class names in string, must correspond to num_classes if set
     voc07_metric : boolean
         whether to use 11-point evluation as in VOC07 competition
+    buckets : list of (int, int) or None
+        padded (height, width) input shapes, multiples of 128. Images are
+        batched by bucket and each bucket is bound once, images larger than
+        every bucket run alone. If None, the network is reshaped for every image
     """
     # set up logger
     logging.basicConfig()
@@ -68,7 +72,8 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
     model_prefix += '_' + str(data_shape[1])
 
     # iterator
-    eval_iter = FaceTestIter(imdb, mean_pixels, img_stride=128)
+    eval_iter = FaceTestIter(imdb, mean_pixels=mean_pixels, img_stride=128,
+                             batch_size=batch_size, buckets=buckets)
     # model params
     load_net, args, auxs = mx.model.load_checkpoint(model_prefix, epoch)
     # network
@@ -77,15 +82,27 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
     else:
         net = get_symbol(net, data_shape[1], num_classes=num_classes,
             nms_thresh=nms_thresh, force_suppress=force_nms)
+    det_net = net
     if not 'label' in net.list_arguments():
         label = mx.sym.Variable(name='label')
         net = mx.sym.Group([net, label])
 
     # init module
-    mod = mx.mod.Module(net, label_names=('label',), logger=logger, context=ctx,
-        fixed_param_names=net.list_arguments())
-    mod.bind(data_shapes=eval_iter.provide_data, label_shapes=eval_iter.provide_label)
-    mod.set_params(args, auxs, allow_missing=False, force_init=True)
+    if buckets:
+        # labels go to the metric directly, so their shape never changes an executor
+        bucket_mod = mx.mod.BucketingModule(lambda key: (det_net, ('data',), None),
+            default_bucket_key=eval_iter.default_bucket_key, logger=logger, context=ctx)
+        bucket_mod.bind(data_shapes=eval_iter.provide_data, for_training=False)
+        bucket_mod.set_params(args, auxs, allow_missing=False, force_init=True)
+        # images larger than every bucket
+        mod = mx.mod.Module(det_net, label_names=None, logger=logger, context=ctx)
+        mod.bind(data_shapes=[('data', (1, 3) + eval_iter.default_bucket_key)], for_training=False)
+        mod.set_params(args, auxs, allow_missing=False, force_init=True)
+    else:
+        mod = mx.mod.Module(net, label_names=('label',), logger=logger, context=ctx,
+            fixed_param_names=net.list_arguments())
+        mod.bind(data_shapes=eval_iter.provide_data, label_shapes=eval_iter.provide_label)
+        mod.set_params(args, auxs, allow_missing=False, force_init=True)
 
     # run evaluation
     if voc07_metric:
@@ -95,6 +112,11 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
 
     results = []
     for i, (datum, im_info) in enumerate(eval_iter):
+        if buckets:
+            _update_bucket(metric, mod, bucket_mod, datum, im_info)
+            if i % 10 == 0:
+                print('processed {} batches.'.format(i))
+            continue
         mod.reshape(data_shapes=datum.provide_data, label_shapes=datum.provide_label)
         mod.forward(datum)
 
@@ -108,9 +130,35 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
 
         if i % 10 == 0:
             print('processed {} images.'.format(i))
-        if i == 10:
-            break
 
     results = metric.get_name_value()
     for k, v in results:
         print("{}: {}".format(k, v))
+
+
+def _update_bucket(metric, mod, bucket_mod, datum, im_info):
+    """
+    forward a batch of FaceTestIter with buckets and update the metric with
+    its images. Images larger than every bucket are reshaped into mod. Padding
+    slots are left out, and so are detections centred beyond the shape an
+    image is padded to when it runs alone
+    """
+    # the modules take no labels, new buckets must not be bound with them
+    data_batch = mx.io.DataBatch(datum.data, provide_data=datum.provide_data,
+                                 pad=datum.pad, bucket_key=datum.bucket_key)
+    if datum.bucket_key is None:
+        mod.reshape(data_shapes=datum.provide_data)
+        mod.forward(data_batch, is_train=False)
+        preds = mod.get_outputs()[0].asnumpy()
+    else:
+        bucket_mod.forward(data_batch, is_train=False)
+        preds = bucket_mod.get_outputs()[0].asnumpy()
+    n = datum.data[0].shape[0] - datum.pad
+    labels = datum.label[0].asnumpy()[:n]
+    preds = preds[:n]
+    for k, ((sy, sx, _), (pad_h, pad_w)) in enumerate(zip(im_info['im_shape'], im_info['pad_shape'])):
+        labels[k, :, 1:5] *= (sx, sy, sx, sy)
+        cx = (preds[k, :, 2] + preds[k, :, 4]) * 0.5
+        cy = (preds[k, :, 3] + preds[k, :, 5]) * 0.5
+        preds[k, (cx >= pad_w) | (cy >= pad_h), 0] = -1
+    metric.update([mx.nd.array(labels)], [mx.nd.array(preds)])
@@ -4,6 +4,7 @@ import mxnet as mx
 import os
 import sys
 from evaluate.evaluate_net_wider import evaluate_net
+from demo_face import parse_buckets
 from dataset.dataset_loader import load_pascal, load_wider #, load_pascal_patch
 
 def parse_args():
@@ -32,6 +33,10 @@ def parse_args():
                         help='green mean value')
     parser.add_argument('--mean-b', dest='mean_b', type=float, default=104,
                         help='blue mean value')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1,
+                        help='images per forward pass, more than 1 needs buckets')
+    parser.add_argument('--buckets', dest='buckets', type=str, default='',
+                        help='comma separated padded input shapes of bucketed evaluation, e.g. 384x384,640x640')
     parser.add_argument('--nms', dest='nms_thresh', type=float, default=0.35,
                         help='non-maximum suppression threshold')
     parser.add_argument('--overlap', dest='overlap_thresh', type=float, default=0.5,
@@ -68,4 +73,5 @@ if __name__ == '__main__':
                  nms_thresh=args.nms_thresh,
                  force_nms=args.force_nms, ovp_thresh=args.overlap_thresh,
                  use_difficult=args.use_difficult,
-                 voc07_metric=args.use_voc07_metric)
+                 voc07_metric=args.use_voc07_metric,
+                 batch_size=args.batch_size, buckets=parse_buckets(args.buckets))
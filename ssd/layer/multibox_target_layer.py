@@ -12,7 +12,7 @@ class MultiBoxTarget(mx.operator.CustomOp):
     Python implementation of MultiBoxTarget layer.
     """
     def __init__(self, th_iou, th_iou_neg, th_nms_neg, th_small, square_bb,
-            reg_sample_ratio, hard_neg_ratio, variances):
+            reg_sample_ratio, hard_neg_ratio, variances, match_mode='vectorized'):
         #
         super(MultiBoxTarget, self).__init__()
         self.th_iou = th_iou
@@ -21,9 +21,15 @@ class MultiBoxTarget(mx.operator.CustomOp):
         self.reg_sample_ratio = reg_sample_ratio
         self.hard_neg_ratio = hard_neg_ratio
         self.variances = variances
+        self.variances_nd = None
+        self.match_mode = match_mode
+        # upper bound of iou entries computed at once by the vectorized matching
+        self.max_match_elems = 1 << 20
 
         # precompute nms candidates
         self.anchors = None
+        self.anchors_ct = None
+        self.area_anchors = None
         self.nidx_neg = None
         self.anchors_t = None
         self.area_anchors_t = None
@@ -41,6 +47,13 @@ class MultiBoxTarget(mx.operator.CustomOp):
         # outputs: ['target_reg', 'mask_reg', 'target_cls']
         n_batch, nch, n_anchors = in_data[2].shape
 
+        if self.match_mode == 'ndarray':
+            # stay on the input context, no host round trip
+            outputs = self._forward_ndarray(in_data[0], in_data[1], in_data[2])
+            for i, out in enumerate(outputs):
+                self.assign(out_data[i], req[i], out)
+            return
+
         labels_all = in_data[1].asnumpy().astype(np.float32) # (batch, num_label, 6)
         labels_all = labels_all[:, :, :5]
         max_cids = mx.nd.argmax( \
@@ -51,6 +64,9 @@ class MultiBoxTarget(mx.operator.CustomOp):
         # precompute some data
         if self.anchors_t is None:
             self.anchors = np.reshape(in_data[0].asnumpy(), (-1, 4)) # (n_anchor, 4)
+            self.anchors_ct = np.ascontiguousarray(self.anchors.T) # (4, n_anchor)
+            self.area_anchors = \
+                    (self.anchors_ct[2] - self.anchors_ct[0]) * (self.anchors_ct[3] - self.anchors_ct[1])
             self.anchors_t = mx.nd.transpose(mx.nd.reshape(in_data[0].copy(), shape=(-1, 4)), (1, 0)) # (4, n_anchor)
             self.area_anchors_t = \
                     (self.anchors_t[2] - self.anchors_t[0]) * (self.anchors_t[3] - self.anchors_t[1])
@@ -61,11 +77,40 @@ class MultiBoxTarget(mx.operator.CustomOp):
         else:
             assert self.anchors.shape == in_data[0].shape[1:]
 
+        if self.match_mode == 'vectorized':
+            target_reg, mask_reg, target_cls, match_info = \
+                    self._forward_vectorized(labels_all, max_cids, probs_bg_cls)
+        else:
+            target_reg, mask_reg, target_cls, match_info = \
+                    self._forward_loop(labels_all, max_cids, probs_bg_cls)
+
+        target_reg = np.reshape(target_reg, (n_batch, -1))
+        mask_reg = np.reshape(mask_reg, (n_batch, -1))
+
+        self.assign(out_data[0], req[0], mx.nd.array(target_reg, ctx=in_data[2].context))
+        self.assign(out_data[1], req[1], mx.nd.array(mask_reg, ctx=in_data[2].context))
+        self.assign(out_data[2], req[2], mx.nd.array(target_cls, ctx=in_data[2].context))
+        self.assign(out_data[3], req[3], mx.nd.array(match_info, ctx=in_data[2].context))
+
+    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        '''
+        Pass the gradient to their corresponding positions
+        '''
+        for i, r in enumerate(req):
+            self.assign(in_grad[i], r, 0)
+
+    def _forward_loop(self, labels_all, max_cids, probs_bg_cls):
+        '''
+        Reference implementation, matches labels of each image one by one.
+        '''
+        n_batch, n_label = labels_all.shape[:2]
+        n_anchors = self.anchors.shape[0]
+
         # output numpy arrays
         target_reg = np.zeros((n_batch, n_anchors, 4), dtype=np.float32)
         mask_reg = np.zeros_like(target_reg)
         target_cls = np.full((n_batch, 1, n_anchors), -1, dtype=np.float32)
-        match_info = np.full((n_batch, in_data[1].shape[1], 50), -1)
+        match_info = np.full((n_batch, n_label, 50), -1)
 
         max_iou_pos = []
 
@@ -79,20 +124,241 @@ class MultiBoxTarget(mx.operator.CustomOp):
             target_cls[i][0] = self._forward_batch_neg( \
                     probs_bg_cls[i], max_iou_pos[i], target_cls[i][0])
 
-        target_reg = np.reshape(target_reg, (n_batch, -1))
-        mask_reg = np.reshape(mask_reg, (n_batch, -1))
+        return target_reg, mask_reg, target_cls, match_info
 
-        self.assign(out_data[0], req[0], mx.nd.array(target_reg, ctx=in_data[2].context))
-        self.assign(out_data[1], req[1], mx.nd.array(mask_reg, ctx=in_data[2].context))
-        self.assign(out_data[2], req[2], mx.nd.array(target_cls, ctx=in_data[2].context))
-        self.assign(out_data[3], req[3], mx.nd.array(match_info, ctx=in_data[2].context))
+    def _forward_vectorized(self, labels_all, max_cids, probs_bg_cls):
+        '''
+        Same matching as _forward_loop, but over (n_batch, n_label, n_anchor)
+        IOU tensors instead of one label at a time.
+        The batch is split into chunks of at most max_match_elems IOU entries
+        so that the temporaries stay small.
+        '''
+        n_batch, n_label = labels_all.shape[:2]
+        n_anchors = self.anchors.shape[0]
 
-    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        target_reg = np.zeros((n_batch, n_anchors, 4), dtype=np.float32)
+        mask_reg = np.zeros_like(target_reg)
+        target_cls = np.full((n_batch, n_anchors), -1, dtype=np.float32)
+        match_info = np.full((n_batch, n_label, 50), -1)
+        max_iou = np.zeros((n_batch, n_anchors), dtype=np.float32)
+
+        # labels after the first padded one are ignored, as in _get_valid_labels
+        n_valid = np.sum(_get_valid_mask(labels_all), axis=1)
+        n_chunk = max(1, self.max_match_elems // max(1, n_anchors * max(1, np.max(n_valid))))
+        for s in range(0, n_batch, n_chunk):
+            e = min(s + n_chunk, n_batch)
+            n_gt = int(np.max(n_valid[s:e]))
+            if n_gt == 0:
+                continue
+            self._match_chunk(labels_all[s:e, :n_gt], n_valid[s:e], max_cids[s:e],
+                    target_reg[s:e], mask_reg[s:e], target_cls[s:e], match_info[s:e], max_iou[s:e])
+
+        target_cls = self._forward_neg_vectorized(probs_bg_cls, max_iou, target_cls)
+        return target_reg, mask_reg, np.reshape(target_cls, (n_batch, 1, n_anchors)), match_info
+
+    def _match_chunk(self, labels, n_valid, max_cids,
+            target_reg, mask_reg, target_cls, match_info, max_iou):
         '''
-        Pass the gradient to their corresponding positions
+        Positive and regression sample assignment for a chunk of images.
+        labels: (n_batch, n_gt, 5), max_cids: (n_batch, n_anchor)
+        Outputs are written in place.
+
+        A label overwrites the targets of the previous labels, so for every anchor
+        the last label that marks it as positive (or regression) sample wins.
         '''
-        for i, r in enumerate(req):
-            self.assign(in_grad[i], r, 0)
+        n_batch, n_gt = labels.shape[:2]
+        valid = np.arange(n_gt)[np.newaxis, :] < n_valid[:, np.newaxis]
+
+        if self.square_bb:
+            boxes = np.reshape(_fit_box_ratio(np.reshape(labels[:, :, 1:], (-1, 4)), 0.8), \
+                    (n_batch, n_gt, 4))
+        else:
+            boxes = labels[:, :, 1:]
+        iou = _compute_iou_batch(boxes, self.anchors_ct, self.area_anchors)
+        iou[np.logical_not(valid)] = 0
+
+        # an anchor is available to a label only if no previous label has higher iou
+        iou_mask = np.empty(iou.shape, dtype=bool)
+        for i in range(n_gt):
+            np.greater(iou[:, i], max_iou, out=iou_mask[:, i])
+            np.maximum(max_iou, iou[:, i], out=max_iou)
+
+        gt_cls = labels[:, :, 0].astype(int) + 1
+        gt_sz = np.maximum(labels[:, :, 3] - labels[:, :, 1], labels[:, :, 4] - labels[:, :, 2])
+        is_small = np.logical_and(gt_sz < self.th_small, np.max(iou, axis=2) < self.th_iou_neg)
+        active = valid & (labels[:, :, 0] != -1) & np.logical_not(is_small)
+        # from here on iou only decides samples of the remaining labels
+        iou[np.logical_not(active)] = 0
+
+        # positive samples, at least one per label
+        pos = iou > self.th_iou
+        pos &= iou_mask
+        bidx, gidx = np.where(active & np.logical_not(np.any(pos, axis=2)))
+        if len(bidx) > 0:
+            pos[bidx, gidx, np.argmax(iou[bidx, gidx], axis=1)] = True
+
+        # regression samples, anchors predicting the same class
+        reg = iou > self.th_iou_neg
+        reg &= iou_mask
+        reg &= (max_cids[:, np.newaxis, :] == gt_cls[:, :, np.newaxis])
+        reg |= pos
+        del iou, iou_mask
+
+        # class targets
+        bidx, aidx = np.where(np.any(pos, axis=1))
+        pos = pos[bidx, :, aidx] # (n_pos_anchor, n_gt)
+        target_cls[bidx, aidx] = gt_cls[bidx, _last_true(pos)]
+
+        # first 50 positive anchors of each label
+        pidx, gidx = np.where(pos)
+        if len(pidx) > 0:
+            bidx, aidx = bidx[pidx], aidx[pidx]
+            sidx = np.lexsort((aidx, gidx, bidx))
+            bidx, gidx, aidx = bidx[sidx], gidx[sidx], aidx[sidx]
+            key = bidx * n_gt + gidx
+            sidx = np.r_[0, np.where(np.diff(key) != 0)[0] + 1]
+            rank = np.arange(len(key)) - np.repeat(sidx, np.diff(np.r_[sidx, len(key)]))
+            rmask = rank < 50
+            match_info[bidx[rmask], gidx[rmask], rank[rmask]] = aidx[rmask]
+
+        # regression targets
+        bidx, aidx = np.where(np.any(reg, axis=1))
+        gidx = _last_true(reg[bidx, :, aidx])
+        rt, rm = _compute_loc_target(labels[bidx, gidx, 1:], self.anchors[aidx, :], self.variances)
+        target_reg[bidx, aidx, :] = rt
+        mask_reg[bidx, aidx, :] = rm
+
+    def _forward_neg_vectorized(self, probs_bg_cls, max_iou, target_cls):
+        '''
+        Batch version of _forward_batch_neg.
+        target_cls: (n_batch, n_anchor)
+        '''
+        # mask for negative sampling region
+        rmask = np.logical_or(max_iou > self.th_iou_neg, target_cls > 0)
+
+        # no hard negative sampling case
+        if self.hard_neg_ratio <= 0:
+            target_cls[rmask == False] = 0
+            return target_cls
+
+        # greedy nms between negative samples is sequential by nature
+        if self.th_nms_neg < 1.0:
+            for i in range(target_cls.shape[0]):
+                target_cls[i] = self._forward_batch_neg(probs_bg_cls[i], max_iou[i], target_cls[i])
+            return target_cls
+
+        # first remove positive samples from mining
+        bg_probs = probs_bg_cls.copy()
+        bg_probs[rmask] = -1.0
+
+        # number of hard samples
+        n_neg_sample = (np.sum(target_cls > 0, axis=1) * self.hard_neg_ratio).astype(int)
+        n_neg_sample = np.maximum(n_neg_sample, 1)
+
+        # pick the hardest samples of each image
+        eidx = np.argsort(bg_probs, axis=1)[:, ::-1]
+        sel = np.arange(eidx.shape[1])[np.newaxis, :] < n_neg_sample[:, np.newaxis]
+        target_cls[np.where(sel)[0], eidx[sel]] = 0
+        return target_cls
+
+    def _forward_ndarray(self, anchors, labels_all, probs_cls):
+        '''
+        Same matching as _forward_vectorized, written with NDArray operations only
+        so that the op does not block on device-host copies.
+        Ties between background probabilities in hard negative mining
+        may be broken differently from the numpy implementations.
+        Meant for gpu contexts, on cpu match_mode='vectorized' is faster.
+        '''
+        n_batch, n_label = labels_all.shape[:2]
+        n_anchors = probs_cls.shape[2]
+        ctx = probs_cls.context
+
+        anchors = mx.nd.reshape(anchors, (1, 1, -1, 4)) # (1, 1, n_anchor, 4)
+        labels = mx.nd.slice_axis(labels_all, axis=2, begin=0, end=5) # (n_batch, n_label, 5)
+        gt_cls = mx.nd.slice_axis(labels, axis=2, begin=0, end=1) + 1 # (n_batch, n_label, 1)
+        gt_bb = mx.nd.slice_axis(labels, axis=2, begin=1, end=5)
+
+        # labels after the first padded one are ignored, as in _get_valid_labels
+        is_pad = mx.nd.min(labels == -1.0, axis=2, keepdims=True)
+        valid = 1 - _cummax_nd(is_pad)
+
+        boxes = _fit_box_ratio_nd(gt_bb, 0.8) if self.square_bb else gt_bb
+        iou = _compute_iou_nd(boxes, anchors) * valid # (n_batch, n_label, n_anchor)
+
+        # an anchor is available to a label only if no previous label has higher iou
+        max_prev = _cummax_nd(iou)
+        max_iou = mx.nd.slice_axis(max_prev, axis=1, begin=n_label-1, end=n_label)
+        iou_mask = iou > _shift_nd(max_prev, 1)
+
+        gt_sz = mx.nd.maximum( \
+                mx.nd.slice_axis(gt_bb, axis=2, begin=2, end=3) - mx.nd.slice_axis(gt_bb, axis=2, begin=0, end=1),
+                mx.nd.slice_axis(gt_bb, axis=2, begin=3, end=4) - mx.nd.slice_axis(gt_bb, axis=2, begin=1, end=2))
+        is_small = (gt_sz < self.th_small) * (mx.nd.max(iou, axis=2, keepdims=True) < self.th_iou_neg)
+        active = valid * (gt_cls != 0) * (1 - is_small) # (n_batch, n_label, 1)
+        iou = mx.nd.broadcast_mul(iou, active)
+
+        # positive samples, at least one per label
+        pos = iou_mask * (iou > self.th_iou)
+        no_pos = active * (mx.nd.max(pos, axis=2, keepdims=True) == 0)
+        pos = mx.nd.maximum(pos, mx.nd.broadcast_mul(no_pos, \
+                mx.nd.one_hot(mx.nd.argmax(iou, axis=2), n_anchors)))
+
+        # regression samples, anchors predicting the same class
+        max_cids = mx.nd.argmax( \
+                mx.nd.slice_axis(probs_cls, axis=1, begin=1, end=None), axis=1, keepdims=True) + 1
+        reg = iou_mask * (iou > self.th_iou_neg) * (1 - pos)
+        reg = reg * mx.nd.broadcast_equal(max_cids, gt_cls)
+        reg = mx.nd.maximum(reg, pos)
+
+        # the last label marking an anchor wins, as labels overwrite each other
+        order = mx.nd.reshape(mx.nd.arange(1, n_label + 1, ctx=ctx), (1, -1, 1))
+        offset = mx.nd.reshape(mx.nd.arange(0, n_batch * n_label, n_label, ctx=ctx), (-1, 1))
+        gidx_pos = mx.nd.max(mx.nd.broadcast_mul(pos, order), axis=1) # (n_batch, n_anchor)
+        gidx_reg = mx.nd.max(mx.nd.broadcast_mul(reg, order), axis=1)
+
+        # class targets
+        cls = mx.nd.take(mx.nd.reshape(gt_cls, (-1,)),
+                mx.nd.broadcast_add(mx.nd.maximum(gidx_pos - 1, 0), offset))
+        target_cls = mx.nd.where(gidx_pos > 0, cls, mx.nd.full(cls.shape, -1, ctx=ctx))
+
+        # regression targets
+        reg_bb = mx.nd.take(mx.nd.reshape(gt_bb, (-1, 4)),
+                mx.nd.broadcast_add(mx.nd.maximum(gidx_reg - 1, 0), offset)) # (n_batch, n_anchor, 4)
+        if self.variances_nd is None or self.variances_nd.context != ctx:
+            self.variances_nd = mx.nd.array(self.variances, ctx=ctx)
+        loc_target = _compute_loc_target_nd(reg_bb, mx.nd.reshape(anchors, (1, -1, 4)),
+                self.variances_nd)
+        has_reg = mx.nd.broadcast_to(mx.nd.expand_dims(gidx_reg > 0, axis=2), loc_target.shape)
+        target_reg = mx.nd.where(has_reg, loc_target, mx.nd.zeros_like(loc_target))
+        mask_reg = has_reg
+
+        # first 50 positive anchors of each label
+        n_match = min(50, n_anchors)
+        rev_aidx = mx.nd.reshape(mx.nd.arange(n_anchors, 0, -1, ctx=ctx), (1, 1, -1))
+        vals, aidx = mx.nd.topk(mx.nd.broadcast_mul(pos, rev_aidx), axis=2, k=n_match, ret_typ='both')
+        match_info = mx.nd.where(vals > 0, aidx, -mx.nd.ones_like(aidx))
+        if n_match < 50:
+            match_info = mx.nd.concat(match_info, \
+                    mx.nd.full((n_batch, n_label, 50 - n_match), -1, ctx=ctx), dim=2)
+
+        # negative samples
+        max_iou = mx.nd.reshape(max_iou, (n_batch, -1))
+        rmask = mx.nd.maximum(max_iou > self.th_iou_neg, target_cls > 0)
+        if self.hard_neg_ratio <= 0:
+            target_cls = mx.nd.where(rmask, target_cls, mx.nd.zeros_like(target_cls))
+        else:
+            bg_probs = 1 - mx.nd.reshape( \
+                    mx.nd.slice_axis(probs_cls, axis=1, begin=0, end=1), (n_batch, -1))
+            bg_probs = mx.nd.where(rmask, -mx.nd.ones_like(bg_probs), bg_probs)
+            n_neg_sample = mx.nd.floor(mx.nd.sum(target_cls > 0, axis=1, keepdims=True) * self.hard_neg_ratio)
+            n_neg_sample = mx.nd.maximum(n_neg_sample, 1)
+            # rank of each anchor in descending order of bg_probs
+            rank = mx.nd.argsort(mx.nd.argsort(bg_probs, axis=1, is_ascend=False), axis=1)
+            target_cls = mx.nd.where(mx.nd.broadcast_lesser(rank, n_neg_sample),
+                    mx.nd.zeros_like(target_cls), target_cls)
+
+        return mx.nd.reshape(target_reg, (n_batch, -1)), mx.nd.reshape(mask_reg, (n_batch, -1)), \
+                mx.nd.reshape(target_cls, (n_batch, 1, -1)), match_info
 
     def _forward_batch_pos(self, labels, max_cids, target_cls, target_reg, mask_reg):
         '''
@@ -214,6 +480,21 @@ def _get_valid_labels(labels):
         n_valid_label += 1
     return labels[:n_valid_label, :]
 
+def _get_valid_mask(labels_all):
+    '''
+    labels_all: (n_batch, n_label, 5)
+    returns (n_batch, n_label) mask, True before the first padded label of each image.
+    '''
+    not_pad = np.logical_not(np.all(labels_all == -1.0, axis=2))
+    return np.cumprod(not_pad, axis=1).astype(bool)
+
+def _last_true(mask):
+    '''
+    mask: (n, m), every row has at least one True.
+    returns the column index of the last True in each row.
+    '''
+    return mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+
 def _compute_nms_cands(anc, anchors_t, area_anchors_t, th_nms):
     #
     sf = 192.0 / (anc[3] - anc[1])
@@ -237,6 +518,62 @@ def _compute_iou(label, anchors_t, area_anchors_t):
     iou = I / mx.nd.maximum((U - I), 1e-08)
     return iou.asnumpy() # (num_anchors, )
 
+def _compute_iou_batch(boxes, anchors_t, area_anchors):
+    '''
+    boxes: (n_batch, n_label, 4)
+    anchors_t: (4, n_anchor)
+    area_anchors: (n_anchor, )
+    returns (n_batch, n_label, n_anchor) iou, same arithmetic as _compute_iou.
+    '''
+    iw = np.minimum(boxes[:, :, 2:3], anchors_t[2])
+    iw -= np.maximum(boxes[:, :, 0:1], anchors_t[0])
+    ih = np.minimum(boxes[:, :, 3:4], anchors_t[3])
+    ih -= np.maximum(boxes[:, :, 1:2], anchors_t[1])
+    I = np.maximum(iw, 0, out=iw)
+    I *= np.maximum(ih, 0, out=ih)
+    U = np.add((boxes[:, :, 3:4] - boxes[:, :, 1:2]) * (boxes[:, :, 2:3] - boxes[:, :, 0:1]), \
+            area_anchors, out=ih)
+    U -= I
+    I /= np.maximum(U, 1e-08, out=U)
+    return I
+
+def _compute_iou_nd(boxes, anchors):
+    '''
+    boxes: (n_batch, n_label, 4)
+    anchors: (1, 1, n_anchor, 4)
+    returns (n_batch, n_label, n_anchor) iou NDArray.
+    '''
+    boxes = mx.nd.expand_dims(boxes, axis=2)
+    b0, b1, b2, b3 = [mx.nd.slice_axis(boxes, axis=3, begin=i, end=i+1) for i in range(4)]
+    a0, a1, a2, a3 = [mx.nd.slice_axis(anchors, axis=3, begin=i, end=i+1) for i in range(4)]
+    iw = mx.nd.broadcast_minimum(b2, a2) - mx.nd.broadcast_maximum(b0, a0)
+    ih = mx.nd.broadcast_minimum(b3, a3) - mx.nd.broadcast_maximum(b1, a1)
+    I = mx.nd.maximum(iw, 0) * mx.nd.maximum(ih, 0)
+    U = mx.nd.broadcast_add((b3 - b1) * (b2 - b0), (a2 - a0) * (a3 - a1))
+    iou = I / mx.nd.maximum((U - I), 1e-08)
+    return mx.nd.reshape(iou, (0, 0, -1))
+
+def _cummax_nd(x):
+    '''
+    Inclusive running max along axis 1 of a 3D NDArray with non-negative values,
+    in log2(n) shifted max steps.
+    '''
+    k = 1
+    while k < x.shape[1]:
+        x = mx.nd.maximum(x, _shift_nd(x, k))
+        k *= 2
+    return x
+
+def _shift_nd(x, k):
+    '''
+    Shift a 3D NDArray by k along axis 1, filling with zeros.
+    '''
+    n_batch, n, m = x.shape
+    zeros = mx.nd.zeros((n_batch, min(k, n), m), ctx=x.context)
+    if k >= n:
+        return zeros
+    return mx.nd.concat(zeros, mx.nd.slice_axis(x, axis=1, begin=0, end=n-k), dim=1)
+
 def _compute_overlap(anchors_t, area_anchors_t, img_shape):
     #
     iw = mx.nd.minimum(img_shape[2], anchors_t[2]) - mx.nd.maximum(img_shape[0], anchors_t[0])
@@ -246,15 +583,36 @@ def _compute_overlap(anchors_t, area_anchors_t, img_shape):
     return overlap.asnumpy()
 
 def _compute_loc_target(gt_bb, bb, variances):
+    '''
+    gt_bb: (4, ) or (n_bb, 4)
+    bb: (n_bb, 4)
+    '''
     loc_target = np.zeros_like(bb)
     aw = (bb[:, 2] - bb[:, 0])
     ah = (bb[:, 3] - bb[:, 1])
-    loc_target[:, 0] = ((gt_bb[2] + gt_bb[0]) - (bb[:, 2] + bb[:, 0])) * 0.5 / aw
-    loc_target[:, 1] = ((gt_bb[3] + gt_bb[1]) - (bb[:, 3] + bb[:, 1])) * 0.5 / ah
-    loc_target[:, 2] = np.log((gt_bb[2] - gt_bb[0]) / aw)
-    loc_target[:, 3] = np.log((gt_bb[3] - gt_bb[1]) / ah)
+    loc_target[:, 0] = ((gt_bb[..., 2] + gt_bb[..., 0]) - (bb[:, 2] + bb[:, 0])) * 0.5 / aw
+    loc_target[:, 1] = ((gt_bb[..., 3] + gt_bb[..., 1]) - (bb[:, 3] + bb[:, 1])) * 0.5 / ah
+    loc_target[:, 2] = np.log((gt_bb[..., 2] - gt_bb[..., 0]) / aw)
+    loc_target[:, 3] = np.log((gt_bb[..., 3] - gt_bb[..., 1]) / ah)
     return loc_target / variances, np.ones_like(loc_target)
 
+def _compute_loc_target_nd(gt_bb, bb, variances):
+    '''
+    gt_bb: (n_batch, n_anchor, 4) NDArray
+    bb: (1, n_anchor, 4) NDArray
+    variances: (1, 4) NDArray
+    '''
+    g0, g1, g2, g3 = [mx.nd.slice_axis(gt_bb, axis=2, begin=i, end=i+1) for i in range(4)]
+    b0, b1, b2, b3 = [mx.nd.slice_axis(bb, axis=2, begin=i, end=i+1) for i in range(4)]
+    aw = b2 - b0
+    ah = b3 - b1
+    loc_target = mx.nd.concat( \
+            mx.nd.broadcast_div(mx.nd.broadcast_sub(g2 + g0, b2 + b0) * 0.5, aw),
+            mx.nd.broadcast_div(mx.nd.broadcast_sub(g3 + g1, b3 + b1) * 0.5, ah),
+            mx.nd.log(mx.nd.broadcast_div(g2 - g0, aw)),
+            mx.nd.log(mx.nd.broadcast_div(g3 - g1, ah)), dim=2)
+    return mx.nd.broadcast_div(loc_target, mx.nd.reshape(variances, (1, 1, 4)))
+
 def _rescale_anchor(anchors_t, sf):
     ranc = anchors_t.copy()
     ranc[0] = (ranc[0] + ranc[2]) * 0.5
@@ -283,6 +641,17 @@ def _fit_box_ratio(bb, ratio):
         res = res.ravel()
     return res
 
+def _fit_box_ratio_nd(bb, ratio):
+    '''
+    NDArray version of _fit_box_ratio, bb: (..., 4)
+    '''
+    ax = len(bb.shape) - 1
+    b0, b1, b2, b3 = [mx.nd.slice_axis(bb, axis=ax, begin=i, end=i+1) for i in range(4)]
+    cx = (b0 + b2) / 2.0
+    cy = (b1 + b3) / 2.0
+    sz2 = mx.nd.maximum(b2 - b0, b3 - b1) / 2.0
+    return mx.nd.concat(cx - sz2 * ratio, cy - sz2, cx + sz2 * ratio, cy + sz2, dim=ax)
+
 # def _expand_target(loc_target, cid, n_cls):
 #     n_target = loc_target.shape[0]
 #     loc_target_e = np.zeros((n_target, 4 * n_cls), dtype=np.float32)
@@ -302,7 +671,7 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
             th_iou=0.5, th_iou_neg=0.35, th_nms_neg=1.0,
             th_small=0.04, square_bb=False,
             reg_sample_ratio=1.0, hard_neg_ratio=3.0,
-            variances=(0.1, 0.1, 0.2, 0.2)):
+            variances=(0.1, 0.1, 0.2, 0.2), match_mode='vectorized'):
         #
         super(MultiBoxTargetProp, self).__init__(need_top_grad=False)
         self.th_iou = float(th_iou)
@@ -315,6 +684,11 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
         if isinstance(variances, str):
             variances = make_tuple(variances)
         self.variances = np.reshape(np.array(variances), (1, -1))
+        self.match_mode = str(match_mode)
+        assert self.match_mode in ('vectorized', 'loop', 'ndarray'), \
+                'Unknown match_mode {}'.format(self.match_mode)
+        assert self.match_mode != 'ndarray' or self.th_nms_neg >= 1.0, \
+                'match_mode=ndarray does not support nms between negative samples'
 
     def list_arguments(self):
         return ['anchors', 'label', 'probs_cls']
@@ -338,4 +712,4 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
                 self.th_iou, self.th_iou_neg, self.th_nms_neg,
                 self.th_small, self.square_bb,
                 self.reg_sample_ratio, self.hard_neg_ratio,
-                self.variances)
+                self.variances, self.match_mode)
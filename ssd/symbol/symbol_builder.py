@@ -94,7 +94,8 @@ def get_symbol_train(network, num_classes, from_layers, num_filters, strides, pa
         cls_probs = mx.sym.SoftmaxActivation(cls_preds, mode='channel')
         tmp = mx.sym.Custom(*[anchor_boxes, label, cls_probs], name='multibox_target',
                 op_type='multibox_target',
-                hard_neg_ratio=neg_ratio, th_small=th_small, square_bb=square_bb)
+                hard_neg_ratio=neg_ratio, th_small=th_small, square_bb=square_bb,
+                match_mode=cfg.train['multibox_match_mode'])
     else:
         neg_ratio = -1 if use_focal_loss else 3
         tmp = mx.contrib.symbol.MultiBoxTarget(
@@ -0,0 +1,183 @@
+from __future__ import print_function
+import sys, os
+import argparse
+import time
+curr_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(curr_path, '..'))
+import mxnet as mx
+import numpy as np
+from evaluate.eval_metric import MApMetric
+
+
+class LoopMApMetric(MApMetric):
+    """ MApMetric with the per-detection loop update it was vectorized from """
+
+    def update(self, labels, preds):
+        """
+        MApMetric.update one detection at a time
+
+        Params:
+        ----------
+        labels: mx.nd.array (n * 6) or (n * 5), difficult column is optional
+            2-d array of ground-truths, n objects(id-xmin-ymin-xmax-ymax-[difficult])
+        preds: mx.nd.array (m * 6)
+            2-d array of detections, m objects(id-score-xmin-ymin-xmax-ymax)
+        """
+        def iou(x, ys):
+            """
+            Calculate intersection-over-union overlap
+            Params:
+            ----------
+            x : numpy.array
+                single box [xmin, ymin ,xmax, ymax]
+            ys : numpy.array
+                multiple box [[xmin, ymin, xmax, ymax], [...], ]
+            Returns:
+            -----------
+            numpy.array
+                [iou1, iou2, ...], size == ys.shape[0]
+            """
+            ixmin = np.maximum(ys[:, 0], x[0])
+            iymin = np.maximum(ys[:, 1], x[1])
+            ixmax = np.minimum(ys[:, 2], x[2])
+            iymax = np.minimum(ys[:, 3], x[3])
+            iw = np.maximum(ixmax - ixmin, 0.)
+            ih = np.maximum(iymax - iymin, 0.)
+            inters = iw * ih
+            uni = (x[2] - x[0]) * (x[3] - x[1]) + (ys[:, 2] - ys[:, 0]) * \
+                (ys[:, 3] - ys[:, 1]) - inters
+            ious = inters / uni
+            ious[uni < 1e-12] = 0  # in case bad boxes
+            return ious
+
+        # independant execution for each image
+        for i in range(labels[0].shape[0]):
+            # get as numpy arrays
+            label = labels[0][i].asnumpy()
+            if np.sum(label[:, 0] >= 0) < 1:
+                continue
+            pred = preds[self.pred_idx][i].asnumpy()
+            # calculate for each class
+            while (pred.shape[0] > 0):
+                cid = int(pred[0, 0])
+                indices = np.where(pred[:, 0].astype(int) == cid)[0]
+                if cid < 0:
+                    pred = np.delete(pred, indices, axis=0)
+                    continue
+                dets = pred[indices]
+                pred = np.delete(pred, indices, axis=0)
+                # sort by score, desceding
+                dets[dets[:,1].argsort()[::-1]]
+                records = np.hstack((dets[:, 1][:, np.newaxis], np.zeros((dets.shape[0], 1))))
+                # ground-truths
+                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
+                gts = label[label_indices, :]
+                label = np.delete(label, label_indices, axis=0)
+                if gts.size > 0:
+                    found = [False] * gts.shape[0]
+                    for j in range(dets.shape[0]):
+                        # compute overlaps
+                        ious = iou(dets[j, 2:], gts[:, 1:5])
+                        ovargmax = np.argmax(ious)
+                        ovmax = ious[ovargmax]
+                        if ovmax > self.ovp_thresh:
+                            if (not self.use_difficult and
+                                gts.shape[1] >= 6 and
+                                gts[ovargmax, 5] > 0):
+                                pass
+                            else:
+                                if not found[ovargmax]:
+                                    records[j, -1] = 1  # tp
+                                    found[ovargmax] = True
+                                else:
+                                    # duplicate
+                                    records[j, -1] = 2  # fp
+                        else:
+                            records[j, -1] = 2 # fp
+                else:
+                    # no gt, mark all fp
+                    records[:, -1] = 2
+
+                # ground truth count
+                if (not self.use_difficult and gts.shape[1] >= 6):
+                    gt_count = np.sum(gts[:, 5] < 1)
+                else:
+                    gt_count = gts.shape[0]
+
+                # now we push records to buffer
+                # first column: score, second column: tp/fp
+                # 0: not set(matched to difficult or something), 1: tp, 2: fp
+                records = records[np.where(records[:, -1] > 0)[0], :]
+                if records.size > 0:
+                    self._insert(cid, records, gt_count)
+
+            # add missing class if not present in prediction
+            while (label.shape[0] > 0):
+                cid = int(label[0, 0])
+                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
+                label = np.delete(label, label_indices, axis=0)
+                if cid < 0:
+                    continue
+                gt_count = label_indices.size
+                self._insert(cid, np.array([[0, 0]]), gt_count)
+
+
+def make_batch(n_img, n_dets, n_gts, n_class, rng):
+    """ random ground-truths with difficult flags and detections around them, padded with -1 """
+    labels = -np.ones((n_img, n_gts, 6), dtype=np.float32)
+    preds = -np.ones((n_img, n_dets, 6), dtype=np.float32)
+    for i in range(n_img):
+        m = rng.randint(0, n_gts + 1)
+        xy = rng.uniform(0, 0.9, (m, 2))
+        wh = rng.uniform(0.01, 0.2, (m, 2))
+        labels[i, :m, 0] = rng.randint(0, n_class, m)
+        labels[i, :m, 1:3] = xy
+        labels[i, :m, 3:5] = xy + wh
+        labels[i, :m, 5] = rng.uniform(0, 1, m) < 0.2
+        k = rng.randint(0, n_dets + 1)
+        preds[i, :k, 0] = rng.randint(-1, n_class, k)
+        preds[i, :k, 1] = rng.uniform(0, 1, k)
+        if m > 0:
+            obj = rng.randint(0, m, k)
+            box = labels[i, obj, 1:5]
+            preds[i, :k, 2:6] = box + rng.normal(0, 0.02, (k, 4))
+    return [mx.nd.array(labels)], [mx.nd.array(preds)]
+
+def run(metric, batches):
+    metric.reset()
+    tic = time.time()
+    for labels, preds in batches:
+        metric.update(labels, preds)
+    return (time.time() - tic) / len(batches)
+
+def same_records(a, b):
+    return list(a.records.keys()) == list(b.records.keys()) and a.counts == b.counts and \
+        all(np.array_equal(a.records[k], b.records[k]) for k in a.records)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark MApMetric.update against the per-detection loop')
+    parser.add_argument('--num-dets', dest='num_dets', type=str, default='10,100,400',
+                        help='comma separated numbers of detections per image')
+    parser.add_argument('--num-gts', dest='num_gts', type=int, default=50)
+    parser.add_argument('--num-class', dest='num_class', type=int, default=1)
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=32)
+    parser.add_argument('--num-batches', dest='num_batches', type=int, default=3)
+    parser.add_argument('--use-difficult', dest='use_difficult', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    ref_metric = LoopMApMetric(use_difficult=args.use_difficult)
+    metric = MApMetric(use_difficult=args.use_difficult)
+    print('{:>8s} {:>12s} {:>14s} {:>8s} {:>6s}'.format(
+        'dets', 'loop (ms)', 'update (ms)', 'speedup', 'same'))
+    for n_dets in [int(n) for n in args.num_dets.split(',')]:
+        batches = [make_batch(args.batch_size, n_dets, args.num_gts, args.num_class, rng)
+                   for _ in range(args.num_batches)]
+        t_loop = run(ref_metric, batches)
+        t_vec = run(metric, batches)
+        print('{:>8d} {:>12.2f} {:>14.2f} {:>8.1f} {:>6s}'.format(
+            n_dets, t_loop * 1000.0, t_vec * 1000.0, t_loop / t_vec,
+            str(same_records(ref_metric, metric))))
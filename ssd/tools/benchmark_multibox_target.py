@@ -0,0 +1,94 @@
+from __future__ import print_function
+import sys, os
+import argparse
+import time
+curr_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(curr_path, '..'))
+import numpy as np
+import mxnet as mx
+from layer.multibox_target_layer import MultiBoxTarget
+
+
+def make_anchors(n_anchor, rng):
+    """ random square-ish anchors inside the unit image """
+    ctr = rng.uniform(0, 1, (n_anchor, 2))
+    sz = np.exp(rng.uniform(np.log(0.01), np.log(0.8), (n_anchor, 1)))
+    sz = np.hstack((sz, sz * rng.uniform(0.8, 1.25, (n_anchor, 1)))) * 0.5
+    anchors = np.hstack((ctr - sz, ctr + sz)).astype(np.float32)
+    return np.reshape(anchors, (1, -1, 4))
+
+def make_labels(batch_size, max_label, n_class, rng):
+    """ random gt boxes, padded with -1 like DetIter does """
+    labels = np.full((batch_size, max_label, 6), -1, dtype=np.float32)
+    for i in range(batch_size):
+        n_label = rng.randint(1, max_label + 1)
+        ctr = rng.uniform(0.05, 0.95, (n_label, 2))
+        sz = np.exp(rng.uniform(np.log(0.01), np.log(0.5), (n_label, 2))) * 0.5
+        labels[i, :n_label, 0] = rng.randint(0, n_class, n_label)
+        labels[i, :n_label, 1:3] = np.maximum(ctr - sz, 0)
+        labels[i, :n_label, 3:5] = np.minimum(ctr + sz, 1)
+        labels[i, :n_label, 5] = 0
+    return labels
+
+def make_probs(batch_size, n_class, n_anchor, rng):
+    probs = rng.uniform(0, 1, (batch_size, n_class + 1, n_anchor)).astype(np.float32)
+    return probs / np.sum(probs, axis=1, keepdims=True)
+
+def run_op(op, in_data, out_shapes, n_iter):
+    """ call forward of the custom op directly, returns outputs and mean time """
+    out_data = [mx.nd.zeros(s) for s in out_shapes]
+    req = ['write'] * len(out_data)
+    op.forward(True, req, in_data, out_data, [])
+    mx.nd.waitall()
+    tic = time.time()
+    for _ in range(n_iter):
+        op.forward(True, req, in_data, out_data, [])
+    mx.nd.waitall()
+    return [o.asnumpy() for o in out_data], (time.time() - tic) / n_iter
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark MultiBoxTarget matching modes')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=16)
+    parser.add_argument('--num-anchor', dest='num_anchor', type=int, default=32768)
+    parser.add_argument('--max-label', dest='max_label', type=int, default=100,
+                        help='maximum number of gt boxes per image')
+    parser.add_argument('--num-class', dest='num_class', type=int, default=1)
+    parser.add_argument('--hard-neg-ratio', dest='hard_neg_ratio', type=float, default=3.0)
+    parser.add_argument('--square-bb', dest='square_bb', action='store_true')
+    parser.add_argument('--num-iter', dest='num_iter', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', type=str, default='loop,vectorized,ndarray',
+                        help='match modes to compare, the first one is the reference')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+
+    anchors = make_anchors(args.num_anchor, rng)
+    labels = make_labels(args.batch_size, args.max_label, args.num_class, rng)
+    probs = make_probs(args.batch_size, args.num_class, args.num_anchor, rng)
+    in_data = [mx.nd.array(anchors), mx.nd.array(labels), mx.nd.array(probs)]
+    out_shapes = [(args.batch_size, args.num_anchor * 4), (args.batch_size, args.num_anchor * 4),
+                  (args.batch_size, 1, args.num_anchor), (args.batch_size, args.max_label, 50)]
+
+    variances = np.reshape(np.array((0.1, 0.1, 0.2, 0.2)), (1, -1))
+    modes = [m.strip() for m in args.modes.split(',')]
+    results = {}
+    for mode in modes:
+        op = MultiBoxTarget(0.5, 0.35, 1.0, 0.04, args.square_bb, 1, args.hard_neg_ratio,
+                            variances, match_mode=mode)
+        results[mode] = run_op(op, in_data, out_shapes, args.num_iter)
+        print('{:>10s}: {:.2f} ms / batch'.format(mode, results[mode][1] * 1000.0))
+
+    names = ['target_reg', 'mask_reg', 'target_cls', 'match_info']
+    ref = modes[0]
+    for mode in modes[1:]:
+        print('{} vs {}: speedup {:.1f}x'.format(mode, ref, results[ref][1] / results[mode][1]))
+        for name, a, b in zip(names, results[ref][0], results[mode][0]):
+            if np.array_equal(a, b):
+                res = 'identical'
+            else:
+                valid = np.isfinite(a) & np.isfinite(b)
+                res = 'max abs diff {:g}'.format(np.max(np.abs(a[valid] - b[valid])))
+            print('{:>12s}: {}'.format(name, res))
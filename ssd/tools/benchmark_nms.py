@@ -0,0 +1,56 @@
+from __future__ import print_function
+import sys, os
+import argparse
+import time
+curr_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(curr_path, '..'))
+import numpy as np
+from detect.nms import nms, nms_loop
+
+
+def make_dets(n_dets, n_class, rng):
+    """ random clustered boxes like low threshold face candidates, sorted by score """
+    n_obj = max(1, n_dets // 20)
+    ctr = rng.uniform(0, 1000, (n_obj, 2))
+    sz = np.exp(rng.uniform(np.log(8), np.log(200), (n_obj, 1)))
+    obj = rng.randint(0, n_obj, n_dets)
+    jitter = rng.normal(0, 0.15, (n_dets, 4)) * sz[obj]
+    dets = np.zeros((n_dets, 6), dtype=np.float32)
+    dets[:, 0] = rng.randint(0, n_class, n_dets)
+    dets[:, 1] = rng.uniform(0, 1, n_dets)
+    dets[:, 2:4] = ctr[obj] - sz[obj] * 0.5 + jitter[:, :2]
+    dets[:, 4:6] = ctr[obj] + sz[obj] * 0.5 + jitter[:, 2:]
+    return dets[np.argsort(dets[:, 1])[::-1]]
+
+def run(func, dets, n_iter, **kwargs):
+    res = func(dets, **kwargs)
+    tic = time.time()
+    for _ in range(n_iter):
+        func(dets, **kwargs)
+    return res, (time.time() - tic) / n_iter
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark nms against number of candidates')
+    parser.add_argument('--num-dets', dest='num_dets', type=str, default='100,1000,3000,10000',
+                        help='comma separated numbers of candidates')
+    parser.add_argument('--num-class', dest='num_class', type=int, default=1)
+    parser.add_argument('--th-nms', dest='th_nms', type=float, default=0.35)
+    parser.add_argument('--top-k', dest='top_k', type=int, default=-1)
+    parser.add_argument('--per-class', dest='per_class', action='store_true')
+    parser.add_argument('--num-iter', dest='num_iter', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    kwargs = {'th_nms': args.th_nms, 'top_k': args.top_k, 'per_class': args.per_class}
+    print('{:>8s} {:>8s} {:>12s} {:>12s} {:>8s} {:>6s}'.format(
+        'dets', 'kept', 'loop (ms)', 'tiled (ms)', 'speedup', 'same'))
+    for n_dets in [int(n) for n in args.num_dets.split(',')]:
+        dets = make_dets(n_dets, args.num_class, rng)
+        ref, t_loop = run(nms_loop, dets, args.num_iter, **kwargs)
+        res, t_tiled = run(nms, dets, args.num_iter, **kwargs)
+        print('{:>8d} {:>8d} {:>12.2f} {:>12.2f} {:>8.1f} {:>6s}'.format(
+            n_dets, len(res), t_loop * 1000.0, t_tiled * 1000.0, t_loop / t_tiled,
+            str(list(ref) == list(res))))
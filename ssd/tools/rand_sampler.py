@@ -78,6 +78,9 @@ class RandCropper(RandSampler):
         generate random cropping boxes according to parameters
         if satifactory crops generated, apply to ground-truth as well
 
+        All trial boxes are drawn at once and checked against all ground-truths
+        together, the first max_sample satisfactory ones are used
+
         Parameters:
         ----------
         label : numpy.array (n x 5 matrix)
@@ -87,92 +90,79 @@ class RandCropper(RandSampler):
         ----------
         list of (crop_box, label) tuples, if failed, return empty list []
         """
+        valid_mask = np.where(label[:, 0] > -1)[0]
+        gt = label[valid_mask, :]
+        if gt.shape[0] == 0 or self.max_sample == 0:
+            return []
+        rand_boxes = self._generate_boxes(self.max_trials)
+        ious = self._compute_ious(rand_boxes, gt)
+        satisfied = np.where(self._check_satisfy(rand_boxes, gt, ious))[0]
         samples = []
-        count = 0
-        for trial in range(self.max_trials):
-            if count >= self.max_sample:
-                return samples
-            scale = np.random.uniform(self.min_scale, self.max_scale)
-            min_ratio = max(self.min_aspect_ratio, scale * scale)
-            max_ratio = min(self.max_aspect_ratio, 1. / scale / scale)
-            ratio = math.sqrt(np.random.uniform(min_ratio, max_ratio))
-            width = scale * ratio
-            height = scale / ratio
-            left = np.random.uniform(0., 1 - width)
-            top = np.random.uniform(0., 1 - height)
-            rand_box = (left, top, left + width, top + height)
-            valid_mask = np.where(label[:, 0] > -1)[0]
-            gt = label[valid_mask, :]
-            ious = self._check_satisfy(rand_box, gt)
-            if ious is not None:
-                # transform gt labels after crop, discard bad ones
-                l, t, r, b = rand_box
-                new_gt_boxes = []
-                new_width = r - l
-                new_height = b - t
-                for i in range(valid_mask.size):
-                    if ious[i] > 0:
-                        xmin = max(0., (gt[i, 1] - l) / new_width)
-                        ymin = max(0., (gt[i, 2] - t) / new_height)
-                        xmax = min(1., (gt[i, 3] - l) / new_width)
-                        ymax = min(1., (gt[i, 4] - t) / new_height)
-                        new_gt_boxes.append([gt[i, 0], xmin, ymin, xmax, ymax])
-                if not new_gt_boxes:
-                    continue
-                new_gt_boxes = np.array(new_gt_boxes)
-                label = np.lib.pad(new_gt_boxes,
-                    ((0, label.shape[0]-new_gt_boxes.shape[0]), (0,0)), \
-                    'constant', constant_values=(-1, -1))
-                samples.append((rand_box, label))
-                count += 1
+        for trial in satisfied[:self.max_sample]:
+            # transform gt labels after crop, discard bad ones
+            l, t, r, b = rand_boxes[trial]
+            new_gt_boxes = gt[ious[trial] > 0, :5].copy()
+            new_gt_boxes[:, 1::2] = (new_gt_boxes[:, 1::2] - l) / (r - l)
+            new_gt_boxes[:, 2::2] = (new_gt_boxes[:, 2::2] - t) / (b - t)
+            new_gt_boxes[:, 1:3] = np.maximum(new_gt_boxes[:, 1:3], 0.)
+            new_gt_boxes[:, 3:5] = np.minimum(new_gt_boxes[:, 3:5], 1.)
+            new_label = np.lib.pad(new_gt_boxes,
+                ((0, label.shape[0]-new_gt_boxes.shape[0]), (0,0)), \
+                'constant', constant_values=(-1, -1))
+            samples.append((tuple(rand_boxes[trial]), new_label))
         return samples
 
-    def _check_satisfy(self, rand_box, gt_boxes):
+    def _generate_boxes(self, num_trials):
+        """
+        draw random (left, top, right, bottom) boxes, one row per trial
         """
-        check if overlap with any gt box is larger than threshold
+        scale = np.random.uniform(self.min_scale, self.max_scale, num_trials)
+        min_ratio = np.maximum(self.min_aspect_ratio, scale * scale)
+        max_ratio = np.minimum(self.max_aspect_ratio, 1. / scale / scale)
+        ratio = np.sqrt(np.random.uniform(min_ratio, max_ratio))
+        width = scale * ratio
+        height = scale / ratio
+        left = np.random.uniform(0., 1 - width)
+        top = np.random.uniform(0., 1 - height)
+        return np.stack((left, top, left + width, top + height), axis=1)
+
+    def _compute_ious(self, rand_boxes, gt_boxes):
         """
-        l, t, r, b = rand_box
-        num_gt = gt_boxes.shape[0]
-        ls = np.ones(num_gt) * l
-        ts = np.ones(num_gt) * t
-        rs = np.ones(num_gt) * r
-        bs = np.ones(num_gt) * b
-        mask = np.where(ls < gt_boxes[:, 1])[0]
-        ls[mask] = gt_boxes[mask, 1]
-        mask = np.where(ts < gt_boxes[:, 2])[0]
-        ts[mask] = gt_boxes[mask, 2]
-        mask = np.where(rs > gt_boxes[:, 3])[0]
-        rs[mask] = gt_boxes[mask, 3]
-        mask = np.where(bs > gt_boxes[:, 4])[0]
-        bs[mask] = gt_boxes[mask, 4]
-        w = rs - ls
-        w[w < 0] = 0
-        h = bs - ts
-        h[h < 0] = 0
+        (num_trials x num_gt) overlaps between random boxes and ground-truths
+        """
+        l, t, r, b = [rand_boxes[:, i:i+1] for i in range(4)]
+        w = np.maximum(np.minimum(r, gt_boxes[:, 3]) - np.maximum(l, gt_boxes[:, 1]), 0)
+        h = np.maximum(np.minimum(b, gt_boxes[:, 4]) - np.maximum(t, gt_boxes[:, 2]), 0)
         inter_area = h * w
-        union_area = np.ones(num_gt) * max(0, r - l) * max(0, b - t)
-        union_area += (gt_boxes[:, 3] - gt_boxes[:, 1]) * (gt_boxes[:, 4] - gt_boxes[:, 2])
+        union_area = np.maximum(r - l, 0) * np.maximum(b - t, 0)
+        union_area = union_area + (gt_boxes[:, 3] - gt_boxes[:, 1]) * (gt_boxes[:, 4] - gt_boxes[:, 2])
         union_area -= inter_area
-        ious = inter_area / union_area
-        ious[union_area <= 0] = 0
-        max_iou = np.amax(ious)
-        if max_iou < self.min_overlap:
-            return None
+        valid = union_area > 0
+        ious = np.zeros_like(inter_area)
+        ious[valid] = inter_area[valid] / union_area[valid]
+        return ious
+
+    def _check_satisfy(self, rand_boxes, gt_boxes, ious):
+        """
+        check for each random box if overlap with any gt box is larger than
+        threshold, and if the overlapping gt boxes meet the constraint
+        """
+        overlapped = ious > 0
+        # at least one gt box has to be kept
+        satisfied = np.any(overlapped, axis=1)
+        satisfied &= np.amax(ious, axis=1) >= self.min_overlap
+        l, t, r, b = [rand_boxes[:, i:i+1] for i in range(4)]
         # check ground-truth constraint
         if self.config['gt_constraint'] == 'center':
-            for i in range(ious.shape[0]):
-                if ious[i] > 0:
-                    gt_x = (gt_boxes[i, 1] + gt_boxes[i, 3]) / 2.0
-                    gt_y = (gt_boxes[i, 2] + gt_boxes[i, 4]) / 2.0
-                    if gt_x < l or gt_x > r or gt_y < t or gt_y > b:
-                        return None
+            gt_x = (gt_boxes[:, 1] + gt_boxes[:, 3]) / 2.0
+            gt_y = (gt_boxes[:, 2] + gt_boxes[:, 4]) / 2.0
+            outside = (gt_x < l) | (gt_x > r) | (gt_y < t) | (gt_y > b)
+            satisfied &= ~np.any(overlapped & outside, axis=1)
         elif self.config['gt_constraint'] == 'corner':
-            for i in range(ious.shape[0]):
-                if ious[i] > 0:
-                    if gt_boxes[i, 1] < l or gt_boxes[i, 3] > r \
-                        or gt_boxes[i, 2] < t or gt_boxes[i, 4] > b:
-                        return None
-        return ious
+            outside = (gt_boxes[:, 1] < l) | (gt_boxes[:, 3] > r) | \
+                (gt_boxes[:, 2] < t) | (gt_boxes[:, 4] > b)
+            satisfied &= ~np.any(overlapped & outside, axis=1)
+        return satisfied
 
 
 class RandPadder(RandSampler):
@@ -28,7 +28,8 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
               min_obj_size=32.0, use_difficult=False,
               nms_thresh=0.45, force_suppress=False, ovp_thresh=0.5,
               voc07_metric=True, nms_topk=400,
-              iter_monitor=0, monitor_pattern=".*", log_file=None):
+              iter_monitor=0, monitor_pattern=".*", log_file=None,
+              num_workers=0):
     """
     Wrapper for training phase.
 
@@ -86,6 +87,9 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
         regex pattern for monitoring network stats
     log_file : str
         log to file if enabled
+    num_workers : int
+        number of image decoding processes for each data iterator, 0 to decode
+        in the training thread
     """
     # set up logger
     logging.basicConfig()
@@ -131,11 +135,11 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
     train_iter = DetIter(imdb, batch_size, data_shape[1], rand_scaler,
                          mean_pixels, cfg.train['rand_mirror_prob'] > 0,
                          cfg.train['shuffle'], cfg.train['seed'],
-                         is_train=True)
+                         is_train=True, num_workers=num_workers)
     if val_imdb:
         rand_scaler = RandScaler(patch_size, no_random=True, force_resize=force_resize)
         val_iter = DetIter(val_imdb, batch_size, data_shape[1], rand_scaler,
-                           mean_pixels, is_train=True)
+                           mean_pixels, is_train=True, num_workers=num_workers)
     else:
         val_iter = None
 
@@ -87,6 +87,8 @@ def parse_args():
                         help='force non-maximum suppression on different class')
     parser.add_argument('--voc07', dest='use_voc07_metric', type=bool, default=True,
                         help='use PASCAL VOC 07 11-point metric')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=0,
+                        help='number of image decoding processes, 0 to decode in the training thread')
     args = parser.parse_args()
     return args
 
@@ -119,4 +121,5 @@ if __name__ == '__main__':
               nms_thresh=args.nms_thresh,
               ovp_thresh=args.overlap_thresh,
               force_suppress=args.force_nms,
-              voc07_metric=args.use_voc07_metric)
+              voc07_metric=args.use_voc07_metric,
+              num_workers=args.num_workers)